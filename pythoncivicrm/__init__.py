@@ -1,11 +1,17 @@
 """
 Package level import
 """
+import sys
 
 __all__ = [
     'CiviCRM',
     'CivicrmError',
 ]
 
-from pythoncivicrm import CiviCRM
-from pythoncivicrm import CivicrmError
+from .pythoncivicrm import CiviCRM
+from .pythoncivicrm import CivicrmError
+
+# async/await syntax is only available on Python 3.5+
+if sys.version_info >= (3, 5):
+    from .asynccivicrm import AsyncCiviCRM
+    __all__.append('AsyncCiviCRM')
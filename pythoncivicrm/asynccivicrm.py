@@ -0,0 +1,471 @@
+"""
+.. module::asynccivicrm
+:synopis:asyncio interface to the CiviCRM v3 API.
+
+AsyncCiviCRM
+============
+
+AsyncCiviCRM mirrors the methods of the CiviCRM class as coroutines, for use
+from asyncio code. It takes the same arguments as CiviCRM, plus
+max_concurrency, the maximum number of API calls in flight at once
+(default 10). Requires Python 3.5 or later.
+
+If httpx is installed, requests are sent by it without blocking, while
+payloads are built and results checked by a CiviCRM instance (available as
+client) exactly as it does itself. Otherwise, or with native=False, calls
+are made by the client in a pool of worker threads, as are those of helpers
+such as add_activity that make several API calls (in a single slot) and
+get with related. Pass an existing CiviCRM object as client to share its
+settings, caches and (for calls made in worker threads) connection pool::
+
+    civicrm = CiviCRM(url, site_key, api_key)
+    async_civicrm = AsyncCiviCRM(client=civicrm, max_concurrency=20)
+
+    async def lookup(ids):
+        return await asyncio.gather(
+            *[async_civicrm.getsingle('Contact', id=i) for i in ids]
+        )
+
+Cancelling a call that is still waiting for a free slot means the request
+is never sent. Cancelling a request sent by httpx abandons it, while a call
+handed to a worker thread will complete, but the result is discarded.
+Calls sent by httpx use the client's result cache and metrics, but are not
+hedged or traced, since they don't run in a thread of their own.
+
+Call aclose() (or use async with) to close the connections opened by httpx,
+and shut down the worker threads and the client's connection pool if it was
+created by AsyncCiviCRM. close() does the same except for httpx's.
+
+With coalesce=True (the default if the client coalesces), identical reads
+(get, getsingle, getvalue, getcount, getoptions, getfields) awaited at the
+same time share a single call, and so a single slot. Cancelling one of the
+callers doesn't cancel the shared call.
+"""
+
+import asyncio
+import copy
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+from .cache import MISSING, fingerprint
+from .pythoncivicrm import CiviCRM
+from .records import to_records
+from .transport import FORM_HEADERS, query_string
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+
+class HttpxTransport(object):
+    """
+    .. class::HttpxTransport(self, pool_maxsize=10)
+    Sends requests with an httpx.AsyncClient, created on first use (so in
+    the running loop) with up to pool_maxsize connections. As the
+    transports in transport, except that request and close are coroutines
+    and responses are read in full.
+    """
+    name = 'httpx'
+
+    def __init__(self, pool_maxsize=10):
+        self.pool_maxsize = pool_maxsize
+        self._client = None
+
+    @property
+    def client(self):
+        """The httpx.AsyncClient used."""
+        if self._client is None:
+            self._client = httpx.AsyncClient(limits=httpx.Limits(
+                max_connections=self.pool_maxsize,
+                max_keepalive_connections=self.pool_maxsize
+            ))
+        return self._client
+
+    async def request(self, method, url, payload, timeout=None):
+        if isinstance(timeout, tuple):
+            # (connect, read), as requests takes
+            timeout = httpx.Timeout(timeout[1], connect=timeout[0])
+        else:
+            timeout = httpx.Timeout(timeout)
+        query = query_string(payload)
+        if method == 'get':
+            return await self.client.get('%s?%s' % (url, query),
+                                         timeout=timeout)
+        return await self.client.post(url, content=query.encode('utf-8'),
+                                      headers=FORM_HEADERS, timeout=timeout)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+
+class AsyncCiviCRM(object):
+    """
+    .. class::AsyncCiviCRM(
+                    self, [url], [site_key], [api_key], [client=None],
+                    [max_concurrency=10], [coalesce=None], [native=True],
+                    **kwargs
+                    )
+    Make calls against the Civicrm API from asyncio code.
+    """
+
+    def __init__(self, url=None, site_key=None, api_key=None, client=None,
+                 max_concurrency=10, coalesce=None, native=True, **kwargs):
+        """Either supply url and keys (and any other CiviCRM arguments)
+        or an existing CiviCRM object as client."""
+        if client is None:
+            # one pooled connection per worker
+            kwargs.setdefault('pool_maxsize', max_concurrency)
+            kwargs['coalesce'] = bool(coalesce)
+            client = CiviCRM(url, site_key, api_key, **kwargs)
+            self._owns_client = True
+        else:
+            self._owns_client = False
+        self.client = client
+        self.max_concurrency = max_concurrency
+        if native and httpx is not None:
+            self.transport = HttpxTransport(max_concurrency)
+        else:
+            self.transport = None
+        # created when first needed
+        self._executor = None
+        self._semaphore = None
+        if coalesce is None:
+            coalesce = client.coalescer is not None
+        self.coalesce = coalesce
+        self._inflight = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.aclose()
+
+    def close(self):
+        """Shut down worker threads, and close the client's connections
+        if the client was created by us."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+        if self._owns_client:
+            self.client.close()
+
+    async def aclose(self):
+        """Like close, also closing the connections opened by httpx."""
+        self.close()
+        if self.transport is not None:
+            await self.transport.close()
+
+    def _slot(self):
+        """Returns the semaphore limiting calls in flight."""
+        if self._semaphore is None:
+            # created here so it belongs to the running loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _call(self, method, *args, **kwargs):
+        """Run a blocking client method in the worker pool,
+        waiting for a free slot first."""
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrency)
+        loop = asyncio.get_event_loop()
+        async with self._slot():
+            return await loop.run_in_executor(
+                self._executor, functools.partial(method, *args, **kwargs)
+            )
+
+    async def _read(self, method, *args, **kwargs):
+        """Like _call for client methods that only read, but if coalescing
+        shares the call with any identical one already in progress.
+        Without a worker pool method is one of ours instead."""
+        if self.transport is None:
+            call = functools.partial(self._call, getattr(self.client, method))
+        else:
+            call = getattr(self, '_native_%s' % method)
+        if not self.coalesce:
+            return await call(*args, **kwargs)
+        key = fingerprint([method, args, kwargs])
+        task = self._inflight.get(key)
+        leader = task is None
+        if leader:
+            task = asyncio.ensure_future(call(*args, **kwargs))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # so cancelling one caller doesn't cancel the call for the others
+        results = await asyncio.shield(task)
+        # the others get their own copy, as results may be changed in place
+        return results if leader else copy.deepcopy(results)
+
+    async def _request(self, use, payload):
+        """Send payload using GET or POST with httpx, waiting for a free
+        slot first. Returns the response or raises a CivicrmError if the
+        status code is anything other than 200."""
+        async with self._slot():
+            api_call = await self.transport.request(
+                use, self.client.url, payload, self.client.timeout)
+        self.client._received(payload, api_call)
+        return api_call
+
+    async def _get_payload(self, payload):
+        """Coroutine version of CiviCRM._get_payload, sending the request
+        with httpx."""
+        client = self.client
+        with client._timer(payload['entity'], payload['action']) as timer:
+            content, store = client._cache_lookup(payload)
+            if content is MISSING:
+                api_call = await self._request(client._get_method(payload),
+                                               payload)
+                content = api_call.content
+                results = client.json_codec.decode(content)
+                if store is not None:
+                    store(content, results)
+            else:
+                results = client.json_codec.decode(content)
+            timer.result = results = client._check_results(results)
+        return results
+
+    async def _post_payload(self, postdata, parameters):
+        """Coroutine version of CiviCRM._post_payload, sending the request
+        with httpx."""
+        client = self.client
+        entity = postdata['entity']
+        with client._timer(entity, postdata['action']) as timer:
+            try:
+                api_call = await self._request('post', postdata)
+            finally:
+                client._written(entity, parameters)
+            timer.result = results = client._post_results(entity,
+                                                          api_call.content)
+        return results
+
+    async def _get(self, action, entity, parameters=None):
+        """Coroutine version of CiviCRM._get."""
+        if self.transport is None:
+            return await self._call(self.client._get, action, entity,
+                                    parameters)
+        payload = self.client._construct_payload('get', action, entity,
+                                                 parameters or {})
+        return await self._get_payload(payload)
+
+    async def _post(self, action, entity, parameters=None):
+        """Coroutine version of CiviCRM._post."""
+        if self.transport is None:
+            return await self._call(self.client._post, action, entity,
+                                    parameters)
+        parameters = parameters or {}
+        postdata = self.client._construct_payload('post', action, entity,
+                                                  parameters)
+        return await self._post_payload(postdata, parameters)
+
+    async def _metadata(self, key, fetch):
+        """Coroutine version of CiviCRM._cached_metadata, fetch being
+        a coroutine function."""
+        cache = self.client.metadata_cache
+        if cache is None:
+            return await fetch()
+        value = cache.get(key)
+        if value is MISSING:
+            value = await fetch()
+            cache.set(key, value)
+        return value
+
+    async def _native_get(self, entity, **kwargs):
+        """As CiviCRM.get, sending the request with httpx. Related
+        records are fetched by the client in a worker thread."""
+        if kwargs.get('related'):
+            return await self._call(self.client.get, entity, **kwargs)
+        limit = kwargs.pop('limit', None)
+        offset = kwargs.pop('offset', None)
+        kwargs.pop('related', None)
+        params = self.client._add_options(kwargs, limit=limit, offset=offset)
+        results = await self._get('get', entity, params)
+        if self.client.records and isinstance(results, list):
+            results = to_records(entity, results)
+        return results
+
+    async def _native_getsingle(self, entity, **kwargs):
+        return await self._get('getsingle', entity, kwargs)
+
+    async def _native_getvalue(self, entity, returnfield, **kwargs):
+        kwargs['return'] = returnfield
+        return await self._get('getvalue', entity, kwargs)
+
+    async def _native_getcount(self, entity, **kwargs):
+        return await self._get('getcount', entity, kwargs)
+
+    async def _native_getfields(self, entity):
+        return await self._metadata(
+            ('getfields', entity),
+            lambda: self._get('getfields', entity, {'sequential': 0})
+        )
+
+    async def _native_getoptions(self, entity, field):
+        return await self._metadata(
+            ('getoptions', entity, field),
+            lambda: self._get('getoptions', entity,
+                              {'field': field, 'sequential': 0})
+        )
+
+    async def is_valid_option(self, entity, field, value):
+        """Coroutine version of CiviCRM.is_valid_option."""
+        return await self._call(
+            self.client.is_valid_option, entity, field, value
+        )
+
+    async def resolve_options(self, entity, field, values, strict=True):
+        """Coroutine version of CiviCRM.resolve_options."""
+        return await self._call(
+            self.client.resolve_options, entity, field, values, strict
+        )
+
+    async def get(self, entity, **kwargs):
+        """Coroutine version of CiviCRM.get."""
+        return await self._read('get', entity, **kwargs)
+
+    async def get_many(self, entity, values, field='id', **kwargs):
+        """Coroutine version of CiviCRM.get_many. Its chunks are fetched
+        by the client's own threads, using a single slot here."""
+        return await self._call(
+            self.client.get_many, entity, values, field, **kwargs
+        )
+
+    async def getsingle(self, entity, **kwargs):
+        """Coroutine version of CiviCRM.getsingle."""
+        return await self._read('getsingle', entity, **kwargs)
+
+    async def getvalue(self, entity, returnfield, **kwargs):
+        """Coroutine version of CiviCRM.getvalue."""
+        return await self._read('getvalue', entity, returnfield, **kwargs)
+
+    async def create(self, entity, **kwargs):
+        """Coroutine version of CiviCRM.create."""
+        if self.transport is None:
+            return await self._call(self.client.create, entity, **kwargs)
+        chained = [key for key in kwargs if key.startswith('api.')]
+        results = await self._post('create', entity, kwargs)
+        if chained and isinstance(results, list):
+            results = [self.client._check_chained(row) for row in results]
+        return results
+
+    async def update(self, entity, db_id, **kwargs):
+        """Coroutine version of CiviCRM.update."""
+        if self.transport is None:
+            return await self._call(self.client.update, entity, db_id,
+                                    **kwargs)
+        return await self.create(entity, id=db_id, **kwargs)
+
+    async def setvalue(self, entity, db_id, field, value):
+        """Coroutine version of CiviCRM.setvalue."""
+        if self.transport is None:
+            return await self._call(
+                self.client.setvalue, entity, db_id, field, value
+            )
+        return await self._post(
+            'setvalue', entity, {'id': db_id, 'field': field, 'value': value}
+        )
+
+    async def delete(self, entity, db_id, skip_undelete=False):
+        """Coroutine version of CiviCRM.delete."""
+        if self.transport is None:
+            return await self._call(
+                self.client.delete, entity, db_id, skip_undelete
+            )
+        params = {'id': db_id}
+        if skip_undelete is True:
+            params['skip_undelete'] = 1
+        return await self._post('delete', entity, params)
+
+    async def getcount(self, entity, **kwargs):
+        """Coroutine version of CiviCRM.getcount."""
+        return await self._read('getcount', entity, **kwargs)
+
+    async def getfields(self, entity):
+        """Coroutine version of CiviCRM.getfields."""
+        return await self._read('getfields', entity)
+
+    async def getoptions(self, entity, field):
+        """Coroutine version of CiviCRM.getoptions."""
+        return await self._read('getoptions', entity, field)
+
+    async def doaction(self, action, entity, **kwargs):
+        """Coroutine version of CiviCRM.doaction."""
+        if self.transport is None:
+            return await self._call(self.client.doaction, action, entity,
+                                    **kwargs)
+        return await self._post(action, entity, kwargs)
+
+    async def add_contact(self, contact_type, **kwargs):
+        """Coroutine version of CiviCRM.add_contact."""
+        return await self._call(self.client.add_contact, contact_type, **kwargs)
+
+    async def add_relationship(self, contact_a, contact_b, relationship,
+                               **kwargs):
+        """Coroutine version of CiviCRM.add_relationship."""
+        return await self._call(
+            self.client.add_relationship, contact_a, contact_b, relationship,
+            **kwargs
+        )
+
+    async def add_activity_type(self, label, weight=5, is_active=0, **kwargs):
+        """Coroutine version of CiviCRM.add_activity_type."""
+        return await self._call(
+            self.client.add_activity_type, label, weight, is_active, **kwargs
+        )
+
+    async def add_activity(self, activity_type, sourceid, *args, **kwargs):
+        """Coroutine version of CiviCRM.add_activity."""
+        return await self._call(
+            self.client.add_activity, activity_type, sourceid, *args, **kwargs
+        )
+
+    async def add_contribution(self, contact_id, total_amount,
+                               financial_type, **kwargs):
+        """Coroutine version of CiviCRM.add_contribution."""
+        return await self._call(
+            self.client.add_contribution, contact_id, total_amount,
+            financial_type, **kwargs
+        )
+
+    async def add_email(self, contact_id, email, email_like=False, **kwargs):
+        """Coroutine version of CiviCRM.add_email."""
+        return await self._call(
+            self.client.add_email, contact_id, email, email_like, **kwargs
+        )
+
+    async def add_note(self, entity_id, note, **kwargs):
+        """Coroutine version of CiviCRM.add_note."""
+        return await self._call(self.client.add_note, entity_id, note, **kwargs)
+
+    async def add_tag(self, name, **kwargs):
+        """Coroutine version of CiviCRM.add_tag."""
+        return await self._call(self.client.add_tag, name, **kwargs)
+
+    async def add_entity_tag(self, entity_id, tag_id,
+                             entity_table="civicrm_contact"):
+        """Coroutine version of CiviCRM.add_entity_tag."""
+        return await self._call(
+            self.client.add_entity_tag, entity_id, tag_id, entity_table
+        )
+
+    async def add_group(self, title, **kwargs):
+        """Coroutine version of CiviCRM.add_group."""
+        return await self._call(self.client.add_group, title, **kwargs)
+
+    async def add_group_contact(self, contact_id, group_id, **kwargs):
+        """Coroutine version of CiviCRM.add_group_contact."""
+        return await self._call(
+            self.client.add_group_contact, contact_id, group_id, **kwargs
+        )
+
+    async def add_phone(self, contact_id, phone, **kwargs):
+        """Coroutine version of CiviCRM.add_phone."""
+        return await self._call(self.client.add_phone, contact_id, phone,
+                                **kwargs)
+
+    async def add_address(self, contact_id, location_type, **kwargs):
+        """Coroutine version of CiviCRM.add_address."""
+        return await self._call(
+            self.client.add_address, contact_id, location_type, **kwargs
+        )
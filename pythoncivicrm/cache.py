@@ -0,0 +1,307 @@
+"""
+.. module::cache
+:synopis:Caches used by CiviCRM.
+
+LRUCache is a thread safe, size bounded cache whose entries expire after ttl
+seconds. It counts hits and misses so its effectiveness can be checked.
+
+DiskCache has the same interface but keeps entries in an SQLite database, so
+they survive restarts and can be shared by several processes. Keys must be
+JSON serialisable (tuples are returned as such) and values picklable.
+Either can be used as the result cache of a CiviCRM object.
+
+Keys that are tuples are grouped by their first item (the entity, for the
+keys CiviCRM uses), and invalidate_groups removes whole groups without
+looking at every key.
+
+fingerprint returns a canonical string for a request, to use as a key.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# returned by get for a missing key, as None is a perfectly good value
+MISSING = object()
+
+
+def fingerprint(request):
+    """Returns a string identifying request (e.g. a payload dictionary),
+    the same for equal requests whatever the order of their keys."""
+    return json.dumps(request, sort_keys=True, separators=(',', ':'),
+                      default=str)
+
+
+class LRUCache(object):
+    """
+    .. class::LRUCache(self, maxsize=256, ttl=300)
+    Holds up to maxsize entries, discarding the least recently used when
+    full. Entries older than ttl seconds are treated as missing, a ttl of
+    None means they never expire. A different ttl can be given to set.
+    """
+
+    def __init__(self, maxsize=256, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        # group: set of keys, see invalidate_groups
+        self._groups = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.peek(key) is not MISSING
+
+    def peek(self, key):
+        """Like get, but doesn't count as a hit or miss or update recency."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or self._expired(entry):
+                return MISSING
+            return entry[1]
+
+    def _expired(self, entry):
+        return entry[2] is not None and time.time() - entry[0] > entry[2]
+
+    def get(self, key, default=MISSING):
+        """Returns the value for key, or default if it is not cached."""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is None or self._expired(entry):
+                if entry is not None:
+                    self._ungroup(key)
+                self.misses += 1
+                return default
+            # move to the most recently used end
+            self._data[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=MISSING):
+        """Cache value for key, for ttl seconds if given (None for ever)
+        instead of the cache's ttl."""
+        if ttl is MISSING:
+            ttl = self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (time.time(), value, ttl)
+            group = _group(key)
+            if group is not None:
+                self._groups.setdefault(group, set()).add(key)
+            while len(self._data) > self.maxsize:
+                self._ungroup(self._data.popitem(last=False)[0])
+
+    def _ungroup(self, key):
+        """Remove key, which is no longer cached, from its group."""
+        group = _group(key)
+        keys = self._groups.get(group)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._groups[group]
+
+    def invalidate(self, match=None):
+        """Remove entries. With no arguments everything is removed.
+        match can be a key, or a function that is passed each key and
+        returns True for those to be removed.
+        """
+        with self._lock:
+            if match is None:
+                self._data.clear()
+                self._groups.clear()
+            elif callable(match):
+                for key in [k for k in self._data if match(k)]:
+                    del self._data[key]
+                    self._ungroup(key)
+            elif self._data.pop(match, None) is not None:
+                self._ungroup(match)
+
+    def invalidate_groups(self, groups):
+        """Remove the entries whose keys are tuples starting with one of
+        groups."""
+        with self._lock:
+            for group in groups:
+                for key in self._groups.pop(group, ()):
+                    del self._data[key]
+
+    def stats(self):
+        """Returns a dictionary of hits, misses, size and maxsize."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._data),
+            'maxsize': self.maxsize,
+        }
+
+
+class DiskCache(object):
+    """
+    .. class::DiskCache(self, path, maxsize=10000, ttl=300)
+    Like LRUCache, but stored in the SQLite database at path, which is
+    created if necessary. Hits and misses are counted per object, as are
+    entries to keep within maxsize, so if several processes share the
+    database it can hold more.
+    """
+
+    def __init__(self, path, maxsize=10000, ttl=300):
+        self.path = path
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # shared between threads, access is serialised by _lock
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        # it's a cache, so losing the latest writes in a crash is fine
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            self._db.execute(
+                'CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, '
+                'value BLOB, expires REAL, used REAL, grp TEXT)'
+            )
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS cache_grp ON cache (grp)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS cache_used ON cache (used)')
+            self._db.execute(
+                'CREATE INDEX IF NOT EXISTS cache_expires ON cache (expires)')
+        self._size = self._count()
+
+    def __len__(self):
+        with self._lock:
+            return self._count()
+
+    def _count(self):
+        return self._db.execute('SELECT COUNT(*) FROM cache').fetchone()[0]
+
+    def __contains__(self, key):
+        return self.peek(key) is not MISSING
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _load(self, key):
+        """Returns the unexpired value for key, or MISSING."""
+        row = self._db.execute(
+            'SELECT value, expires FROM cache WHERE key = ?', (_dumps(key),)
+        ).fetchone()
+        if row is None or (row[1] is not None and row[1] < time.time()):
+            return MISSING
+        return pickle.loads(bytes(row[0]))
+
+    def peek(self, key):
+        """Like get, but doesn't count as a hit or miss or update recency."""
+        with self._lock:
+            return self._load(key)
+
+    def get(self, key, default=MISSING):
+        """Returns the value for key, or default if it is not cached."""
+        with self._lock:
+            value = self._load(key)
+            if value is MISSING:
+                self.misses += 1
+                return default
+            self.hits += 1
+            with self._db:
+                self._db.execute('UPDATE cache SET used = ? WHERE key = ?',
+                                 (time.time(), _dumps(key)))
+            return value
+
+    def set(self, key, value, ttl=MISSING):
+        """Cache value for key, for ttl seconds if given (None for ever)
+        instead of the cache's ttl."""
+        if ttl is MISSING:
+            ttl = self.ttl
+        now = time.time()
+        expires = None if ttl is None else now + ttl
+        data = sqlite3.Binary(pickle.dumps(value, 2))
+        group = _group(key)
+        if group is not None:
+            group = _dumps(group)
+        stored = _dumps(key)
+        with self._lock, self._db:
+            if self._db.execute('SELECT 1 FROM cache WHERE key = ?',
+                                (stored,)).fetchone() is None:
+                self._size += 1
+            self._db.execute(
+                'INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)',
+                (stored, data, expires, now, group)
+            )
+            if self._size > self.maxsize:
+                # discard expired entries, then the least recently used
+                self._size -= self._db.execute(
+                    'DELETE FROM cache WHERE expires < ?', (now,)).rowcount
+            if self._size > self.maxsize:
+                self._size -= self._db.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM cache '
+                    'ORDER BY used LIMIT ?)', (self._size - self.maxsize,)
+                ).rowcount
+
+    def invalidate(self, match=None):
+        """Remove entries. With no arguments everything is removed.
+        match can be a key, or a function that is passed each key and
+        returns True for those to be removed.
+        """
+        with self._lock, self._db:
+            if match is None:
+                self._db.execute('DELETE FROM cache')
+            elif callable(match):
+                keys = [row[0] for row in
+                        self._db.execute('SELECT key FROM cache').fetchall()
+                        if match(_loads(row[0]))]
+                self._db.executemany('DELETE FROM cache WHERE key = ?',
+                                     [(key,) for key in keys])
+            else:
+                self._db.execute('DELETE FROM cache WHERE key = ?',
+                                 (_dumps(match),))
+            self._size = self._count()
+
+    def invalidate_groups(self, groups):
+        """Remove the entries whose keys are tuples starting with one of
+        groups."""
+        groups = [_dumps(group) for group in groups]
+        if not groups:
+            return
+        with self._lock, self._db:
+            self._size -= self._db.execute(
+                'DELETE FROM cache WHERE grp IN (%s)'
+                % ', '.join('?' * len(groups)), groups
+            ).rowcount
+
+    def stats(self):
+        """Returns a dictionary of hits, misses, size and maxsize."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self),
+            'maxsize': self.maxsize,
+        }
+
+
+def _group(key):
+    """The group of key, its first item if it is a tuple, or None."""
+    if isinstance(key, tuple) and key:
+        return key[0]
+    return None
+
+
+def _dumps(key):
+    """DiskCache key as stored."""
+    return json.dumps(key, separators=(',', ':'))
+
+
+def _loads(key):
+    """DiskCache key as stored back to the original, lists becoming tuples."""
+    key = json.loads(key)
+    return tuple(key) if isinstance(key, list) else key
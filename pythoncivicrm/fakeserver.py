@@ -0,0 +1,451 @@
+"""
+.. module::fakeserver
+:synopis:Stand-in for the CiviCRM REST API, for tests and benchmarks.
+
+FakeCiviCRM answers API v3 requests from in-memory tables of rows, one per
+entity. It understands get, getsingle, getvalue, getcount, create (which
+updates if id is given), setvalue, delete, getoptions and getfields, the
+options[limit], options[offset] and options[sort] options, return,
+sequential, the json parameter and the IN, comparison and LIKE operators.
+It is nowhere near a complete implementation, but enough to exercise the
+client's paging, batching, caching and concurrency without a network.
+
+Latency (plus up to jitter seconds more, chosen at random), API errors and
+HTTP errors can be injected, and each row returned can be padded to make
+responses bigger.
+
+FakeServer serves a FakeCiviCRM over HTTP on localhost from a background
+thread, at the path CiviCRM expects::
+
+    fake = FakeCiviCRM({'Contact': sample_contacts(1000)}, latency=0.02)
+    with FakeServer(fake) as server:
+        civicrm = server.civicrm()
+        civicrm.get('Contact', limit=10)
+
+To leave out HTTP altogether use fake.civicrm(), which makes calls through
+a transport.InProcessTransport.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import random
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import parse_qsl, urlsplit
+    text_type = unicode
+except ImportError:
+    # Python 3
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import parse_qsl, urlsplit
+    text_type = str
+
+PATH = '/extern/rest.php'
+
+# CiviCRM returns 25 rows unless told otherwise
+DEFAULT_LIMIT = 25
+
+OPERATORS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '<>': lambda a, b: a != b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+}
+
+# parameters that aren't fields to filter on
+NOT_FIELDS = set([
+    'key', 'api_key', 'entity', 'action', 'json', 'sequential', 'return',
+    'options', 'field', 'id', 'value',
+])
+
+
+def sample_contacts(count):
+    """Returns count Contact rows, with ids from 1, as the API would."""
+    return [{
+        'id': text_type(i),
+        'contact_id': text_type(i),
+        'contact_type': 'Individual',
+        'sort_name': 'Surname%s, Forename' % i,
+        'display_name': 'Forename Surname%s' % i,
+        'first_name': 'Forename',
+        'last_name': 'Surname%s' % i,
+        'email': 'contact%s@example.org' % i,
+        'city': 'Portland',
+        'is_deleted': '0',
+    } for i in range(1, count + 1)]
+
+
+class FakeCiviCRM(object):
+    """
+    .. class::FakeCiviCRM(
+                    self, tables=None, options=None, site_key='site_key',
+                    api_key='api_key', latency=0, jitter=0, error_rate=0,
+                    http_error_rate=0, padding=0, seed=None
+                    )
+    tables is a dictionary of entity: list of rows (dictionaries), options
+    a dictionary of (entity, field): {id: label} for getoptions.
+    error_rate and http_error_rate are the fractions of requests that get an
+    API error (a deadlock) or a 500 response. padding adds a field of that
+    many characters to every row returned.
+    requests counts the requests handled by (entity, action).
+    """
+
+    def __init__(self, tables=None, options=None, site_key='site_key',
+                 api_key='api_key', latency=0, jitter=0, error_rate=0,
+                 http_error_rate=0, padding=0, seed=None):
+        self.tables = dict((entity, [dict(row) for row in rows])
+                           for entity, rows in (tables or {}).items())
+        self.options = dict(options or {})
+        self.site_key = site_key
+        self.api_key = api_key
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.http_error_rate = http_error_rate
+        self.padding = padding
+        self.requests = {}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def handle(self, params):
+        """Answers the request with (list of (name, value) pairs, as form
+        decoded) params. Returns (status code, response dictionary)."""
+        params = self._merge(params)
+        entity, action = params.get('entity'), params.get('action')
+        with self._lock:
+            key = (entity, action)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            failure = self._random.random()
+            delay = self.latency + self._random.random() * self.jitter
+        if delay:
+            time.sleep(delay)
+        if failure < self.http_error_rate:
+            return 500, {'is_error': 1, 'error_message': 'Server Error'}
+        if failure < self.http_error_rate + self.error_rate:
+            return 200, _error('DB Error: Deadlock found when trying to '
+                               'get lock; try restarting transaction')
+        if (params.get('key') != self.site_key
+                or params.get('api_key') != self.api_key):
+            return 200, _error('Failed to authenticate key')
+        method = getattr(self, '_' + (action or '').lower(), None)
+        if method is None or entity is None:
+            return 200, _error('API (%s, %s) does not exist' %
+                               (entity, action))
+        with self._lock:
+            return 200, method(entity, params)
+
+    def civicrm(self, **kwargs):
+        """Returns a CiviCRM object calling handle directly."""
+        from .pythoncivicrm import CiviCRM
+        from .transport import InProcessTransport
+        return CiviCRM('fake', self.site_key, self.api_key,
+                       transport=InProcessTransport(self), **kwargs)
+
+    def _merge(self, pairs):
+        """Returns the parameters as a dictionary, parsed as PHP would:
+        the last of repeated names wins and name[] fields are collected into
+        a list. JSON encoded parameters are decoded and merged."""
+        params = {}
+        for name, value in pairs:
+            if name.endswith('[]'):
+                name = name[:-2]
+                if not isinstance(params.get(name), list):
+                    params[name] = []
+                params[name].append(value)
+            else:
+                params[name] = value
+        encoded = params.get('json')
+        if encoded and encoded != '1':
+            params.update(json.loads(encoded))
+        options = params.get('options')
+        options = dict(options) if isinstance(options, dict) else {}
+        for name in list(params):
+            if name.startswith('options[') and name.endswith(']'):
+                options[name[8:-1]] = params.pop(name)
+        params['options'] = options
+        return params
+
+    def _rows(self, entity, params):
+        """The rows of entity matching params, sorted and limited."""
+        rows = [row for row in self.tables.get(entity, [])
+                if _matches(row, params)]
+        options = params['options']
+        sort = options.get('sort')
+        if sort:
+            field, _, direction = sort.partition(' ')
+            rows.sort(key=lambda row: _sort_key(row.get(field)),
+                      reverse=direction.strip().upper() == 'DESC')
+        offset = int(options.get('offset') or 0)
+        limit = int(options.get('limit', DEFAULT_LIMIT) or 0)
+        rows = rows[offset:offset + limit] if limit else rows[offset:]
+        return [self._output(row, params) for row in rows]
+
+    def _output(self, row, params):
+        fields = params.get('return')
+        if fields:
+            if not isinstance(fields, list):
+                fields = fields.split(',')
+            fields = set(field.strip() for field in fields)
+            fields.add('id')
+            row = dict((key, value) for key, value in row.items()
+                       if key in fields)
+        else:
+            row = dict(row)
+        if self.padding:
+            row['padding'] = 'x' * self.padding
+        return row
+
+    def _get(self, entity, params):
+        rows = self._rows(entity, params)
+        if text_type(params.get('sequential', 1)) == '0':
+            values = dict((row['id'], row) for row in rows)
+        else:
+            values = rows
+        return {'is_error': 0, 'version': 3, 'count': len(rows),
+                'values': values}
+
+    def _single(self, entity, params):
+        params = dict(params, options=dict(params['options'], limit=0))
+        rows = self._rows(entity, params)
+        if len(rows) != 1:
+            return None, _error('Expected one %s but found %s'
+                                % (entity, len(rows)), count=len(rows))
+        return rows[0], None
+
+    def _getsingle(self, entity, params):
+        row, error = self._single(entity, params)
+        return error or row
+
+    def _getvalue(self, entity, params):
+        field = params.get('return')
+        row, error = self._single(entity, dict(params, **{'return': None}))
+        return error or {'is_error': 0, 'result': row.get(field)}
+
+    def _getcount(self, entity, params):
+        params = dict(params, options={'limit': 0})
+        return {'is_error': 0, 'result': len(self._rows(entity, params))}
+
+    def _create(self, entity, params):
+        table = self.tables.setdefault(entity, [])
+        values = dict((name, _text(value)) for name, value in params.items()
+                      if name not in NOT_FIELDS
+                      and not name.startswith('api.'))
+        row_id = params.get('id')
+        if row_id:
+            row = self._find(table, row_id)
+            if row is None:
+                return _error('Record %s not found' % row_id)
+        else:
+            row_id = max([int(r['id']) for r in table] or [0]) + 1
+            row = {'id': text_type(row_id)}
+            table.append(row)
+        row.update(values)
+        return {'is_error': 0, 'version': 3, 'count': 1, 'id': int(row['id']),
+                'values': [self._output(row, {})]}
+
+    def _setvalue(self, entity, params):
+        row = self._find(self.tables.get(entity, []), params.get('id'))
+        if row is None:
+            return _error('Record %s not found' % params.get('id'))
+        row[params['field']] = _text(params.get('value'))
+        return {'is_error': 0, 'version': 3, 'count': 1,
+                'values': {'id': row['id'],
+                           params['field']: row[params['field']]}}
+
+    def _delete(self, entity, params):
+        table = self.tables.get(entity, [])
+        row = self._find(table, params.get('id'))
+        if row is None:
+            return _error('Could not delete %s' % entity)
+        table.remove(row)
+        return {'is_error': 0, 'version': 3, 'count': 1, 'values': 1}
+
+    def _getoptions(self, entity, params):
+        options = self.options.get((entity, params.get('field')))
+        if options is None:
+            return _error('The field did not specify any options')
+        return {'is_error': 0, 'version': 3, 'count': len(options),
+                'values': dict(options)}
+
+    def _getfields(self, entity, params):
+        names = set(['id'])
+        for row in self.tables.get(entity, []):
+            names.update(row)
+        return {'is_error': 0, 'version': 3, 'count': len(names),
+                'values': dict((name, {'name': name}) for name in names)}
+
+    def _find(self, table, row_id):
+        for row in table:
+            if row.get('id') == text_type(row_id):
+                return row
+        return None
+
+
+def _error(message, **extra):
+    return dict({'is_error': 1, 'error_message': message}, **extra)
+
+
+def _text(value):
+    """Values are stored as strings, as CiviCRM returns them."""
+    if value is None or isinstance(value, (dict, list)):
+        return value
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    return text_type(value)
+
+
+def _sort_key(value):
+    """Sort numbers as numbers, then anything else as text."""
+    try:
+        return (0, float(value), '')
+    except (TypeError, ValueError):
+        return (1, 0, text_type(value))
+
+
+def _compare(value, operator, operand):
+    """True if row value matches operand under operator."""
+    if value is None:
+        return operator in ('IS NULL', '!=', '<>')
+    if operator == 'IN':
+        return value in [text_type(item) for item in operand]
+    if operator == 'NOT IN':
+        return value not in [text_type(item) for item in operand]
+    if operator == 'LIKE':
+        pattern = text_type(operand).lower()
+        text = value.lower()
+        if pattern.startswith('%') and pattern.endswith('%'):
+            return pattern.strip('%') in text
+        if pattern.endswith('%'):
+            return text.startswith(pattern.rstrip('%'))
+        if pattern.startswith('%'):
+            return text.endswith(pattern.lstrip('%'))
+        return text == pattern
+    if operator == 'IS NOT NULL':
+        return True
+    compare = OPERATORS.get(operator)
+    if compare is None:
+        return False
+    left, right = _sort_key(value), _sort_key(operand)
+    return compare(left, right)
+
+
+def _matches(row, params):
+    """True if row matches the field filters in params."""
+    for name, wanted in params.items():
+        if name in NOT_FIELDS and name != 'id' or name.startswith('api.'):
+            continue
+        if name.startswith('options'):
+            continue
+        value = row.get(name)
+        if isinstance(wanted, dict):
+            for operator, operand in wanted.items():
+                if not _compare(value, operator.upper(), operand):
+                    return False
+        elif isinstance(wanted, list):
+            if value not in [text_type(item) for item in wanted]:
+                return False
+        elif value != _text(wanted):
+            return False
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    # keep connections open, as requests does
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        parts = urlsplit(self.path)
+        self._answer(parts.path, _parse(parts.query))
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        self._answer(urlsplit(self.path).path,
+                     _parse(self.rfile.read(length)))
+
+    def _answer(self, path, params):
+        if not path.endswith(PATH):
+            status, response = 404, {'is_error': 1,
+                                     'error_message': 'Not Found'}
+        else:
+            status, response = self.server.fake.handle(params)
+        body = json.dumps(response).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _parse(query):
+    """Form decodes query (bytes or text) to a list of (name, value)."""
+    if str is not bytes and isinstance(query, bytes):
+        query = query.decode('utf-8')
+    pairs = parse_qsl(query, True)
+    if str is bytes:
+        # Python 2 unquotes to bytes
+        pairs = [(name.decode('utf-8'), value.decode('utf-8'))
+                 for name, value in pairs]
+    return pairs
+
+
+class _HTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class FakeServer(object):
+    """
+    .. class::FakeServer(self, fake=None, host='127.0.0.1', port=0)
+    Serves fake (a FakeCiviCRM, by default an empty one) over HTTP.
+    port 0 picks a free port. start() (or entering a with block) starts
+    serving, stop() shuts the server down.
+    """
+
+    def __init__(self, fake=None, host='127.0.0.1', port=0):
+        self.fake = fake if fake is not None else FakeCiviCRM()
+        self._server = _HTTPServer((host, port), _Handler)
+        self._server.fake = self.fake
+        self._thread = None
+
+    @property
+    def url(self):
+        """The url to give CiviCRM (with use_ssl=False)."""
+        host, port = self._server.server_address[:2]
+        return 'http://%s:%s' % (host, port)
+
+    def civicrm(self, **kwargs):
+        """Returns a CiviCRM object making calls to this server."""
+        from .pythoncivicrm import CiviCRM
+        return CiviCRM(self.url, self.fake.site_key, self.fake.api_key,
+                       use_ssl=False, **kwargs)
+
+    def start(self):
+        # a short poll interval so stop() doesn't keep us waiting
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        args=(0.05,))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        if self._thread is not None:
+            self._server.shutdown()
+            self._thread.join()
+            self._thread = None
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
@@ -0,0 +1,113 @@
+"""
+.. module::jsonstream
+:synopis:Incremental decoding of CiviCRM API responses.
+
+The CiviCRM API returns a JSON object with the results in values. ValuesStream
+reads such an object from an iterable of chunks (e.g. a streamed response's
+iter_content()) and yields the items in values as soon as each one has been
+read, so only one item (and one chunk) needs to be in memory at a time.
+The other top level keys (is_error, count etc.) are collected in header.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import codecs
+import json
+import re
+
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+
+class ValuesStream(object):
+    """Iterate over it to get the items in values. If values is an object
+    (i.e. the results are not sequential) its values are yielded.
+    Once iteration is complete header holds all the other top level keys.
+    A ValueError is raised if the response is not valid JSON.
+    """
+
+    def __init__(self, chunks, encoding='utf-8'):
+        self.chunks = iter(chunks)
+        self.header = {}
+        self._decoder = json.JSONDecoder()
+        self._text = codecs.getincrementaldecoder(encoding)()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _more(self):
+        """Read another chunk into the buffer, dropping what has been
+        consumed already. Returns False at the end of the input."""
+        if self._eof:
+            return False
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        try:
+            chunk = next(self.chunks)
+        except StopIteration:
+            self._eof = True
+            self._buf += self._text.decode(b'', final=True)
+            return False
+        self._buf += self._text.decode(chunk)
+        return True
+
+    def _peek(self):
+        """Returns the next non whitespace character, without consuming it."""
+        while True:
+            self._pos = WHITESPACE.match(self._buf, self._pos).end()
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._more():
+                raise ValueError('Unexpected end of JSON response')
+
+    def _expect(self, chars):
+        char = self._peek()
+        if char not in chars:
+            raise ValueError('Expected %s at %s, found %s'
+                             % (chars, self._pos, char))
+        self._pos += 1
+        return char
+
+    def _value(self):
+        """Decode and return the next complete JSON value."""
+        self._peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if not self._more():
+                    raise
+                continue
+            # a number at the end of the buffer may be incomplete
+            if end == len(self._buf) and self._more():
+                continue
+            self._pos = end
+            return value
+
+    def _items(self, close):
+        """Yield the items of the array or object just opened."""
+        if self._peek() == close:
+            self._pos += 1
+            return
+        while True:
+            if close == '}':
+                self._value()
+                self._expect(':')
+            yield self._value()
+            if self._expect(',' + close) == close:
+                return
+
+    def __iter__(self):
+        self._expect('{')
+        if self._peek() == '}':
+            return
+        while True:
+            key = self._value()
+            self._expect(':')
+            if key == 'values' and self._peek() in '[{':
+                close = ']' if self._expect('[{') == '[' else '}'
+                for item in self._items(close):
+                    yield item
+            else:
+                self.header[key] = self._value()
+            if self._expect(',}') == '}':
+                return
@@ -0,0 +1,195 @@
+"""
+.. module::metrics
+:synopis:Counters and latency histograms for API calls.
+
+A MetricsRegistry records, for each entity and action, the number of calls
+and errors, how long they took (as a histogram), the bytes sent and received
+and the number of rows returned. snapshot() returns a copy of the figures as
+nested dictionaries, prometheus() the same in the Prometheus text format.
+A registry can be shared by several CiviCRM objects::
+
+    registry = MetricsRegistry()
+    civicrm = CiviCRM(url, site_key, api_key, metrics=registry)
+    ...
+    registry.snapshot()['Contact']['get']['calls']
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import bisect
+import threading
+import time
+
+# upper bounds in seconds, as the Prometheus client libraries use
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class MetricsRegistry(object):
+    """
+    .. class::MetricsRegistry(self, buckets=BUCKETS)
+    Thread safe store of call metrics. buckets are the upper bounds (in
+    seconds) of the latency histogram, a final unbounded bucket is added.
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def _entry(self, entity, action):
+        """The figures for entity and action, call holding _lock."""
+        entry = self._stats.get((entity, action))
+        if entry is None:
+            entry = self._stats[(entity, action)] = {
+                'calls': 0,
+                'errors': 0,
+                'seconds': 0.0,
+                'request_bytes': 0,
+                'response_bytes': 0,
+                'rows': 0,
+                'buckets': [0] * (len(self.buckets) + 1),
+            }
+        return entry
+
+    def timer(self, entity, action):
+        """Returns a context manager that records a call taking as long as
+        the with block. Set its result attribute to what the call returned
+        to count rows. The call counts as an error if an exception is
+        raised."""
+        return _Timer(self, entity, action)
+
+    def observe(self, entity, action, seconds, rows=0, error=False):
+        """Record a call that took seconds and returned rows."""
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            entry = self._entry(entity, action)
+            entry['calls'] += 1
+            entry['seconds'] += seconds
+            entry['buckets'][index] += 1
+            entry['rows'] += rows
+            if error:
+                entry['errors'] += 1
+
+    def transferred(self, entity, action, sent=0, received=0):
+        """Record the bytes sent and received by a request."""
+        with self._lock:
+            entry = self._entry(entity, action)
+            entry['request_bytes'] += sent
+            entry['response_bytes'] += received
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def snapshot(self):
+        """Returns {entity: {action: figures}}, where figures is a dictionary
+        of calls, errors, seconds (in total), request_bytes, response_bytes,
+        rows and buckets, a list of (upper bound, calls) with cumulative
+        counts, the last bound being None (no limit).
+        """
+        with self._lock:
+            stats = [(key, dict(entry, buckets=list(entry['buckets'])))
+                     for key, entry in self._stats.items()]
+        snapshot = {}
+        bounds = self.buckets + (None,)
+        for (entity, action), entry in stats:
+            total = 0
+            cumulative = []
+            for bound, count in zip(bounds, entry['buckets']):
+                total += count
+                cumulative.append((bound, total))
+            entry['buckets'] = cumulative
+            snapshot.setdefault(entity, {})[action] = entry
+        return snapshot
+
+    def prometheus(self, prefix='civicrm'):
+        """Returns the metrics in the Prometheus text exposition format."""
+        counters = [
+            ('requests_total', 'calls', 'API calls made.'),
+            ('errors_total', 'errors', 'API calls that failed.'),
+            ('request_bytes_total', 'request_bytes', 'Bytes sent.'),
+            ('response_bytes_total', 'response_bytes', 'Bytes received.'),
+            ('rows_total', 'rows', 'Rows returned.'),
+        ]
+        snapshot = sorted(
+            (entity, action, figures)
+            for entity, actions in self.snapshot().items()
+            for action, figures in actions.items()
+        )
+        lines = []
+        for name, field, help_text in counters:
+            name = '%s_%s' % (prefix, name)
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s counter' % name)
+            for entity, action, figures in snapshot:
+                lines.append('%s{%s} %s' % (
+                    name, _labels(entity, action), figures[field]))
+        name = '%s_request_seconds' % prefix
+        lines.append('# HELP %s Time taken by API calls.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        for entity, action, figures in snapshot:
+            labels = _labels(entity, action)
+            for bound, count in figures['buckets']:
+                le = '+Inf' if bound is None else repr(float(bound))
+                lines.append('%s_bucket{%s,le="%s"} %s' % (
+                    name, labels, le, count))
+            lines.append('%s_sum{%s} %r' % (name, labels, figures['seconds']))
+            lines.append('%s_count{%s} %s' % (name, labels, figures['calls']))
+        return '\n'.join(lines) + '\n'
+
+
+class _Timer(object):
+    """Context manager returned by MetricsRegistry.timer."""
+
+    def __init__(self, registry, entity, action):
+        self.registry = registry
+        self.entity = entity
+        self.action = action
+        self.result = None
+        # set instead of result for rows that weren't kept, e.g. streamed
+        self.rows = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.rows is not None:
+            rows = self.rows
+        elif isinstance(self.result, list):
+            rows = len(self.result)
+        else:
+            # a single record, value or count
+            rows = 0 if self.result is None else 1
+        self.registry.observe(self.entity, self.action,
+                              time.time() - self.started, rows,
+                              exc_type is not None)
+
+
+class NullTimer(object):
+    """Stands in for a _Timer when metrics aren't being kept.
+    A single instance can be shared as it doesn't keep result."""
+
+    @property
+    def result(self):
+        return None
+
+    @result.setter
+    def result(self, value):
+        pass
+
+    rows = result
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def _labels(entity, action):
+    return 'entity="%s",action="%s"' % (_escape(entity), _escape(action))
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,69 @@
+"""
+.. module::options
+:synopis:Lookup tables for option values.
+
+An OptionIndex is built once from the dictionary returned by getoptions
+(id: label) and resolves ids, labels, and labels differing only in case or
+spacing to the corresponding id with a dictionary lookup.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+# marks a normalised label shared by options with different ids
+AMBIGUOUS = object()
+
+
+def normalise(label):
+    """Returns label case folded, with runs of whitespace
+    replaced by a single space and leading/trailing whitespace removed."""
+    try:
+        folded = label.casefold()
+    except AttributeError:
+        # Python 2
+        folded = label.lower()
+    return ' '.join(folded.split())
+
+
+class OptionIndex(object):
+    """
+    .. class::OptionIndex(self, options)
+    options is a dictionary of id: label, as returned by getoptions.
+    labels maps id to label, ids label to id and normalised
+    normalised label to id.
+    """
+
+    def __init__(self, options):
+        self.labels = dict(options)
+        self.ids = {}
+        self.normalised = {}
+        for option_id, label in self.labels.items():
+            self.ids.setdefault(label, option_id)
+            key = normalise(label)
+            if self.normalised.get(key, option_id) != option_id:
+                self.normalised[key] = AMBIGUOUS
+            else:
+                self.normalised[key] = option_id
+
+    def __len__(self):
+        return len(self.labels)
+
+    def resolve(self, value):
+        """Returns the id for value, which can be an id (int) or label.
+        An int is returned unchanged if valid, labels are matched exactly
+        first, then ignoring case and spacing.
+        Raises KeyError if value does not match a single option.
+        """
+        if type(value) is int:
+            if str(value) in self.labels:
+                return value
+            raise KeyError(value)
+        if value in self.ids:
+            return self.ids[value]
+        try:
+            option_id = self.normalised.get(normalise(value), AMBIGUOUS)
+        except AttributeError:
+            # not a string
+            raise KeyError(value)
+        if option_id is AMBIGUOUS:
+            raise KeyError(value)
+        return option_id
@@ -0,0 +1,442 @@
+"""
+.. module::parallel
+:synopis:Run API calls concurrently.
+
+run_parallel calls a function for each item of an iterable using a pool of
+worker threads. Items are read lazily, so the iterable can be a generator
+over more records than would fit in memory.
+
+SingleFlight makes concurrent identical calls share a single execution.
+
+AdaptiveLimiter caps the number of calls in progress at once, raising the cap
+while calls succeed promptly and cutting it when they fail or slow down
+(additive increase, multiplicative decrease, as TCP does), so a bulk job
+finds the highest concurrency the server can sustain.
+
+Hedger repeats a call that is taking longer than most recent calls did,
+using whichever answer arrives first, to cut the time taken by the slowest
+calls. Only use it for calls that are safe to repeat.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import re
+import sys
+import threading
+import time
+from collections import deque
+
+try:
+    import queue
+except ImportError:
+    # Python 2
+    import Queue as queue
+
+# put on the task queue to tell a worker to stop
+_STOP = object()
+
+
+def run_parallel(func, items, concurrency=4, read_ahead=None):
+    """Generator calling func(item) for each item in items using concurrency
+    threads. Yields (index, item, result, error) tuples as calls complete,
+    so not in order, where index is the position of item in items and error
+    is the exception raised by func (result is then None) or None.
+    Up to read_ahead items (default twice concurrency) are read from items
+    before a worker is free to take them.
+    An exception raised while iterating over items is re-raised.
+    Closing the generator (or dropping it) stops items being read and
+    calls that haven't started being made.
+    """
+    tasks = queue.Queue(maxsize=read_ahead or concurrency * 2)
+    done = queue.Queue()
+    feed_error = []
+    stop = threading.Event()
+
+    def feed():
+        try:
+            iterator = iter(items)
+            index = 0
+            # checked before each item is read, so none are lost
+            while not stop.is_set():
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    break
+                tasks.put((index, item))
+                index += 1
+        except Exception:
+            feed_error.append(sys.exc_info()[1])
+        finally:
+            for _ in range(concurrency):
+                tasks.put(_STOP)
+
+    def work():
+        while True:
+            task = tasks.get()
+            if task is _STOP:
+                done.put(_STOP)
+                return
+            if stop.is_set():
+                # keep taking tasks, so the feeder isn't left waiting
+                continue
+            index, item = task
+            try:
+                done.put((index, item, func(item), None))
+            except Exception as error:
+                done.put((index, item, None, error))
+
+    threads = [threading.Thread(target=feed)]
+    threads.extend(threading.Thread(target=work) for _ in range(concurrency))
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    running = concurrency
+    try:
+        while running:
+            outcome = done.get()
+            if outcome is _STOP:
+                running -= 1
+            else:
+                yield outcome
+    finally:
+        stop.set()
+    if feed_error:
+        raise feed_error[0]
+
+
+class SingleFlight(object):
+    """
+    .. class::SingleFlight(self)
+    do(key, func) calls func, unless a call with the same key is already
+    running in another thread, in which case it waits for that to finish
+    and returns its result (or raises its exception) instead.
+    The result object is shared by all the callers.
+    shared counts the calls that didn't need to run func.
+    """
+
+    def __init__(self):
+        self.shared = 0
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.shared += 1
+        if leader:
+            try:
+                call.result = func()
+            except Exception as error:
+                call.error = error
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+        else:
+            call.done.wait()
+        if call.error is not None:
+            raise call.error
+        return call.result
+
+
+class _Call(object):
+    """A call in progress, for SingleFlight."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+# errors suggesting the server (or its database) is struggling
+_OVERLOAD_TYPES = re.compile(r'Timeout|Connection|Protocol')
+_OVERLOAD_MESSAGES = re.compile(
+    r'failed with status code|deadlock|lock wait timeout|'
+    r'try restarting transaction|too many connections|timed out',
+    re.IGNORECASE
+)
+
+
+def is_overload(error):
+    """True if error is a sign of overload rather than a problem with the
+    call itself: a non-200 response, a timeout or connection error, or a
+    deadlock or lock wait timeout reported by the API."""
+    if isinstance(error, EnvironmentError):
+        # sockets, and requests' exceptions
+        return True
+    names = ' '.join(cls.__name__ for cls in type(error).__mro__)
+    return bool(_OVERLOAD_TYPES.search(names)
+                or _OVERLOAD_MESSAGES.search('%s' % error))
+
+
+class AdaptiveLimiter(object):
+    """
+    .. class::AdaptiveLimiter(
+                    self, initial=2, minimum=1, maximum=32, backoff=0.5,
+                    tolerance=3.0, is_overload=is_overload
+                    )
+    call(func, *args, **kwargs) waits until fewer than limit calls are in
+    progress then calls func. limit rises by one for every limit calls that
+    succeed, and is multiplied by backoff when a call raises an exception
+    that is_overload says is a sign of overload, or takes more than
+    tolerance times the average time (and longer than min_slow seconds, so
+    jitter in very quick calls is ignored). Other errors, e.g. a row
+    missing a mandatory field, leave the limit alone.
+    Only one cut is made for the calls started before a cut, so a burst of
+    failures from the same overload doesn't drop the limit to minimum.
+    """
+    min_slow = 0.05
+
+    def __init__(self, initial=2, minimum=1, maximum=32, backoff=0.5,
+                 tolerance=3.0, is_overload=is_overload):
+        self.is_overload = is_overload
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self.in_flight = 0
+        # moving average of the time successful calls take
+        self.latency = None
+        self.decreases = 0
+        self._condition = threading.Condition()
+
+    def cap(self, maximum):
+        """Sets maximum, lowering limit to it if need be, e.g. to the
+        number of threads making calls, so a cut is never spent on
+        a limit that isn't reached."""
+        with self._condition:
+            self.maximum = maximum
+            self.limit = min(self.limit, float(maximum))
+
+    def call(self, func, *args, **kwargs):
+        generation = self._acquire()
+        started = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as error:
+            if self.is_overload(error):
+                self._release(generation, time.time() - started, True)
+            else:
+                self._release(generation, None, False)
+            raise
+        self._release(generation, time.time() - started, False)
+        return result
+
+    def _acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+            return self.decreases
+
+    def _release(self, generation, latency, failed):
+        with self._condition:
+            self.in_flight -= 1
+            if latency is None:
+                # failed for reasons of its own, which says nothing
+                self._condition.notify_all()
+                return
+            slow = False
+            if not failed:
+                if self.latency is None:
+                    self.latency = latency
+                slow = latency > max(self.tolerance * self.latency,
+                                     self.min_slow)
+                self.latency += 0.2 * (latency - self.latency)
+            if failed or slow:
+                if generation == self.decreases:
+                    self.limit = max(self.minimum, self.limit * self.backoff)
+                    self.decreases += 1
+            else:
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self._condition.notify_all()
+
+    def __repr__(self):
+        return '<AdaptiveLimiter limit %s, %s in flight>' % (
+            int(self.limit), self.in_flight
+        )
+
+
+class Hedger(object):
+    """
+    .. class::Hedger(self, percentile=95, window=200, min_samples=20)
+    call(func) calls func in a worker thread. If it hasn't returned after
+    the percentile-th percentile of the times taken by the last window
+    calls, func is called again in a second thread and whichever returns
+    first is used. An exception is only raised if both fail.
+    Nothing is repeated until min_samples calls have been timed.
+    calls and hedged count the calls made and the calls repeated.
+    """
+
+    def __init__(self, percentile=95, window=200, min_samples=20):
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.calls = 0
+        self.hedged = 0
+        self._times = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def delay(self):
+        """Seconds to wait before repeating a call, None if there
+        are too few timings to tell yet."""
+        with self._lock:
+            if len(self._times) < self.min_samples:
+                return None
+            times = sorted(self._times)
+        index = int(len(times) * self.percentile / 100.0)
+        return times[min(index, len(times) - 1)]
+
+    def _timed(self, func):
+        started = time.time()
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self._times.append(time.time() - started)
+
+    def call(self, func):
+        with self._lock:
+            self.calls += 1
+        delay = self.delay()
+        if delay is None:
+            return self._timed(func)
+        done = queue.Queue()
+
+        def attempt():
+            try:
+                done.put((self._timed(func), None))
+            except Exception as error:
+                done.put((None, error))
+
+        _start(attempt)
+        try:
+            outcome = done.get(timeout=delay)
+            pending = 0
+        except queue.Empty:
+            with self._lock:
+                self.hedged += 1
+            _start(attempt)
+            outcome = done.get()
+            pending = 1
+        if outcome[1] is not None and pending:
+            # the other one may yet succeed
+            second = done.get()
+            if second[1] is None:
+                outcome = second
+        if outcome[1] is not None:
+            raise outcome[1]
+        return outcome[0]
+
+    def stats(self):
+        """Returns a dictionary of calls, hedged, and the current delay."""
+        return {
+            'calls': self.calls,
+            'hedged': self.hedged,
+            'delay': self.delay(),
+        }
+
+
+class _Workers(object):
+    """
+    .. class::_Workers(self, idle=30)
+    Daemon threads running the targets passed to start, each kept for idle
+    seconds after its last target so that later ones reuse it rather than
+    starting a thread each time.
+    """
+
+    def __init__(self, idle=30):
+        self.idle = idle
+        self._tasks = queue.Queue()
+        # threads waiting for a target
+        self._waiting = 0
+        self._lock = threading.Lock()
+
+    def start(self, target):
+        with self._lock:
+            self._tasks.put(target)
+            if self._waiting:
+                self._waiting -= 1
+                return
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                target = self._tasks.get(timeout=self.idle)
+            except queue.Empty:
+                with self._lock:
+                    # unless a target was put just now for a waiting thread
+                    if self._waiting and self._tasks.empty():
+                        self._waiting -= 1
+                        return
+                continue
+            try:
+                target()
+            except Exception:
+                pass
+            with self._lock:
+                self._waiting += 1
+
+
+_workers = _Workers()
+
+
+def _start(target):
+    """Runs target in a worker thread, which is left to finish in
+    the background if its result is no longer needed."""
+    _workers.start(target)
+
+
+class BulkResult(object):
+    """
+    .. class::BulkResult(self)
+    Outcome of a bulk operation. results holds what was returned for
+    each row, in the order the rows were supplied (None for failed rows),
+    errors a list of (index, row, exception) for rows that failed.
+    """
+
+    def __init__(self):
+        self.results = []
+        self.errors = []
+        # rows finish out of order, so results may have gaps
+        self.processed = 0
+        self.started = time.time()
+        self.finished = None
+
+    @property
+    def succeeded(self):
+        return self.processed - len(self.errors)
+
+    @property
+    def failed(self):
+        return len(self.errors)
+
+    @property
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    @property
+    def rate(self):
+        """Rows processed per second."""
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed else 0.0
+
+    def add(self, index, row, result, error):
+        if index >= len(self.results):
+            self.results.extend([None] * (index + 1 - len(self.results)))
+        self.results[index] = result
+        self.processed += 1
+        if error is not None:
+            self.errors.append((index, row, error))
+
+    def __repr__(self):
+        return '<BulkResult %s succeeded, %s failed, %.1f rows/s>' % (
+            self.succeeded, self.failed, self.rate
+        )
@@ -0,0 +1,111 @@
+"""
+.. module::prepared
+:synopis:Requests prepared once and made many times.
+
+CiviCRM.prepare(entity, action, **fixed) returns a PreparedCall. The payload
+for the fixed parameters is built, checked and URL encoded once, so calling
+it only has to add and encode the parameters that vary::
+
+    find = civicrm.prepare('Contact', 'get',
+                           **{'return': 'id,display_name'})
+    for email in emails:
+        contacts = find(email=email)
+
+Actions starting with get are sent as reads (using GET, with any caching,
+coalescing and hedging configured, and as records if the client returns
+them), others as writes using POST.
+The results are those of _get or doaction, so get's related and create's
+checks on chained calls are not applied.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+from .records import to_records
+from .transport import EncodedPayload, query_string
+
+try:
+    string_types = basestring
+except NameError:
+    # Python 3
+    string_types = str
+
+
+class PreparedCall(object):
+    """
+    .. class::PreparedCall(self, client, entity, action, **fixed)
+    A request to client for action on entity with the fixed parameters,
+    made by calling it with any others as keyword arguments.
+    Raises CivicrmError if a fixed parameter is one set by the client
+    (site_key, api_key, entity, action or json).
+    """
+
+    def __init__(self, client, entity, action, **fixed):
+        # imported here as pythoncivicrm imports this module
+        from .pythoncivicrm import CivicrmError, GET_NOT_PARAMS, NOT_PARAMS
+        if not (isinstance(entity, string_types) and entity
+                and isinstance(action, string_types) and action):
+            raise CivicrmError('entity and action must be given')
+        self.client = client
+        self.entity = entity
+        self.action = action
+        self.read = action.startswith('get')
+        self.use = 'get' if self.read else 'post'
+        reserved = set(NOT_PARAMS).intersection(fixed)
+        if reserved:
+            raise CivicrmError('%s can not be set'
+                               % ', '.join(sorted(reserved)))
+        self.fixed = self._options(fixed)
+        payload = client._construct_payload(self.use, action, entity,
+                                            dict(self.fixed))
+        if payload.get('json', 1) != 1:
+            # parameters sent as JSON have to be encoded together
+            self.static = None
+            self.query = None
+        else:
+            self.static = payload
+            self.query = query_string(payload)
+        # names that can't be added to the static part as they are
+        self._clashes = frozenset(
+            GET_NOT_PARAMS if self.read else NOT_PARAMS).union(payload)
+
+    def _options(self, params):
+        """Converts limit and offset to options, as get does."""
+        if self.action != 'get' or not ('limit' in params
+                                         or 'offset' in params):
+            return params
+        params = dict(params)
+        limit = params.pop('limit', None)
+        offset = params.pop('offset', None)
+        return self.client._add_options(params, limit=limit, offset=offset)
+
+    def payload(self, **params):
+        """Returns the payload for a call with params."""
+        params = self._options(params)
+        if self.static is None or not self._clashes.isdisjoint(params) \
+                or self.client._needs_json(params):
+            merged = dict(self.fixed)
+            merged.update(params)
+            return self.client._construct_payload(self.use, self.action,
+                                                  self.entity, merged)
+        payload = EncodedPayload(self.static)
+        if params:
+            payload.update(params)
+            payload.query = '%s&%s' % (self.query, query_string(params))
+        else:
+            payload.query = self.query
+        return payload
+
+    def __call__(self, **params):
+        payload = self.payload(**params)
+        if self.read:
+            results = self.client._get_payload(payload)
+            if self.action == 'get' and self.client.records \
+                    and isinstance(results, list):
+                results = to_records(self.entity, results)
+            return results
+        merged = dict(self.fixed)
+        merged.update(params)
+        return self.client._post_payload(payload, merged)
+
+    def __repr__(self):
+        return '<PreparedCall %s.%s>' % (self.entity, self.action)
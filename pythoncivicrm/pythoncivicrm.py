@@ -47,6 +47,49 @@ expand it to key value pairs::
                 }
     civicrm.get('Contact', **my_dict)
 
+To work through large result sets without holding them all in memory use
+iter_get, which fetches page_size records at a time::
+
+    for contact in civicrm.iter_get('Contact', page_size=500):
+        print(contact['display_name'])
+
+Pass keyset=True to page by id instead of offset, which stays fast for deep
+pages, and after_id=<last id processed> to resume an interrupted scan.
+
+stream_get makes a single request but decodes the response as it is read,
+yielding each row as soon as it has been parsed, so memory use is bounded
+by the size of a row, not the whole response::
+
+    for contact in civicrm.stream_get('Contact', limit=0):
+        print(contact['display_name'])
+
+A contact and its emails, phones, addresses and group memberships can be
+created in a single request, using API chaining::
+
+    contact = civicrm.add_contact('Individual', display_name='Test Test',
+                                  emails=['test@example.org'],
+                                  phones=['111-111-1111'], groups=[5])
+    contact['emails'][0]['id']
+
+Other chained calls can be passed to create as api.<Entity>.<action> keys.
+
+To import many records use bulk_create, which takes any iterable of
+dictionaries and makes several requests at once. Errors are collected rather
+than raised::
+
+    result = civicrm.bulk_create('Email', rows, concurrency=8,
+                                 progress=lambda r: print(r))
+    for index, row, error in result.errors:
+        print(index, error)
+
+When the same call is made many times with only some parameters changing,
+prepare it once. The fixed part of the request is built and encoded then,
+so each call only encodes what changes::
+
+    find = civicrm.prepare('Contact', 'get', contact_type='Individual')
+    for email in emails:
+        contacts = find(email=email)
+
 The following optional values can be supplied when intializing:
     use_ssl=True/False      Connect over https not http, defaults to True.
     timeout=N               Connection will time out in N seconds, i.e if
@@ -55,6 +98,90 @@ The following optional values can be supplied when intializing:
                             the connection timesout.
                             Defaults to None, this means the connection will
                             hang until closed.
+    connect_timeout=N       Separate timeout for establishing the connection,
+                            timeout is then only used for reading the
+                            response. Defaults to None (use timeout for both).
+    session=Session         A requests.Session (or compatible) object to make
+                            calls with. By default one is created on first
+                            use and reused, so connections are kept alive.
+    pool_connections=N      Number of per-host connection pools to keep
+                            (default 10). Ignored if session is supplied.
+    pool_maxsize=N          Maximum number of connections kept in each pool
+                            (default 10). Ignored if session is supplied.
+    json_codec=codec        Name of the JSON library used to decode responses
+                            ('orjson', 'simdjson', 'ujson' or 'json') or a
+                            codec object (see jsoncodec). Defaults to orjson
+                            if installed, otherwise json.
+    metadata_ttl=N          Cache the results of getoptions and getfields
+                            for N seconds (default 300). 0 or None turns
+                            off caching.
+    metadata_cache_size=N   Maximum number of getoptions/getfields results
+                            to cache (default 256).
+    max_query_length=N      Approximate maximum length of the query string
+                            used for GET requests (default 4000). Longer
+                            reads are sent using POST instead, and get_many
+                            splits lookups into chunks below this.
+    json_params=True/False  Send API parameters as a single JSON object
+                            rather than form fields. Defaults to False, but
+                            this is done anyway for nested values such as
+                            id={'IN': [1, 2]} and chained calls.
+    coalesce=True/False     If True, a read (get, getsingle, getoptions etc.)
+                            made while an identical one is in progress in
+                            another thread waits for and shares its result
+                            rather than making another request. The result
+                            returned is the same object, so treat it as
+                            read only. Defaults to False.
+    result_cache=cache      Cache the responses to reads (get, getsingle,
+                            getvalue, getcount etc.) in cache, e.g.
+                            cache.LRUCache(1000, ttl=60) in memory or
+                            cache.DiskCache('/tmp/civicrm.db') on disk.
+                            Writes (create, update, setvalue, delete and
+                            doaction) drop the cached results for the entity
+                            they change. Defaults to None (no caching).
+    result_ttls=dict        Seconds to cache results for, by entity, e.g.
+                            {'Contact': 30, 'Country': None}, where None
+                            means for ever and 0 not at all. Other entities
+                            use the ttl of result_cache.
+    adaptive_concurrency=True/False
+                            If True, bulk_create and get_many adjust how
+                            many requests they make at once for each entity,
+                            backing off when requests fail from overload
+                            (error responses, timeouts, deadlocks, not
+                            invalid rows) or slow down and creeping back
+                            up while they succeed. Their concurrency
+                            argument is then the most requests made at once.
+                            Defaults to False.
+    hedge_percentile=N      Send a second, identical request for a read
+                            (get, getsingle, getvalue, getcount, getoptions
+                            or getfields) if no answer has arrived after the
+                            Nth percentile of recent response times (e.g.
+                            95), and use whichever answer comes first. This
+                            trims the slowest reads at the cost of about
+                            (100 - N)% more requests. Writes are never
+                            repeated. Defaults to None (off).
+    metrics=True/registry   Keep counts of calls, errors, rows and bytes sent
+                            and received and a histogram of response times
+                            for each entity and action, in a
+                            metrics.MetricsRegistry available as metrics
+                            (pass one to share it between objects). See
+                            metrics.snapshot() and metrics.prometheus().
+                            Defaults to None (off).
+    tracer=Tracer           A tracing.Tracer to record a span for each call
+                            of a public method, containing a span for each
+                            HTTP request made. Defaults to None (off).
+    transport=transport     How requests are sent: 'requests' (the default),
+                            'urllib3', which has less overhead per call, or
+                            a transport object (see transport), e.g.
+                            transport.InProcessTransport for testing.
+                            session and the pool sizes are only used by the
+                            default transport.
+    records=True/False      Return the rows from get, iter_get, stream_get
+                            and get_many as records.Record objects, which
+                            hold just the values, with the field names kept
+                            once per entity and set of fields, so use a
+                            fraction of the memory of dictionaries. They can
+                            be read by key or attribute, but not changed.
+                            Defaults to False.
 
 e.g.
     url = 'www.example.org/path/to/civi/codebase/civicrm/extern/rest.php'
@@ -64,6 +191,14 @@ e.g.
 
     Connections will timeout after 5 seconds, and raise an error.
 
+Connections are pooled and reused between calls. Call close() when you
+are finished, or use the object as a context manager::
+
+    with CiviCRM(url, site_key, api_key) as civicrm:
+        civicrm.get('Contact', city='Gotham City')
+
+A session supplied by the caller is never closed by close().
+
 .. _things-to-note:
 
 Things to note
@@ -101,6 +236,10 @@ being limited to this. When methods do this they don't use this method if a
 numeric id is supplied, so that id is not checked for validity (though a
 Civicrm Error will still be raised if its not) as it is assumed you know
 what you are doing in this case, and we can save an extra API call for speed.
+Options are fetched once per entity and field and kept in an index (see
+option_index), so later lookups don't hit the API until the metadata cache
+expires. Labels are also matched ignoring case and spacing. To convert a whole
+list of labels at once use resolve_options.
 
 * The  replace API call is undocumented, AFAIK, so not implemented, use
 getaction if you must.
@@ -108,25 +247,108 @@ getaction if you must.
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import hashlib
 import re
-import requests
-import json
+import threading
+import time
+
+from .cache import LRUCache, MISSING, fingerprint
+from .jsoncodec import get_codec
+from .jsonstream import ValuesStream
+from .metrics import MetricsRegistry, NullTimer
+from .options import OptionIndex
+from .tracing import NullSpan, traced
+from .transport import (
+    RequestsTransport, get_transport, query_length_bound, query_string
+)
+from .prepared import PreparedCall
+from .records import RecordBuilder, to_records
+from .parallel import (
+    AdaptiveLimiter, BulkResult, Hedger, SingleFlight, run_parallel
+)
+
+try:
+    string_types = basestring
+    text_type = unicode
+    from urllib import quote, urlencode
+except NameError:
+    # Python 3
+    string_types = str
+    text_type = str
+    from urllib.parse import quote, urlencode
+
+# used when metrics aren't kept
+_NULL_TIMER = NullTimer()
+# used when there is no tracer
+_NULL_SPAN = NullSpan()
+
+# parameters removed by _construct_payload
+NOT_PARAMS = ('site_key', 'api_key', 'entity', 'action', 'json')
+GET_NOT_PARAMS = NOT_PARAMS + ('body_html', 'body_text')
+
+# read only actions, so safe to send twice when hedging
+HEDGED_ACTIONS = frozenset([
+    'get', 'getsingle', 'getvalue', 'getcount', 'getoptions', 'getfields'
+])
 
 
 class CivicrmError(Exception):
     pass
 
 
-class CiviCRM:
+class _BackgroundCall(threading.Thread):
+    """Calls func(*args) in a daemon thread. result() waits for it
+    to finish and returns the result, or raises the exception raised by it.
+    """
+
+    def __init__(self, func, *args):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.func = func
+        self.args = args
+        self._result = None
+        self._error = None
+        self.start()
+
+    def run(self):
+        try:
+            self._result = self.func(*self.args)
+        except Exception as error:
+            self._error = error
+
+    def result(self):
+        self.join()
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class CiviCRM(object):
     """
     .. class::CiviCRM(
-                    self, url, site_key, api_key,[use_ssl=True], [timeout=None]
+                    self, url, site_key, api_key,[use_ssl=True], [timeout=None],
+                    [connect_timeout=None], [session=None],
+                    [pool_connections=10], [pool_maxsize=10],
+                    [json_codec=None], [metadata_ttl=300],
+                    [metadata_cache_size=256], [max_query_length=4000],
+                    [json_params=False], [coalesce=False],
+                    [result_cache=None], [result_ttls=None],
+                    [adaptive_concurrency=False], [hedge_percentile=None],
+                    [metrics=None], [tracer=None], [transport=None],
+                    [records=False]
                     )
     Make calls against the Civicrm API.
     """
 
-    def __init__(self, url, site_key, api_key, use_ssl=True, timeout=None):
-        """Set url,api keys, ssl usage, timeout"""
+    def __init__(self, url, site_key, api_key, use_ssl=True, timeout=None,
+                 connect_timeout=None, session=None, pool_connections=10,
+                 pool_maxsize=10, json_codec=None, metadata_ttl=300,
+                 metadata_cache_size=256, max_query_length=4000,
+                 json_params=False, coalesce=False, result_cache=None,
+                 result_ttls=None, adaptive_concurrency=False,
+                 hedge_percentile=None, metrics=None, tracer=None,
+                 transport=None, records=False):
+        """Set url,api keys, ssl usage, timeout, connection pooling"""
 
         # strip http(s):// off url
         regex = re.compile('^https?://')
@@ -138,25 +360,183 @@ class CiviCRM:
         self.site_key = site_key
         self.api_key = api_key
         self.use_ssl = use_ssl
-        self.timeout = timeout
+        if connect_timeout is not None:
+            # requests takes a (connect, read) tuple
+            self.timeout = (connect_timeout, timeout)
+        else:
+            self.timeout = timeout
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        if transport is None:
+            transport = RequestsTransport(session, pool_connections,
+                                          pool_maxsize)
+        elif isinstance(transport, string_types):
+            transport = get_transport(transport,
+                                      pool_connections=pool_connections,
+                                      pool_maxsize=pool_maxsize)
+        self.transport = transport
+        if json_codec is None or isinstance(json_codec, string_types):
+            json_codec = get_codec(json_codec)
+        self.json_codec = json_codec
+        self.max_query_length = max_query_length
+        self.json_params = json_params
+        self.coalescer = SingleFlight() if coalesce else None
+        self.result_cache = result_cache
+        self.result_ttls = result_ttls or {}
+        # bumped by invalidations, in all and per entity, so reads that
+        # started before one don't cache what they got
+        self._invalidations = 0
+        self._generations = {}
+        self._generations_lock = threading.Lock()
+        self.adaptive_concurrency = adaptive_concurrency
+        self._limiters = {}
+        self._limiters_lock = threading.Lock()
+        if hedge_percentile:
+            self.hedger = Hedger(hedge_percentile)
+        else:
+            self.hedger = None
+        if metrics is True:
+            metrics = MetricsRegistry()
+        self.metrics = metrics or None
+        self.tracer = tracer
+        self.records = records
+        if metadata_ttl:
+            self.metadata_cache = LRUCache(metadata_cache_size, metadata_ttl)
+        else:
+            self.metadata_cache = None
         if self.use_ssl:
             start = 'https://'
         else:
             start = 'http://'
         self.url = "%s%s/extern/rest.php" % (start, self.urlstring)
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    @property
+    def session(self):
+        """The requests.Session used for api calls, if using the default
+        transport. Created on first use, with a connection pool mounted for
+        http and https, and shared between threads.
+        """
+        return self.transport.session
+
+    def close(self):
+        """Close pooled connections. Sessions supplied by the caller
+        are left open. A new session is created if further calls are made.
+        """
+        self.transport.close()
+
     def _get(self, action, entity, parameters=None):
         """Internal method to make api calls using GET."""
 
         if not parameters:
             parameters = {}
         payload = self._construct_payload('get', action, entity, parameters)
-        api_call = requests.get(self.url, params=payload, timeout=self.timeout)
-        if api_call.status_code != 200:
-            raise CivicrmError('request to %s failed with status code %s'
-                               % (self.url, api_call.status_code))
-        results = json.loads(api_call.content)
-        return self._check_results(results)
+        return self._get_payload(payload)
+
+    def _get_payload(self, payload):
+        """Make a read request with a constructed payload and return
+        the checked results."""
+        with self._timer(payload['entity'], payload['action']) as timer:
+            if self.result_cache is not None:
+                read = self._cached_read
+            else:
+                read = self._read
+            if self.coalescer is not None:
+                # the response body is shared and each caller decodes its
+                # own copy, as get changes the results in place
+                own = []
+
+                def lead():
+                    content, results = read(payload)
+                    own.append(results)
+                    return content
+                content = self.coalescer.do(self._fingerprint(payload), lead)
+                if own:
+                    results = own[0]
+                else:
+                    results = self.json_codec.decode(content)
+            else:
+                content, results = read(payload)
+            timer.result = results = self._check_results(results)
+        return results
+
+    def _timer(self, entity, action):
+        """Returns a context manager timing a call, see metrics."""
+        if self.metrics is None:
+            return _NULL_TIMER
+        return self.metrics.timer(entity, action)
+
+    def _fingerprint(self, payload):
+        """Returns a key identifying payload, decoding JSON encoded
+        parameters so that their order makes no difference."""
+        params = payload.get('json')
+        if isinstance(params, string_types):
+            payload = dict(payload, json=self.json_codec.decode(params))
+        return fingerprint(payload)
+
+    def _read(self, payload):
+        """Send a read request and return the response body
+        and the decoded response."""
+        content = self._fetch(payload)
+        return content, self.json_codec.decode(content)
+
+    def _fetch(self, payload):
+        """Send a read request, using GET unless payload is too long,
+        and return the response body. The request is hedged if that is
+        turned on and the action only reads."""
+        method = self._get_method(payload)
+        if self.hedger is None or payload['action'] not in HEDGED_ACTIONS:
+            return self._request(method, payload).content
+        return self.hedger.call(self._bind(
+            lambda: self._request(method, payload).content
+        ))
+
+    def _cached_read(self, payload):
+        """Like _read, but using result_cache. The raw response is cached,
+        so each caller gets its own copy of the results. Errors are not
+        cached."""
+        content, store = self._cache_lookup(payload)
+        if content is not MISSING:
+            return content, self.json_codec.decode(content)
+        content, results = self._read(payload)
+        if store is not None:
+            store(content, results)
+        return content, results
+
+    def _cache_lookup(self, payload):
+        """Returns the cached response body for payload, or MISSING, and
+        a function to call with the body and decoded results once they have
+        been fetched, which caches them unless the API reported an error
+        or the entity's results were invalidated in the meantime (None if
+        there's nothing to store)."""
+        entity = payload['entity']
+        ttl = self.result_ttls.get(entity, MISSING)
+        if self.result_cache is None or ttl == 0:
+            return MISSING, None
+        # hashed, so keys aren't stored in the cache
+        digest = hashlib.sha1(
+            self._fingerprint(payload).encode('utf-8')).hexdigest()
+        key = (entity, digest)
+        content = self.result_cache.get(key)
+        if content is not MISSING:
+            return content, None
+        generation = self._generation(entity)
+
+        def store(content, results):
+            if not (isinstance(results, dict) and results.get('is_error')) \
+                    and self._generation(entity) == generation:
+                self.result_cache.set(key, content, ttl)
+        return MISSING, store
+
+    def _generation(self, entity):
+        """Returns a value that changes when cached results for entity
+        are invalidated."""
+        return self._invalidations, self._generations.get(entity, 0)
 
     def _post(self, action, entity, parameters=None):
         """Internal method to make api calls using POST."""
@@ -164,21 +544,136 @@ class CiviCRM:
         if not parameters:
             parameters = {}
         postdata = self._construct_payload('post', action, entity, parameters)
-        api_call = requests.post(
-            self.url, data=postdata, timeout=self.timeout
-        )
-        if api_call.status_code != 200:
-            raise CivicrmError('request to %s failed with status code %s'
-                               % (self.url, api_call.status_code))
-        results = json.loads(api_call.content)
+        return self._post_payload(postdata, parameters)
+
+    def _post_payload(self, postdata, parameters):
+        """Make a request with a constructed payload using POST and return
+        the checked results. parameters are those used to construct it."""
+        entity = postdata['entity']
+        with self._timer(entity, postdata['action']) as timer:
+            try:
+                api_call = self._request('post', postdata)
+            finally:
+                self._written(entity, parameters)
+            timer.result = results = self._post_results(entity,
+                                                        api_call.content)
+        return results
+
+    def _written(self, entity, parameters):
+        """Called after a write to entity with parameters, even if it
+        failed, as the change may have been made."""
+        if self.result_cache is not None:
+            self._invalidate_written(entity, parameters)
+
+    def _post_results(self, entity, content):
+        """Returns the results of a write to entity from the response
+        body, raising a CivicrmError if the API reported one."""
+        results = self.json_codec.decode(content)
         # Some entities return things in the values field
         # that don't conform to the normal use elsewhere
         # Here we check for this and just return straight results
         funny_values = ['GroupContact']
-        if entity in funny_values:
-            return results
+        if entity not in funny_values:
+            results = self._check_results(results)
+        return results
+
+    def _request(self, use, payload, stream=False):
+        """Send payload to the API using GET or POST, through transport.
+        If stream is True the response body is read as it is used.
+        Returns the response or raises a CivicrmError if the status
+        code is anything other than 200.
+        """
+        with self._span(use, payload) as span:
+            api_call = self.transport.request(use, self.url, payload,
+                                              self.timeout, stream)
+            span.set(status=api_call.status_code)
+            self._received(payload, api_call, stream)
+        return api_call
+
+    def _received(self, payload, api_call, stream=False):
+        """Records the response to payload in metrics and raises
+        a CivicrmError if its status code is anything other than 200."""
+        if self.metrics is not None:
+            if stream:
+                # not read yet
+                received = int(api_call.headers.get('Content-Length', 0))
+            else:
+                received = len(api_call.content)
+            self.metrics.transferred(
+                payload['entity'], payload['action'],
+                len(query_string(payload)), received
+            )
+        if api_call.status_code != 200:
+            raise CivicrmError('request to %s failed with status code %s'
+                               % (self.url, api_call.status_code))
+
+    def _span(self, use, payload):
+        """Returns a context manager for a span covering an HTTP request,
+        see tracing."""
+        if self.tracer is None:
+            return _NULL_SPAN
+        entity, action = payload['entity'], payload['action']
+        return self.tracer.span('%s %s.%s' % (use.upper(), entity, action),
+                                entity=entity, action=action, method=use)
+
+    def _bind(self, func):
+        """Returns func bound to the current span, for calling in another
+        thread, see tracing."""
+        if self.tracer is None:
+            return func
+        return self.tracer.bind(func)
+
+    def _get_method(self, payload):
+        """Returns 'get', or 'post' if payload would make the query string
+        longer than max_query_length (so the server would likely refuse it).
+        payload is only encoded to check if a cheap estimate says it might.
+        """
+        if query_length_bound(payload) <= self.max_query_length:
+            return 'get'
+        if len(query_string(payload)) > self.max_query_length:
+            return 'post'
+        return 'get'
+
+    def _stream(self, action, entity, parameters=None, chunk_size=65536):
+        """Internal method to make api calls using GET, decoding the response
+        as it arrives. A generator yielding the items in values.
+        """
+        if not parameters:
+            parameters = {}
+        payload = self._construct_payload('get', action, entity, parameters)
+        api_call = self._request(self._get_method(payload), payload,
+                                 stream=True)
+        try:
+            stream = ValuesStream(api_call.iter_content(chunk_size))
+            for row in stream:
+                yield row
+        finally:
+            api_call.close()
+        # raises a CivicrmError if the API reported one
+        self._check_results(stream.header)
+
+    def _observed(self, name, entity, action, rows):
+        """Generator yielding rows, a stream of results, timed as a call
+        to action on entity (see metrics) and traced as a span called name,
+        from the first row being asked for until the last is yielded.
+        Stopping early isn't counted as an error."""
+        if self.tracer is None:
+            span = _NULL_SPAN
         else:
-            return self._check_results(results)
+            span = self.tracer.span(name, entity=entity)
+        count = 0
+        try:
+            with span, self._timer(entity, action) as timer:
+                try:
+                    for row in rows:
+                        count += 1
+                        yield row
+                except GeneratorExit:
+                    pass
+                finally:
+                    timer.rows = count
+        finally:
+            rows.close()
 
     def _payload_template(self, action, entity):
         """Return the base payload items.
@@ -219,8 +714,12 @@ class CiviCRM:
 
     def _construct_payload(self, use, action, entity, parameters):
         """Takes action, entity, parameters returns payload suitable for a URL.
-        body_html and body_text parameters are removed as being very likely
-        to exceed the maximum URL length limits. Use POST instead.
+        body_html and body_text parameters are removed from GET requests as
+        being very likely to exceed the maximum URL length limits.
+        Use POST instead.
+        Parameters are sent JSON encoded in the json parameter if json_params
+        is set, or if they include nested values (e.g. {'IN': [1, 2]}) or
+        chained calls, which can't be sent as form fields.
 
         : use: Http method to use ['get, 'post', 'put', 'delete'] only get and
         post are used here.
@@ -233,18 +732,35 @@ class CiviCRM:
             in the request.
         """
         payload = self._payload_template(action, entity)
-        notparams = [
-            'site_key',
-            'api_key',
-            'entity',
-            'action',
-            'json',
-            'body_html',
-            'body_text'
-            ]
-        if use.lower() == 'post':
-            notparams.extend(['body_html', 'body_text'])
-        return self._filter_merge_payload(parameters, payload, notparams)
+        if use.lower() == 'get':
+            notparams = GET_NOT_PARAMS
+        else:
+            notparams = NOT_PARAMS
+        payload = self._filter_merge_payload(parameters, payload, notparams)
+        if self.json_params or self._needs_json(payload):
+            payload = self._json_payload(payload)
+        return payload
+
+    def _needs_json(self, payload):
+        """True if payload has values that can't be sent as form fields:
+        nested dictionaries, or chained calls, since PHP turns the dots in
+        field names into underscores."""
+        for key, value in payload.items():
+            if isinstance(value, dict) or key.startswith('api.'):
+                return True
+        return False
+
+    def _json_payload(self, payload):
+        """Moves everything but the keys, entity and action into the json
+        parameter as a JSON object. The REST interface decodes this and
+        merges it into the API parameters, preserving nested values.
+        """
+        outer = ['key', 'api_key', 'entity', 'action']
+        params = dict((key, value) for key, value in payload.items()
+                      if key not in outer and key != 'json')
+        payload = dict((key, payload[key]) for key in outer)
+        payload['json'] = self.json_codec.encode(params)
+        return payload
 
 
     def _add_options(self, params, **kwargs):
@@ -253,7 +769,7 @@ class CiviCRM:
         to extend the params dictionary.
         """
         for key, value in kwargs.items():
-            if value:
+            if value is not None:
                 option = "options[%s]" % key
                 params.update({option: value})
         return params
@@ -269,28 +785,54 @@ class CiviCRM:
         else:
             return results
 
+    @traced
     def is_valid_option(self, entity, field, value):
         """Takes a value which can be an id or its corresponding
         label, Returns the (corresponding) id if valid, otherwise
         raises a CivicrmError.
+        Labels are matched exactly, or failing that ignoring differences
+        in case and spacing.
         """
-        # keys are id's
+        index = self.option_index(entity, field)
         try:
-            options = self.getoptions(entity, field)
-        except CivicrmError:
-            raise CivicrmError("%s has no defined options for %s"
-                               % (entity, field))
-        # swap keys & values for lookup keys are labels
-        labels = dict((value, key) for key, value
-                      in options.items())
-        if type(value) is int and str(value) in options:
-            return value
-        elif value in labels:
-            return labels[value]
-        else:
+            return index.resolve(value)
+        except KeyError:
             raise CivicrmError("invalid option %s" % value)
-            # return(labels)
 
+    @traced
+    def option_index(self, entity, field):
+        """Returns an OptionIndex (see options) for the options of field,
+        built from getoptions. It is cached along with getoptions results.
+        Raises a CivicrmError if field has no options.
+        """
+        def build():
+            try:
+                options = self.getoptions(entity, field)
+            except CivicrmError:
+                raise CivicrmError("%s has no defined options for %s"
+                                   % (entity, field))
+            return OptionIndex(options)
+        return self._cached_metadata(('optionindex', entity, field), build)
+
+    @traced
+    def resolve_options(self, entity, field, values, strict=True):
+        """Takes a list of values, ids or labels as for is_valid_option,
+        and returns a list of the corresponding ids, making at most
+        one API call. If strict is True a CivicrmError is raised for
+        the first invalid value, otherwise None is returned in its place.
+        """
+        index = self.option_index(entity, field)
+        resolved = []
+        for value in values:
+            try:
+                resolved.append(index.resolve(value))
+            except KeyError:
+                if strict:
+                    raise CivicrmError("invalid option %s" % value)
+                resolved.append(None)
+        return resolved
+
+    @traced
     def get(self, entity, **kwargs):
         """Simple implementation of get action.
         Supply search terms in a dictionary called params
@@ -299,13 +841,208 @@ class CiviCRM:
         as key=value pairs (options as defined here:
         http://wiki.civicrm.org/confluence/display/CRMDOC/Using+the+API
         #UsingtheAPI-Parameters e.g. match, match mandatory.
-        Returns a list of dictionaries or an empty list.
+        Returns a list of dictionaries (records if records is set)
+        or an empty list.
+
+        related can be a list of entities, e.g. ['Email', 'Phone'], whose
+        records are fetched for all the results at once (with IN queries on
+        contact_id for contacts, or <entity>_id generally) and added to each
+        result as a list under the entity name, e.g. result['Email'].
+        To link on another field give an (entity, field) tuple instead.
         """
         limit = kwargs.pop('limit', None)
         offset = kwargs.pop('offset', None)
+        related = kwargs.pop('related', None)
         params = self._add_options(kwargs, limit=limit, offset=offset)
-        return self._get('get', entity, params)
+        results = self._get('get', entity, params)
+        if related:
+            self._add_related(entity, results, related)
+        if self.records and isinstance(results, list):
+            results = to_records(entity, results)
+        return results
+
+    def _add_related(self, entity, rows, related):
+        """Add the records of each related entity linked to each row,
+        as a list under the entity name. Raises a CivicrmError unless rows
+        is a list of dictionaries with ids."""
+        if not isinstance(rows, list) or not all(
+                isinstance(row, dict) and 'id' in row for row in rows):
+            raise CivicrmError('related needs a list of records with ids, '
+                               'check sequential and return')
+        ids = [row['id'] for row in rows]
+        if not ids:
+            return
+        default_field = '%s_id' % re.sub(
+            r'(?<!^)([A-Z])', r'_\1', entity).lower()
+        for spec in related:
+            if isinstance(spec, tuple):
+                related_entity, field = spec
+            else:
+                related_entity, field = spec, default_field
+            linked = {}
+            for record in self._get_in(related_entity, field, ids):
+                linked.setdefault(record[field], []).append(record)
+            for row in rows:
+                row[related_entity] = linked.get(row['id'], [])
+
+    def stream_get(self, entity, chunk_size=65536, **kwargs):
+        """Like get, but returns a generator that yields rows as they are
+        decoded from the response, which is read chunk_size bytes at a time.
+        Only the row being decoded needs to be held in memory, so use this
+        for big requests e.g. with limit=0 to get every record.
+        A CivicrmError reported by the API is raised once the response
+        has been read.
+        """
+        limit = kwargs.pop('limit', None)
+        offset = kwargs.pop('offset', None)
+        params = self._add_options(kwargs, limit=limit, offset=offset)
+        rows = self._observed('stream_get', entity, 'get',
+                              self._stream('get', entity, params, chunk_size))
+        if self.records:
+            build = RecordBuilder(entity)
+            return (build(row) for row in rows)
+        return rows
+
+    @traced
+    def get_many(self, entity, values, field='id', return_fields=None,
+                 chunk_size=500, concurrency=4, **kwargs):
+        """Look up the records whose field (id by default) is in values
+        using the IN operator. values are split into chunks of up to
+        chunk_size, made smaller if need be to keep the query string under
+        max_query_length, and up to concurrency chunks are fetched at once
+        (fewer if adaptive_concurrency is set and the server is struggling).
+        return_fields, if given, is a list of the fields to return (field is
+        always included). Other keyword arguments are added to each query.
+        Returns a dictionary keyed by value, containing the record found
+        for it. Values with no match are missing. If field isn't unique
+        only one of the records matching a value is returned.
+        """
+        lookup = dict((text_type(value), value) for value in values)
+        found = {}
+        for row in self._get_in(entity, field, lookup.values(),
+                                return_fields, chunk_size, concurrency,
+                                kwargs):
+            value = row.get(field)
+            found[lookup.get(value, value)] = row
+        return found
+
+    def _get_in(self, entity, field, values, return_fields=None,
+                chunk_size=500, concurrency=4, params=None):
+        """Returns a list of every record of entity with field in values,
+        fetched in chunks as described in get_many.
+        Raises the first error encountered.
+        """
+        params = dict(params or {})
+        if return_fields:
+            params['return'] = list(return_fields) + [field]
+
+        def fetch(chunk):
+            chunk_params = dict(params)
+            chunk_params[field] = {'IN': chunk}
+            return self._limited(entity, self.get, entity, limit=0,
+                                 **chunk_params)
+
+        # what's left of the query string once everything else is added
+        base = self._construct_payload(
+            'get', 'get', entity, dict(params, **{field: {'IN': []}})
+        )
+        space = self.max_query_length - len(urlencode(base, doseq=True)) - 20
+        rows = []
+        chunks = _sized_chunks(values, chunk_size, space,
+                               self.json_codec.encode)
+        if self.adaptive_concurrency:
+            self.concurrency_limiter(entity, concurrency)
+        results = run_parallel(self._bind(fetch), chunks, concurrency)
+        try:
+            for _, _, result, error in results:
+                if error is not None:
+                    raise error
+                rows.extend(result)
+        finally:
+            # don't fetch the rest after an error
+            results.close()
+        return rows
+
+    def iter_get(self, entity, page_size=100, prefetch=True, keyset=False,
+                 after_id=0, **kwargs):
+        """Like get, but returns a generator that yields rows one at a time,
+        fetching them page_size records at a time, so only a page or two of
+        results is held in memory however many records match.
+        While you process one page the next is fetched in the background,
+        set prefetch to False to turn this off.
+        offset sets where to start, limit the maximum number of rows
+        returned in total (by default all matching rows are returned).
+        Closing the generator early leaves at most one page request running.
+        related is passed on to get, so related records are fetched once
+        per page.
+
+        Set keyset to True to page by id rather than offset: rows are sorted
+        by id and each page asks for ids greater than the last one seen, so
+        deep pages cost no more than the first. To resume an interrupted
+        scan pass the id of the last row you processed as after_id.
+        offset is ignored in this mode.
+        """
+        offset = kwargs.pop('offset', None) or 0
+        limit = kwargs.pop('limit', None)
+        if keyset:
+            return self._iter_pages(
+                self._keyset_fetcher(entity, page_size, kwargs),
+                after_id, prefetch, limit
+            )
+
+        def fetch_page(start):
+            rows = self.get(entity, limit=page_size, offset=start,
+                            **dict(kwargs))
+            if len(rows) < page_size:
+                return rows, None
+            return rows, start + len(rows)
 
+        return self._iter_pages(fetch_page, offset, prefetch, limit)
+
+    def _keyset_fetcher(self, entity, page_size, params):
+        """Returns a fetch_page function for _iter_pages, that gets the page
+        of rows following (by id) the id passed as its state.
+        """
+        def fetch_page(last_id):
+            page_params = dict(params)
+            page_params.update({
+                'id': {'>': last_id},
+                'options[sort]': 'id ASC',
+            })
+            rows = self.get(entity, limit=page_size, **page_params)
+            if len(rows) < page_size:
+                return rows, None
+            return rows, int(rows[-1]['id'])
+        return fetch_page
+
+    def _iter_pages(self, fetch_page, state, prefetch=True, limit=None):
+        """Generator yielding rows from successive pages.
+        fetch_page(state) returns a page of rows and the state needed to
+        fetch the next page, or None if there are no more pages.
+        If prefetch is True the next page is fetched in a background thread
+        while the rows of the current page are yielded.
+        """
+        count = 0
+        fetch_page = self._bind(fetch_page)
+        pending = _BackgroundCall(fetch_page, state) if prefetch else None
+        while state is not None:
+            if pending is not None:
+                rows, state = pending.result()
+            else:
+                rows, state = fetch_page(state)
+            if limit:
+                rows = rows[:limit - count]
+                if count + len(rows) >= limit:
+                    state = None
+            if prefetch and state is not None:
+                pending = _BackgroundCall(fetch_page, state)
+            for row in rows:
+                yield row
+            count += len(rows)
+            # let the page be garbage collected before the next one arrives
+            rows = None
+
+    @traced
     def getsingle(self, entity, **kwargs):
         """Simple implementation of getsingle action.
         Returns a dictionary.
@@ -314,6 +1051,7 @@ class CiviCRM:
         # TODO OPTIONS?
         return self._get('getsingle', entity, kwargs)
 
+    @traced
     def getvalue(self, entity, returnfield, **kwargs):
         """Simple implementation of getvalue action.
         Will only return one field as unicodestring
@@ -324,13 +1062,103 @@ class CiviCRM:
         kwargs.update({'return': returnfield})
         return self._get('getvalue', entity, kwargs)
 
+    @traced
     def create(self, entity, **kwargs):
         """Simple implementation of create action.
         Returns a list of dictionaries of created entries.
+        Chained calls can be included as api.<Entity>.<action> keys, with
+        a dictionary of parameters, or a list of them for several calls,
+        e.g. **{'api.Email.create': [{'email': 'a@example.org'}]}
+        They are made by the server in the same request. The results
+        of each chained call replace its parameters in the created entries,
+        a CivicrmError is raised if any of them failed, with the created
+        entry as its created attribute.
         """
         # TODO OPTIONS?
-        return self._post('create', entity, kwargs)
-
+        chained = [key for key in kwargs if key.startswith('api.')]
+        results = self._post('create', entity, kwargs)
+        if chained and isinstance(results, list):
+            results = [self._check_chained(row) for row in results]
+        return results
+
+    def _check_chained(self, row):
+        """Replace the api.<Entity>.<action> results of chained calls in row
+        with their values, as _check_results, raising a CivicrmError
+        if any failed. The record itself has been created by then, so it is
+        given to the error as its created attribute, to clean up or retry
+        with."""
+        try:
+            for key in [k for k in row if k.startswith('api.')]:
+                if isinstance(row[key], list):
+                    row[key] = [self._check_results(result)
+                                for result in row[key]]
+                else:
+                    row[key] = self._check_results(row[key])
+        except CivicrmError as error:
+            error.created = row
+            raise
+        return row
+
+    @traced
+    def bulk_create(self, entity, rows, concurrency=4, chunk_size=100,
+                    progress=None):
+        """Create a record for each dictionary in rows, which can be any
+        iterable (e.g. a generator reading a file), using up to concurrency
+        requests at a time over the pooled connections.
+        The API has no multi-record create, so each row is still a request.
+        Rows are handed to the worker threads one at a time, reading up to
+        chunk_size rows ahead, and after every chunk_size rows progress, if
+        given, is called with the BulkResult so far (see its succeeded,
+        failed and rate attributes), and once more at the end.
+        A failing row doesn't stop the others. Returns a BulkResult, with the
+        created record (or None) for each row in results and a list of
+        (index, row, exception) in errors.
+        Set pool_maxsize to at least concurrency to reuse all connections.
+        With adaptive_concurrency set concurrency is the maximum, and fewer
+        requests are made at once if the server is struggling.
+        """
+        outcome = BulkResult()
+        if self.adaptive_concurrency:
+            # more than concurrency would never be in flight
+            self.concurrency_limiter(entity, concurrency)
+
+        def create_row(row):
+            result = self._limited(entity, self.create, entity, **row)
+            if isinstance(result, list) and len(result) == 1:
+                result = result[0]
+            return result
+
+        for index, row, created, error in run_parallel(
+                self._bind(create_row), rows, concurrency, chunk_size):
+            outcome.add(index, row, created, error)
+            if progress and outcome.processed % chunk_size == 0:
+                progress(outcome)
+        outcome.finished = time.time()
+        if progress and outcome.processed % chunk_size:
+            progress(outcome)
+        return outcome
+
+    def _limited(self, entity, method, *args, **kwargs):
+        """Call method, through the entity's AdaptiveLimiter if
+        adaptive_concurrency is set."""
+        if not self.adaptive_concurrency:
+            return method(*args, **kwargs)
+        return self.concurrency_limiter(entity).call(method, *args, **kwargs)
+
+    def concurrency_limiter(self, entity, maximum=None):
+        """Returns the AdaptiveLimiter used for entity by bulk_create and
+        get_many when adaptive_concurrency is set. Its limit attribute is
+        the number of requests currently allowed at once. If maximum is
+        given the limit is capped at it (see AdaptiveLimiter.cap)."""
+        with self._limiters_lock:
+            limiter = self._limiters.get(entity)
+            if limiter is None:
+                limiter = self._limiters[entity] = AdaptiveLimiter()
+        if maximum is not None:
+            limiter.cap(maximum)
+        return limiter
+
+    @traced
     def update(self, entity, db_id, **kwargs):
         """Update a record. An id must be supplied.
         Returns a list of dictionaries of updated  entries.
@@ -338,6 +1166,7 @@ class CiviCRM:
         # TODO OPTIONS?
         return self.create(entity, id=db_id, **kwargs)
 
+    @traced
     def setvalue(self, entity, db_id, field, value):
         """Updates a single field. This is not well documented, use at own risk.
         Takes an id and single field and value,
@@ -354,6 +1183,7 @@ class CiviCRM:
             }
         )
 
+    @traced
     def delete(self, entity, db_id, skip_undelete=False):
         """Delete a record. Set skip_undelete to True, to permanently
         delete a record for cases  where there is a 'recycle bin'
@@ -370,29 +1200,122 @@ class CiviCRM:
             params = {'id': db_id}
         return self._post('delete', entity, params)
 
+    @traced
     def getcount(self, entity, **kwargs):
         """Returns the number of qualifying records. Expects a dictionary.
         May not be accurate for values > 25. (will return 25).
         """
         return self._get('getcount', entity, kwargs)
 
+    @traced
     def getfields(self, entity):
         """Returns a dictionary of fields for entity, where
         keys (and key['name']) are names of field and the value
         is a dictionary describing that field.
+        Results are cached, see invalidate_metadata. The dictionary
+        returned is shared by later calls so should not be modified.
         """
-        return self._get('getfields', entity, parameters={'sequential': 0})
+        return self._cached_metadata(
+            ('getfields', entity),
+            lambda: self._get(
+                'getfields', entity, parameters={'sequential': 0}
+            )
+        )
 
+    @traced
     def getoptions(self, entity, field):
         """Returns a dictionary of options for fields
         as key/value pairs. Typically identical to each other.
         (though sometimes appear to be synonyms? e.g. 1: Yes)
         Raises CivicrmError if a field has no associated options
         or is not present etc.
+        Results are cached, see invalidate_metadata. The dictionary
+        returned is shared by later calls so should not be modified.
         """
         parameters = {'field': field, 'sequential': 0}
-        return self._get('getoptions', entity, parameters)
+        return self._cached_metadata(
+            ('getoptions', entity, field),
+            lambda: self._get('getoptions', entity, parameters)
+        )
 
+    def _cached_metadata(self, key, fetch):
+        """Returns the cached value for key, or calls fetch and caches
+        what it returns. Errors are not cached."""
+        if self.metadata_cache is None:
+            return fetch()
+        value = self.metadata_cache.get(key)
+        if value is MISSING:
+            value = fetch()
+            self.metadata_cache.set(key, value)
+        return value
+
+    def invalidate_metadata(self, entity=None, field=None):
+        """Drop cached getoptions/getfields results, for all entities,
+        a single entity, or a single field of an entity (options only).
+        Use after changing option values, e.g. adding an activity type.
+        """
+        if self.metadata_cache is None:
+            return
+        if entity is None:
+            self.metadata_cache.invalidate()
+        else:
+            self.metadata_cache.invalidate(
+                lambda key: key[1] == entity
+                and (field is None or key[2:] == (field,))
+            )
+
+    def _invalidate_written(self, entity, parameters):
+        """Drop cached results for entity and any entities written to by
+        chained calls in parameters (api.<Entity>.<action> keys)."""
+        entities = set([entity])
+        for key in parameters:
+            if key.startswith('api.') and key.count('.') == 2:
+                chained, action = key.split('.')[1:]
+                if not action.startswith('get'):
+                    entities.add(chained)
+        self.invalidate_results(*entities)
+
+    def invalidate_results(self, *entities):
+        """Drop cached results for the named entities, or all results
+        if none are given. Writes made by this object do this for you,
+        use it after changes made by other means.
+        """
+        if self.result_cache is None:
+            return
+        with self._generations_lock:
+            if not entities:
+                self._invalidations += 1
+            for entity in entities:
+                self._generations[entity] = \
+                    self._generations.get(entity, 0) + 1
+        if not entities:
+            self.result_cache.invalidate()
+        else:
+            self.result_cache.invalidate_groups(entities)
+
+    def result_cache_stats(self):
+        """Returns a dictionary with the number of result cache hits
+        and misses, and its current and maximum size."""
+        if self.result_cache is None:
+            return {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 0}
+        return self.result_cache.stats()
+
+    def hedge_stats(self):
+        """Returns a dictionary with the number of reads made and hedged,
+        and the current delay before a read is repeated (None until enough
+        reads have been timed)."""
+        if self.hedger is None:
+            return {'calls': 0, 'hedged': 0, 'delay': None}
+        return self.hedger.stats()
+
+    def metadata_cache_stats(self):
+        """Returns a dictionary with the number of metadata cache hits
+        and misses, and its current and maximum size."""
+        if self.metadata_cache is None:
+            return {'hits': 0, 'misses': 0, 'size': 0, 'maxsize': 0}
+        return self.metadata_cache.stats()
+
+    @traced
     def doaction(self, action, entity, **kwargs):
         """There are other actions for some entities, but
         these are undocumented?. This allows you to utilise
@@ -400,48 +1323,95 @@ class CiviCRM:
         """
         return self._post(action, entity, kwargs)
 
-    def add_contact(self, contact_type, **kwargs):
+    @traced
+    def prepare(self, entity, action, **kwargs):
+        """Returns a prepared.PreparedCall making action on entity with
+        kwargs, plus any parameters it is called with. Reads return what
+        _get would, other actions what doaction would. limit and offset
+        are accepted for get. Raises a CivicrmError if kwargs contain
+        site_key, api_key, entity, action or json.
+        """
+        return PreparedCall(self, entity, action, **kwargs)
+
+    @traced
+    def add_contact(self, contact_type, emails=None, phones=None,
+                    addresses=None, groups=None, **kwargs):
         """Creates a contact from supplied dictionary params.
         Raises a CivicrmError if a required field is not supplied:
         contact_type and/or one of  first_name, last_name,
         email, display_name. Returns a dictionary of the contact created.
+
+        emails, phones, addresses and groups can be lists of records to
+        create for the new contact in the same request, using API chaining.
+        Emails and phones can be given as strings or dictionaries (as for
+        add_email/add_phone), addresses as dictionaries (location_type can
+        be a label, as for add_address) and groups as group ids. The
+        records created are returned in the contact under the same keys,
+        e.g. contact['emails'] is a list of the emails created.
         """
         required = ['first_name', 'last_name', 'email', 'display_name']
         missing_fields = matches_required(required, kwargs)
         if missing_fields:
             raise CivicrmError('One of the following fields must exist:%s'
                                % ", ".join(missing_fields))
-        return self.create('Contact', contact_type=contact_type, **kwargs)[0]
+        chained = {}
+        for name, items, entity, field in [
+                ('emails', emails, 'Email', 'email'),
+                ('phones', phones, 'Phone', 'phone'),
+                ('addresses', addresses, 'Address', None),
+                ('groups', groups, 'GroupContact', 'group_id')]:
+            if items:
+                chained[name] = 'api.%s.create' % entity
+                kwargs[chained[name]] = [
+                    self._chained_params(entity, field, item)
+                    for item in items
+                ]
+        contact = self.create('Contact', contact_type=contact_type,
+                              **kwargs)[0]
+        for name, key in chained.items():
+            contact[name] = []
+            for result in contact.pop(key):
+                if isinstance(result, list):
+                    contact[name].extend(result)
+                else:
+                    contact[name].append(result)
+        return contact
+
+    def _chained_params(self, entity, field, item):
+        """Parameters for a chained create of entity from item,
+        which is a dictionary or the value of field."""
+        if isinstance(item, dict):
+            params = dict(item)
+        else:
+            params = {field: item}
+        location_type = params.pop('location_type', None)
+        if location_type is not None:
+            if type(location_type) is not int:
+                location_type = self.is_valid_option(
+                    entity, 'location_type_id', location_type
+                )
+            params['location_type_id'] = location_type
+        params.setdefault('sequential', 1)
+        return params
 
+    @traced
     def add_relationship(self, contact_a, contact_b, relationship, **kwargs):
         """Adds a relationship between contact_a and contact_b.
         Contacts must be supplied as id's (int).
         If the relationship is supplied as an int it is assumend to be an id,
         otherwise name_a_b, label_a_b, name_b_a, label_b_a  and description
-        are searched for a match.
+        are searched for a match (in that order), see
+        relationship_type_index.
         A CivicrmError is raised if no match is found.
         N.B. 'Alice', 'Bob', 'Employer of' means Bob is the employer of Alice.
         Non compulsory fields may be passed in a keyword pairs.
-        Searching for a match will hit the API and may do so multiple times,
-        you may find it beneficial to check the result for
-        'relationship_type_id' and cache this result.
         Returns a dictionary of the contact created.
         """
 
-        relationship_id = None
         if type(relationship) is int:
             relationship_id = relationship
         else:
-            for field in ['name_a_b', 'label_a_b',
-                          'name_b_a', 'label_b_a',
-                          'description']:
-                result = self.get(
-                    'RelationshipType',
-                    **{field: relationship, 'return': ['id']}
-                )
-                if result:
-                    relationship_id = result[0]['id']
-                    break
+            relationship_id = self.relationship_type_index().get(relationship)
         if not relationship_id:
             raise CivicrmError('invalid relationship %s' % relationship)
         kwargs.update({
@@ -451,6 +1421,37 @@ class CiviCRM:
         })
         return self.create('Relationship', **kwargs)[0]
 
+    @traced
+    def relationship_type_index(self, refresh=False):
+        """Returns a dictionary mapping the name_a_b, label_a_b, name_b_a,
+        label_b_a and description of every relationship type to its id.
+        Where values clash the earlier field in that list wins.
+        All relationship types are fetched with a single API call and the
+        result kept in the metadata cache, set refresh to True to reload
+        them, e.g. after adding a relationship type.
+        """
+        if refresh:
+            self.invalidate_metadata('RelationshipType')
+
+        def build():
+            fields = ['name_a_b', 'label_a_b', 'name_b_a', 'label_b_a',
+                      'description']
+            # a list would be sent as repeated form fields, of which
+            # PHP only keeps the last
+            types = self.get('RelationshipType', limit=0,
+                             **{'return': ','.join(['id'] + fields)})
+            index = {}
+            for field in fields:
+                for relationship_type in types:
+                    value = relationship_type.get(field)
+                    if value:
+                        index.setdefault(value, relationship_type['id'])
+            return index
+        return self._cached_metadata(
+            ('relationshiptypeindex', 'RelationshipType'), build
+        )
+
+    @traced
     def add_activity_type(self, label, weight=5, is_active=0, **kwargs):
         """Creates an Activity Type. Label is a string describing the activity
         spaces are allowed.  Weight is any postive or negative integer. It
@@ -464,8 +1465,11 @@ class CiviCRM:
             'weight': weight,
             'is_active': is_active
         })
-        return self.create('ActivityType', **kwargs)[0]
+        activity_type = self.create('ActivityType', **kwargs)[0]
+        self.invalidate_metadata('Activity', 'activity_type_id')
+        return activity_type
 
+    @traced
     def add_activity(self, activity_type, sourceid,
                      subject=None, date_time=None, activity_status=None,
                      activity_medium=None, priority=None, **kwargs):
@@ -507,6 +1511,7 @@ class CiviCRM:
         })
         return self.create('Activity', **kwargs)[0]
 
+    @traced
     def add_contribution(self, contact_id, total_amount,
                          financial_type, **kwargs):
         """Add a contribution of amount credited to contact_id.
@@ -528,6 +1533,7 @@ class CiviCRM:
         })
         return self.create('Contribution', **kwargs)[0]
 
+    @traced
     def add_email(self, contact_id, email, email_like=False, **kwargs):
         """Add an email to civicrm. If email_like is True it checks
         to see whether the supplied email looks something like a real email,
@@ -544,6 +1550,7 @@ class CiviCRM:
         return self.create('Email', contact_id=contact_id, email=email,
                            **kwargs)[0]
 
+    @traced
     def add_note(self, entity_id, note, **kwargs):
         """Add a note . Note if entity_table is not defined,
         it defaults to civicrm_contact. entity_table refers to the
@@ -553,10 +1560,12 @@ class CiviCRM:
         return self.create('Note', entity_id=entity_id, note=note,
                            **kwargs)[0]
 
+    @traced
     def add_tag(self, name, **kwargs):
         """Add a tag."""
         return self.create('Tag', name=name, **kwargs)[0]
 
+    @traced
     def add_entity_tag(self, entity_id, tag_id,
                        entity_table="civicrm_contact"):
         """Tag an entity_id (a contact id by default) by tag id.
@@ -568,11 +1577,13 @@ class CiviCRM:
         return self.create('EntityTag', entity_id=entity_id,
                            tag_id=tag_id, entity_table=entity_table)
 
+    @traced
     def add_group(self, title, **kwargs):
         """Add a group to CiviCRM."""
 
         return self.create('Group', title=title, **kwargs)[0]
 
+    @traced
     def add_group_contact(self, contact_id, group_id, **kwargs):
         """Add a link between a group and a contact. See entity_tag
         for a description of return values (and deleting).
@@ -583,6 +1594,7 @@ class CiviCRM:
             group_id=group_id
         )
 
+    @traced
     def add_phone(self, contact_id, phone, **kwargs):
         """Add a phone number to CiviCRM. phone_type is an int,
         is_primary defaults to 1(true). phone_numeric is phone number
@@ -591,6 +1603,7 @@ class CiviCRM:
         return self.create('Phone', contact_id=contact_id,
                            phone=phone, **kwargs)[0]
 
+    @traced
     def add_address(self, contact_id, location_type, **kwargs):
         """Add an address to civicrm. location_type can be supplied as
         numeric id or its equivalent value.
@@ -608,6 +1621,26 @@ class CiviCRM:
         return self.create('Address', **kwargs)[0]
 
 
+def _sized_chunks(values, size, max_length, encode):
+    """Generator yielding lists of up to size values, also limited so that
+    each list, JSON encoded by encode and quoted for use in a URL, is
+    about max_length or less.
+    """
+    chunk = []
+    length = 0
+    for value in values:
+        # allow for the separating ', '
+        value_length = 4 + len(quote(encode(value).encode('utf-8'), safe=''))
+        if chunk and (len(chunk) == size or length + value_length > max_length):
+            yield chunk
+            chunk = []
+            length = 0
+        chunk.append(value)
+        length += value_length
+    if chunk:
+        yield chunk
+
+
 def matches_required(required, params):
     """if none of the fields in the list required are in params,
     returns a list of missing fields, or None
@@ -0,0 +1,280 @@
+"""
+.. module::records
+:synopis:Compact, read only rows.
+
+A dictionary per row costs several hundred bytes before counting its values,
+which adds up when fetching hundreds of thousands of records. A Record holds
+just the values, in a tuple, while its class holds the field names, so there
+is one class per entity and set of fields (a shape) however many rows there
+are. Text values repeated in a field (e.g. contact_type) are shared by the
+records rather than each having a copy. Records can be used much as the
+dictionaries are, by key or attribute::
+
+    civicrm = CiviCRM(url, site_key, api_key, records=True)
+    for contact in civicrm.get('Contact', limit=0):
+        print(contact['display_name'], contact.email)
+
+They can't be changed. Use as_dict() for a dictionary, e.g. to modify a row
+or serialise it as JSON (json.dumps would treat a Record as a list).
+Fields missing from a row (CiviCRM leaves out empty ones) are missing from
+its Record too, though the shape includes them. Use key access for fields
+whose names aren't identifiers or clash with a method (e.g. count, index).
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import threading
+from operator import itemgetter
+
+try:
+    from collections.abc import Mapping
+    text_type = str
+except ImportError:
+    # Python 2
+    from collections import Mapping
+    text_type = unicode
+
+# fills the position of a field a row doesn't have
+_ABSENT = object()
+
+_classes = {}
+_lock = threading.Lock()
+
+
+class Record(tuple):
+    """
+    .. class::Record(self, values)
+    Base class of the record classes made by record_class, a tuple of the
+    values of fields (in the order given by _fields) which behaves as a read
+    only dictionary of them, with the values also available as attributes.
+    """
+    __slots__ = ()
+    entity = None
+    _fields = ()
+    # field name: position
+    _index = {}
+
+    def __getitem__(self, key):
+        try:
+            value = tuple.__getitem__(self, self._index[key])
+        except (KeyError, TypeError):
+            raise KeyError(key)
+        if value is _ABSENT:
+            raise KeyError(key)
+        return value
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return self.get(key, _ABSENT) is not _ABSENT
+
+    def keys(self):
+        return [field for field, value in
+                zip(self._fields, tuple.__iter__(self))
+                if value is not _ABSENT]
+
+    def values(self):
+        return [value for value in tuple.__iter__(self)
+                if value is not _ABSENT]
+
+    def items(self):
+        return [(field, value) for field, value in
+                zip(self._fields, tuple.__iter__(self))
+                if value is not _ABSENT]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def as_dict(self):
+        """Returns the record as a new dictionary."""
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            other = other.as_dict()
+        elif not isinstance(other, Mapping):
+            return NotImplemented
+        return self.as_dict() == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    # unhashable, like the dictionaries they replace
+    __hash__ = None
+
+    def __reduce__(self):
+        return _restore, (self.entity, self._fields, self.as_dict())
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % item for item in self.items()))
+
+
+Mapping.register(Record)
+
+
+def record_class(entity, fields):
+    """Returns the Record subclass for entity with fields (a sequence of
+    names), creating it the first time it is asked for."""
+    key = (entity, tuple(fields))
+    cls = _classes.get(key)
+    if cls is None:
+        with _lock:
+            cls = _classes.get(key)
+            if cls is None:
+                cls = _classes[key] = type(
+                    str('%sRecord' % entity), (Record,), {
+                        '__slots__': (),
+                        'entity': entity,
+                        '_fields': key[1],
+                        '_index': dict((field, position) for position, field
+                                       in enumerate(key[1])),
+                    }
+                )
+    return cls
+
+
+class RecordBuilder(object):
+    """
+    .. class::RecordBuilder(self, entity, fields=())
+    Turns dictionaries into records of entity, called with one at a time
+    (e.g. as rows are streamed). Rows with fields not seen before get a new
+    class, including all the fields seen so far, which later rows share.
+    Equal text values of a field (e.g. contact_type) are shared between the
+    records made, rather than each row having its own copy. Every SAMPLE
+    rows fields with more than one different value in two rows, or
+    SHARED_VALUES in all, are dropped from this as not worth it.
+    """
+    SAMPLE = 100
+    SHARED_VALUES = 1000
+
+    def __init__(self, entity, fields=()):
+        self.entity = entity
+        self.count = 0
+        # field: {value: value}, or None once it isn't shared
+        self._shared = {}
+        self._use(list(fields))
+
+    def _use(self, fields):
+        self.fields = fields
+        self._names = frozenset(fields)
+        self._class = record_class(self.entity, fields)
+        # fetches all the values at once, for rows with every field
+        self._getter = itemgetter(*fields) if len(fields) > 1 else None
+        for field in fields:
+            self._shared.setdefault(field, {})
+        self._columns = [(position, self._shared[field])
+                         for position, field in enumerate(fields)
+                         if self._shared[field] is not None]
+
+    def __call__(self, row):
+        if not self._names.issuperset(row):
+            self._use(self.fields + [key for key in row
+                                     if key not in self._names])
+        if self._getter is not None and len(row) == len(self.fields):
+            values = list(self._getter(row))
+        else:
+            values = [row.get(field, _ABSENT) for field in self.fields]
+        for position, shared in self._columns:
+            value = values[position]
+            if type(value) is text_type:
+                values[position] = shared.setdefault(value, value)
+        self.count += 1
+        if self._columns and self.count % self.SAMPLE == 0:
+            self._review()
+        return self._class(values)
+
+    def convert(self, rows, block=256):
+        """Converts rows, a list of dictionaries, to records in place and
+        returns it. This is done block rows at a time, working a column at
+        a time, so each block of dictionaries can be freed as soon as its
+        records have been made."""
+        for start in range(0, len(rows), block):
+            chunk = rows[start:start + block]
+            if not self._names.issuperset(set().union(*chunk)):
+                for row in chunk:
+                    if not self._names.issuperset(row):
+                        self._use(self.fields + [
+                            key for key in row if key not in self._names])
+            fields, getter = self.fields, self._getter
+            full = len(fields) if getter is not None else -1
+            values = [getter(row) if len(row) == full else
+                      tuple([row.get(field, _ABSENT) for field in fields])
+                      for row in chunk]
+            if self._columns:
+                values = self._share(values)
+            self.count += len(chunk)
+            rows[start:start + block] = map(self._class, values)
+            if self._columns:
+                self._review()
+        return rows
+
+    def _share(self, values):
+        """Returns values (a list of tuples, one per row) with the values
+        of shared fields replaced by the first equal value seen."""
+        columns = list(zip(*values))
+        if not self.count:
+            # look at a sample first, rather than sharing every value of
+            # fields that turn out to be mostly different
+            for position, shared in self._columns:
+                try:
+                    distinct = len(set(columns[position][:self.SAMPLE]))
+                except TypeError:
+                    distinct = self.SAMPLE
+                if distinct * 2 > min(len(values), self.SAMPLE):
+                    self._shared[self.fields[position]] = None
+            self._use(self.fields)
+        for position, shared in self._columns:
+            column = columns[position]
+            try:
+                columns[position] = list(map(shared.setdefault, column,
+                                             column))
+            except TypeError:
+                # lists or dictionaries, which can't be looked up
+                self._shared[self.fields[position]] = None
+        return zip(*columns)
+
+    def _review(self):
+        """Stops sharing the values of fields where they are mostly
+        different."""
+        for field in self.fields:
+            shared = self._shared[field]
+            if shared is not None and (len(shared) * 2 > self.count
+                                       or len(shared) >= self.SHARED_VALUES):
+                self._shared[field] = None
+        self._use(self.fields)
+
+
+def to_records(entity, rows):
+    """Converts rows, a list of dictionaries, to records of entity, all of
+    the same class, and returns it. The list is changed in place, so the
+    dictionaries can be freed as their records are made.
+    """
+    if not isinstance(rows, list):
+        rows = list(rows)
+    if not rows:
+        return rows
+    # the first row's fields in order, then any others
+    fields = list(rows[0])
+    fields.extend(sorted(set().union(*rows).difference(fields)))
+    return RecordBuilder(entity, fields).convert(rows)
+
+
+def _restore(entity, fields, values):
+    """Recreates a pickled record."""
+    return record_class(entity, fields)(
+        [values.get(field, _ABSENT) for field in fields])
@@ -0,0 +1,223 @@
+"""
+.. module::tracing
+:synopis:Spans recording where the time in API calls goes.
+
+A Tracer records a span for each call of a public CiviCRM method, with a
+child span for each HTTP request it makes (and spans for any other public
+methods it calls), so you can see, for example, that add_activity spent
+most of its time looking up options::
+
+    tracer = Tracer()
+    civicrm = CiviCRM(url, site_key, api_key, tracer=tracer)
+    civicrm.add_activity('Meeting', 202)
+    with open('trace.json', 'w') as f:
+        json.dump(tracer.chrome_trace(), f)
+
+Load trace.json in chrome://tracing or https://ui.perfetto.dev to see a
+timeline. Spans are nested per thread. Work handed to other threads (by
+bulk_create, get_many, iter_get's prefetching and hedging) is bound to the
+span it was handed off from, so its spans are children of that one, though
+shown on their own rows.
+
+Functions passed as before and after are called with each span as it
+starts and finishes, e.g. to pass them on to another tracing system.
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import functools
+import itertools
+import os
+import threading
+import time
+from collections import deque
+
+_ids = itertools.count(1)
+
+
+class Span(object):
+    """
+    .. class::Span(self, name, parent=None, **attrs)
+    A timed operation. attrs is a dictionary of details (entity, action,
+    status etc.), parent the enclosing Span or None. start and end are
+    times in seconds, error the exception that ended the span, if any.
+    """
+
+    def __init__(self, name, parent=None, **attrs):
+        self.name = name
+        self.parent = parent
+        self.attrs = attrs
+        self.span_id = next(_ids)
+        self.trace_id = parent.trace_id if parent else self.span_id
+        self.thread = threading.current_thread().ident
+        self.start = time.time()
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self):
+        return (self.end or time.time()) - self.start
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def __repr__(self):
+        return '<Span %s %.3fs>' % (self.name, self.duration)
+
+
+class Tracer(object):
+    """
+    .. class::Tracer(self, before=None, after=None, keep=10000)
+    Creates spans, nested per thread. The last keep finished spans are
+    kept in spans, set keep to 0 to keep none (if only using hooks).
+    """
+
+    def __init__(self, before=None, after=None, keep=10000):
+        self.before = [before] if before else []
+        self.after = [after] if after else []
+        self.spans = deque(maxlen=keep)
+        self._local = threading.local()
+
+    def current(self):
+        """Returns the innermost open span in this thread, or None."""
+        stack = getattr(self._local, 'stack', None)
+        return stack[-1] if stack else None
+
+    def span(self, name, **attrs):
+        """Returns a context manager opening a span within the current
+        one, yielding the Span."""
+        return _SpanContext(self, name, attrs)
+
+    def bind(self, func):
+        """Returns func wrapped so that, in whatever thread it is called,
+        spans it opens are children of the span current now."""
+        parent = self.current()
+        if parent is None:
+            return func
+
+        @functools.wraps(func)
+        def bound(*args, **kwargs):
+            stack = getattr(self._local, 'stack', None)
+            if stack is None:
+                stack = self._local.stack = []
+            stack.append(parent)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                stack.pop()
+        return bound
+
+    def _open(self, name, attrs):
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        span = Span(name, stack[-1] if stack else None, **attrs)
+        stack.append(span)
+        for hook in self.before:
+            hook(span)
+        return span
+
+    def _close(self, span, error):
+        span.end = time.time()
+        span.error = error
+        stack = self._local.stack
+        if stack[-1] is span:
+            stack.pop()
+        elif span in stack:
+            # left open by a generator while others were opened
+            stack.remove(span)
+        self.spans.append(span)
+        for hook in self.after:
+            hook(span)
+
+    def clear(self):
+        self.spans.clear()
+
+    def chrome_trace(self):
+        """Returns the finished spans as a Chrome trace event dictionary,
+        ready to be saved with json.dump."""
+        return chrome_trace(self.spans)
+
+
+class _SpanContext(object):
+    """Context manager returned by Tracer.span."""
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self):
+        self.span = self.tracer._open(self.name, self.attrs)
+        return self.span
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.tracer._close(self.span, exc_value)
+
+
+class NullSpan(object):
+    """Stands in for a span, and its context manager,
+    when there is no tracer."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+def chrome_trace(spans):
+    """Returns spans as a dictionary in the Chrome trace event format,
+    as complete (X) events with times in microseconds."""
+    pid = os.getpid()
+    events = []
+    # parents before children that start in the same microsecond
+    for span in sorted(spans, key=lambda span: (span.start, span.span_id)):
+        args = dict((key, value if isinstance(value, (int, float)) else
+                     '%s' % value) for key, value in span.attrs.items())
+        args['span_id'] = span.span_id
+        if span.parent is not None:
+            args['parent_id'] = span.parent.span_id
+        if span.error is not None:
+            args['error'] = '%s' % span.error
+        events.append({
+            'name': span.name,
+            'cat': 'http' if 'method' in span.attrs else 'call',
+            'ph': 'X',
+            'ts': int(span.start * 1000000),
+            'dur': int(span.duration * 1000000),
+            'pid': pid,
+            'tid': span.thread,
+            'args': args,
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def traced(method):
+    """Decorator for CiviCRM methods, opening a span named after the
+    method if the object has a tracer. If the method has an entity
+    argument it is added to the span, whether passed by position or
+    keyword."""
+    name = method.__name__
+    code = method.__code__
+    argnames = code.co_varnames[1:code.co_argcount]
+    position = argnames.index('entity') if 'entity' in argnames else None
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self.tracer is None:
+            return method(self, *args, **kwargs)
+        if position is None:
+            context = self.tracer.span(name)
+        elif position < len(args):
+            context = self.tracer.span(name, entity=args[position])
+        elif 'entity' in kwargs:
+            context = self.tracer.span(name, entity=kwargs['entity'])
+        else:
+            context = self.tracer.span(name)
+        with context:
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,259 @@
+"""
+.. module::transport
+:synopis:Ways of sending requests to the CiviCRM REST API.
+
+CiviCRM builds payloads and checks the responses, a transport just sends
+them. A transport has a request(method, url, payload, timeout, stream=False)
+method, where method is 'get' or 'post' and payload a dictionary of form
+fields (an EncodedPayload carries its encoding with it), returning a
+response with status_code, content, headers, iter_content(chunk_size) and
+close() as requests' does, and a close() method to release its connections.
+
+RequestsTransport uses a requests.Session, and is the default.
+Urllib3Transport uses a urllib3.PoolManager directly, skipping the work
+requests does on each call (cookies, hooks, redirect handling etc.).
+InProcessTransport passes payloads straight to a fakeserver.FakeCiviCRM,
+without HTTP, to measure or test the client on its own::
+
+    civicrm = CiviCRM(url, site_key, api_key, transport='urllib3')
+"""
+
+from __future__ import absolute_import, unicode_literals
+
+import json
+import threading
+
+import requests
+
+try:
+    from urllib import urlencode
+    text_type = unicode
+except ImportError:
+    # Python 3
+    from urllib.parse import urlencode
+    text_type = str
+
+_STRINGS = (bytes, text_type)
+
+FORM_HEADERS = {'Content-Type': 'application/x-www-form-urlencoded'}
+
+
+class EncodedPayload(dict):
+    """A payload that also carries its URL encoding, as query, so it
+    doesn't have to be encoded again (see prepared)."""
+    query = None
+
+
+class RequestsTransport(object):
+    """
+    .. class::RequestsTransport(
+                    self, session=None, pool_connections=10, pool_maxsize=10
+                    )
+    Sends requests with session, or a requests.Session created on first use
+    with a connection pool of the given size. close() closes the session if
+    it was created here, and a new one is created if more calls are made.
+    """
+    name = 'requests'
+
+    def __init__(self, session=None, pool_connections=10, pool_maxsize=10):
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self._session = session
+        # only close sessions we created ourselves
+        self._owns_session = session is None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """The requests.Session used, shared between threads."""
+        if self._session is None:
+            with self._lock:
+                if self._session is None:
+                    self._session = self._make_session()
+        return self._session
+
+    def _make_session(self):
+        """Returns a new requests.Session with a sized connection pool."""
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=self.pool_connections,
+            pool_maxsize=self.pool_maxsize
+        )
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, url, payload, timeout=None, stream=False):
+        query = getattr(payload, 'query', None)
+        if method == 'get':
+            return self.session.get(url, params=query or payload,
+                                    timeout=timeout, stream=stream)
+        if query is None:
+            return self.session.post(url, data=payload, timeout=timeout,
+                                     stream=stream)
+        return self.session.post(url, data=query, timeout=timeout,
+                                 stream=stream, headers=FORM_HEADERS)
+
+    def close(self):
+        with self._lock:
+            if self._session is not None and self._owns_session:
+                self._session.close()
+                self._session = None
+
+
+class Urllib3Transport(object):
+    """
+    .. class::Urllib3Transport(self, pool_connections=10, pool_maxsize=10)
+    Sends requests with a urllib3.PoolManager, keeping up to pool_maxsize
+    connections for each of up to pool_connections hosts.
+    """
+    name = 'urllib3'
+
+    def __init__(self, pool_connections=10, pool_maxsize=10):
+        import urllib3
+        self._urllib3 = urllib3
+        self.pool = urllib3.PoolManager(num_pools=pool_connections,
+                                        maxsize=pool_maxsize)
+
+    def request(self, method, url, payload, timeout=None, stream=False):
+        if isinstance(timeout, tuple):
+            timeout = self._urllib3.Timeout(connect=timeout[0],
+                                            read=timeout[1])
+        elif timeout is None:
+            timeout = self._urllib3.Timeout.DEFAULT_TIMEOUT
+        body = query_string(payload)
+        if method == 'get':
+            response = self.pool.request(
+                'GET', '%s?%s' % (url, body), timeout=timeout,
+                preload_content=not stream, redirect=False
+            )
+        else:
+            response = self.pool.urlopen(
+                'POST', url, body=body, timeout=timeout,
+                headers=FORM_HEADERS,
+                preload_content=not stream, redirect=False
+            )
+        return _Urllib3Response(response)
+
+    def close(self):
+        self.pool.clear()
+
+
+class _Urllib3Response(object):
+    """Gives a urllib3 response the parts of requests' interface we use."""
+
+    def __init__(self, response):
+        self._response = response
+        self.status_code = response.status
+        self.headers = response.headers
+
+    @property
+    def content(self):
+        return self._response.data
+
+    def iter_content(self, chunk_size=1):
+        return self._response.stream(chunk_size)
+
+    def close(self):
+        self._response.release_conn()
+
+
+class InProcessTransport(object):
+    """
+    .. class::InProcessTransport(self, fake)
+    Answers requests by calling fake.handle (see fakeserver) directly.
+    Responses are still JSON encoded, so they are decoded and checked just
+    as they would be coming from a server.
+    """
+    name = 'inprocess'
+
+    def __init__(self, fake):
+        self.fake = fake
+
+    def request(self, method, url, payload, timeout=None, stream=False):
+        pairs = []
+        for name, value in payload.items():
+            if isinstance(value, (list, tuple)):
+                pairs.extend((name, text_type(item)) for item in value)
+            else:
+                pairs.append((name, text_type(value)))
+        status, response = self.fake.handle(pairs)
+        return InProcessResponse(status, json.dumps(response).encode('utf-8'))
+
+    def close(self):
+        pass
+
+
+class InProcessResponse(object):
+    """A response from InProcessTransport."""
+
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+        self.headers = {'Content-Length': str(len(content))}
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+    def close(self):
+        pass
+
+
+TRANSPORTS = [RequestsTransport, Urllib3Transport]
+
+
+def get_transport(name, **kwargs):
+    """Returns a new transport by name ('requests' or 'urllib3'), passing
+    kwargs to it."""
+    for transport in TRANSPORTS:
+        if transport.name == name:
+            return transport(**kwargs)
+    raise ValueError('unknown transport %s' % name)
+
+
+def query_string(payload):
+    """Returns payload URL encoded, as a query string or form body."""
+    query = getattr(payload, 'query', None)
+    if query is not None:
+        return query
+    return urlencode(_encoded(payload), doseq=True)
+
+
+def query_length_bound(payload):
+    """Returns the length of payload URL encoded, or if it isn't already,
+    an upper bound on it found without encoding it: each character could
+    become up to four UTF-8 bytes (outside the Basic Multilingual Plane,
+    e.g. emoji), each percent encoded as three."""
+    query = getattr(payload, 'query', None)
+    if query is not None:
+        return len(query)
+    length = 0
+    for name, value in payload.items():
+        if isinstance(value, _STRINGS):
+            # name=value&
+            length += len(name) + len(value) + 2
+            continue
+        if not isinstance(value, (list, tuple)):
+            value = (value,)
+        for item in value:
+            if not isinstance(item, _STRINGS):
+                item = '%s' % item
+            length += len(name) + len(item) + 2
+    return length * 12
+
+
+def _encoded(payload):
+    """payload with text encoded as UTF-8, as urlencode on Python 2
+    can't cope with non-ASCII unicode."""
+    if str is not bytes:
+        return payload
+    return dict((name, _utf8(value)) for name, value in payload.items())
+
+
+def _utf8(value):
+    if isinstance(value, (list, tuple)):
+        return [_utf8(item) for item in value]
+    if isinstance(value, text_type):
+        return value.encode('utf-8')
+    return value
@@ -0,0 +1,262 @@
+"""Benchmarks of the client's own overhead. No CiviCRM instance is needed.
+
+Times payload construction, decoding responses, checking results, resolving
+options and get/create calls (plain, prepared and returning records) made
+against a stand-in session that returns canned responses instantly, for
+several result sizes. get_inprocess makes
+calls to a fakeserver.FakeCiviCRM through the in-process transport, so
+includes the cost of answering the query. Memory use (the peak allocated
+while running a benchmark once) is recorded with tracemalloc where available
+(Python 3.4+).
+
+Run from the top level directory::
+
+    python -m tests.benchmarks --output before.json
+    (make changes)
+    python -m tests.benchmarks --output after.json --compare before.json
+
+Results are written as JSON: a list of benchmarks, each with its name, the
+result size, seconds per call (best and median of the repeats), calls per
+second and peak memory in bytes.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from pythoncivicrm.fakeserver import FakeCiviCRM, sample_contacts
+from pythoncivicrm.pythoncivicrm import CiviCRM
+from pythoncivicrm.options import OptionIndex
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+SIZES = [1, 100, 1000]
+
+
+def make_rows(count):
+    """Contact like rows, values are strings as the API returns them."""
+    return [{
+        'id': str(i),
+        'contact_id': str(i),
+        'contact_type': 'Individual',
+        'sort_name': 'Surname%s, Forename' % i,
+        'display_name': 'Forename Surname%s' % i,
+        'first_name': 'Forename',
+        'last_name': 'Surname%s' % i,
+        'email': 'contact%s@example.org' % i,
+        'phone': '555-%04d' % (i % 10000),
+        'street_address': '%s Main Street' % i,
+        'city': 'Portland',
+        'postal_code': '97201',
+        'country_id': '1228',
+        'is_deleted': '0',
+        'created_date': '2014-01-01 12:00:00',
+    } for i in range(count)]
+
+
+def make_response(rows):
+    return json.dumps({
+        'is_error': 0, 'version': 3, 'count': len(rows), 'values': rows
+    }).encode('utf-8')
+
+
+class StubResponse(object):
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+
+class StubSession(object):
+    """Stands in for requests.Session, answering every request with
+    content straight away."""
+
+    def __init__(self, content):
+        self.response = StubResponse(content)
+
+    def get(self, url, **kwargs):
+        return self.response
+
+    def post(self, url, **kwargs):
+        return self.response
+
+    def close(self):
+        pass
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """Returns (best, median) seconds per call of func, calling it enough
+    times that each of the repeat timings takes at least min_time."""
+    number = 1
+    while True:
+        started = time.time()
+        for _ in range(number):
+            func()
+        elapsed = time.time() - started
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        started = time.time()
+        for _ in range(number):
+            func()
+        timings.append((time.time() - started) / number)
+    timings.sort()
+    return timings[0], timings[len(timings) // 2]
+
+
+def peak_memory(func):
+    """Returns the peak bytes allocated while calling func once,
+    or None if tracemalloc is not available."""
+    if tracemalloc is None:
+        return None
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def client(content=b'{"is_error": 0, "values": []}', **kwargs):
+    return CiviCRM('example.org', 'site_key', 'api_key',
+                   session=StubSession(content), **kwargs)
+
+
+def benchmarks(sizes):
+    """Yields (name, size, func) for each benchmark."""
+    cc = client()
+    params = {'contact_type': 'Individual', 'city': 'Portland',
+              'return': 'id,display_name'}
+    yield ('construct_payload', 1, lambda: cc._construct_payload(
+        'get', 'get', 'Contact', dict(params)))
+    yield ('filter_merge_payload', 1, lambda: cc._filter_merge_payload(
+        dict(params), cc._payload_template('get', 'Contact'),
+        ['site_key', 'api_key', 'entity', 'action', 'json']))
+    yield ('add_options', 1, lambda: cc._add_options(
+        dict(params), limit=25, offset=100))
+
+    options = dict((str(i), 'Option %s' % i) for i in range(100))
+    index = OptionIndex(options)
+    labels = ['Option %s' % i for i in range(0, 100, 10)]
+    yield ('option_index', 100, lambda: OptionIndex(options))
+    yield ('option_resolve', len(labels),
+           lambda: [index.resolve(label) for label in labels])
+    options_client = client(json.dumps(
+        {'is_error': 0, 'values': options}).encode('utf-8'))
+    yield ('resolve_options', len(labels), lambda: options_client.
+           resolve_options('Activity', 'activity_type_id', labels))
+
+    for size in sizes:
+        content = make_response(make_rows(size))
+        decoded = cc.json_codec.decode(content)
+        yield ('decode', size, lambda content=content:
+               cc.json_codec.decode(content))
+        yield ('check_results', size, lambda decoded=decoded:
+               cc._check_results(decoded))
+        get_client = client(content)
+        yield ('get', size, lambda get_client=get_client:
+               get_client.get('Contact', contact_type='Individual',
+                              limit=size))
+        find = get_client.prepare('Contact', 'get',
+                                  contact_type='Individual', limit=size)
+        yield ('get_prepared', size, lambda find=find: find())
+        records_client = client(content, records=True)
+        yield ('get_records', size, lambda records_client=records_client:
+               records_client.get('Contact', limit=size))
+
+    fake_client = FakeCiviCRM({'Contact': sample_contacts(max(sizes))}
+                              ).civicrm()
+    for size in sizes:
+        yield ('get_inprocess', size, lambda size=size:
+               fake_client.get('Contact', limit=size))
+
+    create_client = client(make_response(make_rows(1)))
+    yield ('create', 1, lambda: create_client.create(
+        'Contact', contact_type='Individual', first_name='Forename',
+        last_name='Surname', email='contact@example.org'))
+
+
+def run(sizes=SIZES, min_time=0.2, repeat=5, only=None):
+    """Runs the benchmarks (only those named in only, if given) and returns
+    the results as a dictionary."""
+    results = []
+    for name, size, func in benchmarks(sizes):
+        if only and name not in only:
+            continue
+        best, median = measure(func, min_time, repeat)
+        results.append({
+            'name': name,
+            'size': size,
+            'best': best,
+            'median': median,
+            'per_second': 1.0 / best if best else None,
+            'peak_memory': peak_memory(func),
+        })
+    return {
+        'python': platform.python_version(),
+        'codec': client().json_codec.name,
+        'results': results,
+    }
+
+
+def compare(results, baseline):
+    """Returns lines comparing the best times in results with baseline,
+    as a ratio (below 1 is faster)."""
+    before = dict(((r['name'], r['size']), r) for r in baseline['results'])
+    lines = []
+    for result in results['results']:
+        old = before.get((result['name'], result['size']))
+        if old is None or not old['best']:
+            continue
+        lines.append('%-22s %6s %8.2fx' % (
+            result['name'], result['size'], result['best'] / old['best']))
+    return lines
+
+
+def report(results):
+    lines = ['%-22s %6s %12s %12s %12s' % (
+        'benchmark', 'size', 'best (us)', 'calls/s', 'peak (KiB)')]
+    for result in results['results']:
+        memory = result['peak_memory']
+        lines.append('%-22s %6s %12.2f %12.0f %12s' % (
+            result['name'], result['size'], result['best'] * 1e6,
+            result['per_second'] or 0,
+            '-' if memory is None else '%.1f' % (memory / 1024.0)))
+    return lines
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes', default=','.join(map(str, SIZES)),
+                        help='comma separated result sizes (rows)')
+    parser.add_argument('--min-time', type=float, default=0.2,
+                        help='minimum seconds per timing')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', help='comma separated benchmark names')
+    parser.add_argument('--output', help='write results to this JSON file')
+    parser.add_argument('--compare', help='JSON results to compare with')
+    args = parser.parse_args(argv)
+    sizes = [int(size) for size in args.sizes.split(',')]
+    only = args.only.split(',') if args.only else None
+    results = run(sizes, args.min_time, args.repeat, only)
+    print('\n'.join(report(results)))
+    if args.compare:
+        with open(args.compare) as baseline:
+            print('\nbest time relative to %s' % args.compare)
+            print('\n'.join(compare(results, json.load(baseline))))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,12 +4,67 @@ These mock the return values from the API, so no running instance is needed.
 Note, for convenience, mock returns values omit some things returned by
 the API.
 """
+import copy
+import itertools
+import json
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 import mock
+import requests
 
 from pythoncivicrm.pythoncivicrm import CiviCRM
 from pythoncivicrm.pythoncivicrm import CivicrmError
 from pythoncivicrm.pythoncivicrm import matches_required
+from pythoncivicrm.jsonstream import ValuesStream
+from pythoncivicrm.jsoncodec import get_codec, JsonCodec
+from pythoncivicrm.cache import DiskCache, LRUCache, MISSING
+from pythoncivicrm.fakeserver import FakeCiviCRM, FakeServer, sample_contacts
+from pythoncivicrm.metrics import MetricsRegistry
+from pythoncivicrm.options import OptionIndex
+from pythoncivicrm.records import Record, RecordBuilder, to_records
+from pythoncivicrm.tracing import Tracer
+from pythoncivicrm.transport import (
+    InProcessTransport, RequestsTransport, Urllib3Transport,
+    query_length_bound, query_string
+)
+from pythoncivicrm.parallel import (
+    AdaptiveLimiter, Hedger, is_overload, run_parallel, SingleFlight
+)
+
+try:
+    from urllib import urlencode
+except ImportError:
+    # Python 3
+    from urllib.parse import urlencode
+
+from . import benchmarks
+
+try:
+    import tracemalloc
+except ImportError:
+    # Python 2
+    tracemalloc = None
+
+try:
+    import asyncio
+    from pythoncivicrm.asynccivicrm import AsyncCiviCRM, httpx
+except (ImportError, SyntaxError):
+    # Python 2
+    AsyncCiviCRM = httpx = None
+
+def api_params(params):
+    """The API parameters from a mocked request, decoding JSON if used."""
+    params = dict(params)
+    if params.get('json', 1) != 1:
+        params.update(json.loads(params.pop('json')))
+    return params
+
 
 class CiviCRMTests(unittest.TestCase):
         # pylint: disable=R0904
@@ -96,6 +151,29 @@ class CiviCRMTests(unittest.TestCase):
         self.assertEquals(payload['json'], 1)
         self.assertEquals(payload['contact_id'], 2)
 
+    def test__construct_payload_body_html(self):
+        payload = self.cc._construct_payload('get', 'get', 'Mailing',
+                {'body_html': '<p>test</p>'})
+        self.assertNotIn('body_html', payload)
+        payload = self.cc._construct_payload('post', 'create', 'Mailing',
+                {'body_html': '<p>test</p>'})
+        self.assertEquals(payload['body_html'], '<p>test</p>')
+
+    def test__construct_payload_json_params(self):
+        cc = CiviCRM('example.org', 'site', 'api', json_params=True)
+        payload = cc._construct_payload('get', 'get', 'Contact',
+                {'contact_id': 2, 'api_key': 'x'})
+        self.assertEquals(sorted(payload),
+                ['action', 'api_key', 'entity', 'json', 'key'])
+        self.assertEquals(payload['api_key'], 'api')
+        self.assertEquals(json.loads(payload['json']),
+                {'contact_id': 2, 'sequential': 1})
+
+    def test__construct_payload_nested(self):
+        payload = self.cc._construct_payload('get', 'get', 'Contact',
+                {'id': {'IN': [1, 2]}})
+        self.assertEquals(json.loads(payload['json'])['id'], {'IN': [1, 2]})
+
     def test__check_results(self):
         results = self.cc._check_results({'is_error' : 0, 'result' : 1})
         self.assertEquals(results, 1)
@@ -104,25 +182,43 @@ class CiviCRMTests(unittest.TestCase):
         self.assertRaises(CivicrmError, self.cc._check_results,
                 {'is_error' : 1, 'error_message' : 'test', 'result' : 1})
 
-    def test_is_valid_option_id_is_valid(self):
+    def mock_activity_is_test(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":{"0":"No","1":"Yes"}}'
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_is_valid_option_id_is_valid(self, mock_requests):
+        self.mock_activity_is_test(mock_requests)
         result = self.cc.is_valid_option(
                 'Activity', 'activity_is_test', 0)
         self.assertEquals(result, 0)
+        params = mock_requests.get.call_args[1]['params']
+        self.assertEquals(params['action'], 'getoptions')
+        self.assertEquals(params['field'], 'activity_is_test')
 
-    def test_is_valid_option_id_is_not_valid(self):
+    @mock.patch.object(RequestsTransport, "session")
+    def test_is_valid_option_id_is_not_valid(self, mock_requests):
+        self.mock_activity_is_test(mock_requests)
         self.assertRaises(CivicrmError, self.cc.is_valid_option,
             'Activity', 'activity_is_test', 2)
 
-    def test_is_valid_option_label_is_valid(self):
+    @mock.patch.object(RequestsTransport, "session")
+    def test_is_valid_option_label_is_valid(self, mock_requests):
+        self.mock_activity_is_test(mock_requests)
         result = self.cc.is_valid_option(
                 'Activity', 'activity_is_test', 'Yes')
         self.assertEquals(result, '1')
 
-    def test_is_valid_option_label_is_not_valid(self):
+    @mock.patch.object(RequestsTransport, "session")
+    def test_is_valid_option_label_is_not_valid(self, mock_requests):
+        self.mock_activity_is_test(mock_requests)
         self.assertRaises(CivicrmError, self.cc.is_valid_option,
             'Activity', 'activity_is_test', 'Not Valid')
 
-    def test_is_valid_option_label_is_none(self):
+    @mock.patch.object(RequestsTransport, "session")
+    def test_is_valid_option_label_is_none(self, mock_requests):
+        self.mock_activity_is_test(mock_requests)
         self.assertRaises(CivicrmError, self.cc.is_valid_option,
             'Activity', 'activity_is_test', None)
 
@@ -138,30 +234,176 @@ class CiviCRMTests(unittest.TestCase):
         results = matches_required(required, params)
         self.assertEquals(results, None)
 
+    def test_connect_timeout(self):
+        cc = CiviCRM('example.org', 'site', 'api', timeout=5,
+                connect_timeout=2)
+        self.assertEquals(cc.timeout, (2, 5))
+
+    def test_session_is_reused(self):
+        self.assertIs(self.cc.session, self.cc.session)
+
+    def test_close_creates_new_session(self):
+        session = self.cc.session
+        self.cc.close()
+        self.assertIsNot(self.cc.session, session)
+
+    def test_supplied_session_not_closed(self):
+        session = mock.MagicMock()
+        with CiviCRM('example.org', 'site', 'api', session=session) as cc:
+            self.assertIs(cc.session, session)
+        self.assertFalse(session.close.called)
+        self.assertIs(cc.session, session)
+
+    def test_default_json_codec(self):
+        self.assertEquals(
+            self.cc.json_codec.decode(b'{"values": [1]}'), {"values": [1]})
+
+    def test_json_codec_by_name(self):
+        cc = CiviCRM('example.org', 'site', 'api', json_codec='json')
+        self.assertIsInstance(cc.json_codec, JsonCodec)
+        self.assertEquals(cc.json_codec.name, 'json')
+
+    def test_unknown_json_codec(self):
+        self.assertRaises(ValueError, get_codec, 'not a codec')
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_custom_json_codec(self, mock_requests):
+        codec = mock.MagicMock()
+        codec.decode.return_value = {'is_error': 0, 'values': ['decoded']}
+        cc = CiviCRM('example.org', 'site', 'api', json_codec=codec)
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = b'raw'
+        self.assertEquals(cc.get('Contact'), ['decoded'])
+        codec.decode.assert_called_with(b'raw')
+
     # Methods calling requests
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test__get(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = self.contacts
         results = self.cc._get('get', 'Contact')
         self.assertEqual(results[0]['id'], '1')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test__post(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = self.contacts
         results = self.cc._post('get', 'Contact')
         self.assertEqual(results[0]['id'], '1')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_get(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = self.contacts
         results = self.cc.get('Contact')
         self.assertEqual(results[0]['id'], '1')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    def _paged_response(self, total):
+        """side_effect returning total rows, paged by options."""
+        def side_effect(url, params=None, **kwargs):
+            params = api_params(params)
+            offset = params.get('options[offset]', 0)
+            limit = params.get('options[limit]', 25)
+            rows = [{'id': str(i)}
+                    for i in range(offset + 1, min(offset + limit, total) + 1)]
+            response = mock.MagicMock(status_code=200)
+            response.content = json.dumps({'is_error': 0, 'values': rows})
+            return response
+        return side_effect
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_iter_get(self, mock_requests):
+        mock_requests.get.side_effect = self._paged_response(5)
+        results = list(self.cc.iter_get('Contact', page_size=2))
+        self.assertEqual([r['id'] for r in results],
+                ['1', '2', '3', '4', '5'])
+        self.assertEqual(mock_requests.get.call_count, 3)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_iter_get_no_prefetch_with_limit(self, mock_requests):
+        mock_requests.get.side_effect = self._paged_response(10)
+        results = list(self.cc.iter_get('Contact', page_size=2,
+                prefetch=False, limit=3, offset=4))
+        self.assertEqual([r['id'] for r in results], ['5', '6', '7'])
+        self.assertEqual(mock_requests.get.call_count, 2)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_iter_get_keyset(self, mock_requests):
+        def side_effect(url, params=None, **kwargs):
+            params = api_params(params)
+            ids = [i for i in range(3, 20, 3) if i > params['id']['>']]
+            rows = [{'id': str(i)} for i in ids[:params['options[limit]']]]
+            response = mock.MagicMock(status_code=200)
+            response.content = json.dumps({'is_error': 0, 'values': rows})
+            return response
+        mock_requests.get.side_effect = side_effect
+        results = list(self.cc.iter_get('Contact', page_size=2,
+                keyset=True, after_id=4))
+        self.assertEqual([r['id'] for r in results],
+                ['6', '9', '12', '15', '18'])
+        last_call = api_params(mock_requests.get.call_args[1]['params'])
+        self.assertEqual(last_call['id'], {'>': 15})
+        self.assertEqual(last_call['options[sort]'], 'id ASC')
+        self.assertNotIn('options[offset]', last_call)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_iter_get_raises_error(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":1,"error_message":"test"}'
+        self.assertRaises(CivicrmError, list, self.cc.iter_get('Contact'))
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_get_related(self, mock_requests):
+        def side_effect(url, params=None, **kwargs):
+            if params['entity'] == 'Contact':
+                rows = [{'id': '1'}, {'id': '2'}]
+            elif params['entity'] == 'Email':
+                rows = [{'id': '5', 'contact_id': '1'},
+                        {'id': '6', 'contact_id': '1'}]
+            else:
+                rows = [{'id': '9', 'contact_id': '2'}]
+            response = mock.MagicMock(status_code=200)
+            response.content = json.dumps({'is_error': 0, 'values': rows})
+            return response
+        mock_requests.get.side_effect = side_effect
+        results = self.cc.get('Contact', related=['Email', 'Phone'])
+        self.assertEqual([e['id'] for e in results[0]['Email']], ['5', '6'])
+        self.assertEqual(results[1]['Email'], [])
+        self.assertEqual(results[1]['Phone'][0]['id'], '9')
+        self.assertEqual(mock_requests.get.call_count, 3)
+        params = api_params(mock_requests.get.call_args[1]['params'])
+        self.assertEqual(params['contact_id'], {'IN': ['1', '2']})
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_get_related_needs_ids(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        # sequential=0
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":{"1":{"id":"1"}}}'
+        self.assertRaises(CivicrmError, self.cc.get, 'Contact',
+                          related=['Email'], sequential=0)
+        # return leaving out id
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":[{"display_name":"Foo"}]}'
+        self.assertRaises(CivicrmError, self.cc.get, 'Contact',
+                          related=['Email'], **{'return': 'display_name'})
+        self.assertEqual(mock_requests.get.call_count, 2)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_iter_get_related(self, mock_requests):
+        mock_requests.get.side_effect = self._paged_response(4)
+        results = list(self.cc.iter_get('Participant', page_size=2,
+            related=[('ParticipantPayment', 'participant_id')]))
+        self.assertEqual(len(results), 4)
+        # 3 pages, of which 2 have results, and 1 lookup per page
+        self.assertEqual(mock_requests.get.call_count, 5)
+        entities = [c[1]['params']['entity']
+                    for c in mock_requests.get.call_args_list]
+        self.assertEqual(entities.count('ParticipantPayment'), 2)
+
+    @mock.patch.object(RequestsTransport, "session")
     def test_get_invalid_option(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = """
@@ -178,14 +420,85 @@ class CiviCRMTests(unittest.TestCase):
         self.assertRaises(CivicrmError,self.cc.get,
                 "Contact", contact_id="a")
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
+    def test_long_get_uses_post(self, mock_requests):
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.content = self.contacts
+        cc = CiviCRM('example.org', 'site', 'api', max_query_length=100)
+        results = cc.get('Contact', id={'IN': list(range(100))})
+        self.assertEqual(results[0]['id'], '1')
+        self.assertFalse(mock_requests.get.called)
+        data = api_params(mock_requests.post.call_args[1]['data'])
+        self.assertEqual((data['action'], len(data['id']['IN'])), ('get', 100))
+
+    def test_get_method(self):
+        cc = CiviCRM('example.org', 'site', 'api', max_query_length=1000)
+        payload = cc._construct_payload('get', 'get', 'Contact', {
+            'last_name': u'caf\u00e9', 'id': [1, 2], 'is_deleted': 0})
+        self.assertGreaterEqual(query_length_bound(payload),
+                                len(query_string(payload)))
+        self.assertEqual(cc._get_method(payload), 'get')
+        # over the estimate, but not when encoded
+        payload['note'] = 'x' * 40
+        self.assertGreater(query_length_bound(payload), 1000)
+        self.assertEqual(cc._get_method(payload), 'get')
+        payload['note'] = u'\u00e9' * 200
+        self.assertEqual(cc._get_method(payload), 'post')
+        # four UTF-8 bytes each
+        payload['note'] = u'\U0001F600' * 400
+        self.assertGreaterEqual(query_length_bound(payload),
+                                len(query_string(payload)))
+        cc.max_query_length = 4000
+        self.assertEqual(cc._get_method(payload), 'post')
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_get_many(self, mock_requests):
+        def side_effect(url, params=None, **kwargs):
+            params = api_params(params)
+            rows = [{'id': str(i), 'email': 'e%s@example.org' % i}
+                    for i in params['id']['IN'] if i % 2]
+            response = mock.MagicMock(status_code=200)
+            response.content = json.dumps({'is_error': 0, 'values': rows})
+            return response
+        mock_requests.get.side_effect = side_effect
+        results = self.cc.get_many('Contact', range(1, 11), chunk_size=3,
+                return_fields=['email'])
+        self.assertEquals(sorted(results), [1, 3, 5, 7, 9])
+        self.assertEquals(results[7]['email'], 'e7@example.org')
+        self.assertEquals(mock_requests.get.call_count, 4)
+        params = api_params(mock_requests.get.call_args[1]['params'])
+        self.assertEquals(params['return'], ['email', 'id'])
+        self.assertEquals(params['options[limit]'], 0)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_get_many_query_length(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = '{"values":[]}'
+        cc = CiviCRM('example.org', 'site', 'api', max_query_length=400)
+        emails = ['contact%s@example.org' % i for i in range(20)]
+        self.assertEquals(cc.get_many('Email', emails, field='email'), {})
+        self.assertFalse(mock_requests.post.called)
+        self.assertGreater(mock_requests.get.call_count, 1)
+        requested = []
+        for call in mock_requests.get.call_args_list:
+            self.assertLessEqual(
+                len(urlencode(call[1]['params'], doseq=True)), 400)
+            requested.extend(api_params(call[1]['params'])['email']['IN'])
+        self.assertEquals(sorted(requested), sorted(emails))
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_get_many_raises_error(self, mock_requests):
+        mock_requests.get.return_value.status_code = 500
+        self.assertRaises(CivicrmError, self.cc.get_many, 'Contact', [1, 2])
+
+    @mock.patch.object(RequestsTransport, "session")
     def test_getsingle(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = self.contact_json
         results = self.cc.getsingle('Contact',contact_id=1)
         self.assertEqual(results['id'], '1')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_getsingle_multiple_results(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = """
@@ -197,7 +510,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertRaises(CivicrmError, self.cc.getsingle,
             'Contact', country='United States')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_getvalue(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = \
@@ -206,7 +519,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertEquals(type(results), unicode)
         self.assertEquals(results, 'Test, Test')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_getvalue_multiple_results(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = """
@@ -218,7 +531,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertRaises(CivicrmError, self.cc.getvalue,
             'Contact', 'sort_name', country='United States')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_create(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = self.results
@@ -226,7 +539,36 @@ class CiviCRMTests(unittest.TestCase):
                 contact_type='individual', display_name='bar, foo')
         self.assertEquals(results[0]['display_name'], 'bar, foo')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
+    def test_bulk_create(self, mock_requests):
+        def side_effect(url, data=None, **kwargs):
+            response = mock.MagicMock(status_code=200)
+            if data['email'] == 'bad':
+                response.content = '{"is_error":1,"error_message":"bad"}'
+            else:
+                response.content = json.dumps({'is_error': 0, 'values': [
+                    {'id': data['email'][1:], 'email': data['email']}]})
+            return response
+        mock_requests.post.side_effect = side_effect
+        rows = ({'email': 'e%s' % i} for i in range(7))
+        progress = mock.MagicMock()
+        result = self.cc.bulk_create('Email', rows, concurrency=2,
+                chunk_size=3, progress=progress)
+        self.assertEquals([r['id'] for r in result.results],
+                [str(i) for i in range(7)])
+        self.assertEquals(result.failed, 0)
+        self.assertEquals(progress.call_count, 3)
+
+        rows = [{'email': 'e0'}, {'email': 'bad'}, {'email': 'e2'}]
+        result = self.cc.bulk_create('Email', rows, chunk_size=2)
+        self.assertEquals(result.succeeded, 2)
+        self.assertEquals(result.results[1], None)
+        self.assertEquals(result.results[2]['id'], '2')
+        index, row, error = result.errors[0]
+        self.assertEquals((index, row), (1, {'email': 'bad'}))
+        self.assertIsInstance(error, CivicrmError)
+
+    @mock.patch.object(RequestsTransport, "session")
     def test_delete(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content =\
@@ -234,14 +576,14 @@ class CiviCRMTests(unittest.TestCase):
         results = self.cc.delete('Contact', 2, True)
         self.assertEquals(results, 1)
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_update(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = self.results
         results = self.cc.update('Contact', 2, display_name='bar, foo')
         self.assertEquals(results[0]['display_name'], 'bar, foo')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_setvalue(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = """
@@ -255,7 +597,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertEquals(results['display_name'], 'foo,bar')
 
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_getcount(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content =\
@@ -264,7 +606,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertEquals(count, 1)
 
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_getoptions(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = """
@@ -281,7 +623,7 @@ class CiviCRMTests(unittest.TestCase):
         results = self.cc.getoptions('Contact', 'contact_type')
         self.assertIn('Organization', results)
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_getoptions_raises_error(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = """
@@ -289,14 +631,175 @@ class CiviCRMTests(unittest.TestCase):
             """
         self.assertRaises(CivicrmError, self.cc.getoptions, 'Contact', 'city')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
+    def test_getoptions_is_cached(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":{"1":"Yes","0":"No"}}'
+        self.cc.getoptions('Activity', 'is_test')
+        results = self.cc.getoptions('Activity', 'is_test')
+        self.assertEquals(results['1'], 'Yes')
+        self.assertEquals(mock_requests.get.call_count, 1)
+        self.assertEquals(self.cc.metadata_cache_stats()['hits'], 1)
+        self.cc.invalidate_metadata('Activity', 'is_test')
+        self.cc.getoptions('Activity', 'is_test')
+        self.assertEquals(mock_requests.get.call_count, 2)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_getfields_cache_disabled(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":{"id":{"name":"id"}}}'
+        cc = CiviCRM('example.org', 'site', 'api', metadata_ttl=0)
+        cc.getfields('Contact')
+        cc.getfields('Contact')
+        self.assertEquals(mock_requests.get.call_count, 2)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_getoptions_error_not_cached(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":1,"error_message":"no options"}'
+        for _ in range(2):
+            self.assertRaises(CivicrmError, self.cc.getoptions,
+                'Contact', 'city')
+        self.assertEquals(mock_requests.get.call_count, 2)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_result_cache(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":[{"id":"1"}]}'
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.content = \
+            '{"is_error":0,"values":[{"id":"2"}]}'
+        cc = CiviCRM('example.org', 'site', 'api',
+                     result_cache=LRUCache(), result_ttls={'Email': 0})
+        first = cc.get('Contact', city='Portland', contact_type='Individual')
+        first[0]['id'] = 'changed'
+        results = cc.get('Contact', contact_type='Individual', city='Portland')
+        self.assertEqual(results, [{'id': '1'}])
+        self.assertEqual(mock_requests.get.call_count, 1)
+        self.assertEqual(cc.result_cache_stats()['hits'], 1)
+        cc.getcount('Contact')
+        self.assertEqual(mock_requests.get.call_count, 2)
+        # not cached
+        cc.get('Email')
+        cc.get('Email')
+        self.assertEqual(mock_requests.get.call_count, 4)
+        # writes to other entities leave Contact results alone
+        cc.create('Note', entity_id=1, note='test')
+        cc.get('Contact', city='Portland', contact_type='Individual')
+        self.assertEqual(mock_requests.get.call_count, 4)
+        cc.update('Contact', 1, city='Boston')
+        cc.get('Contact', city='Portland', contact_type='Individual')
+        self.assertEqual(mock_requests.get.call_count, 5)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_result_cache_write_during_read(self, mock_requests):
+        cache = LRUCache()
+        cc = CiviCRM('example.org', 'site', 'api', result_cache=cache)
+
+        def read_during_write(*args, **kwargs):
+            # a write finishes while the read is in progress
+            cc.create('Contact', contact_type='Individual')
+            return mock.MagicMock(
+                status_code=200, content='{"is_error":0,"values":[]}')
+        mock_requests.get.side_effect = read_during_write
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.content = \
+            '{"is_error":0,"values":[{"id":"2"}]}'
+        self.assertEqual(cc.get('Contact'), [])
+        # what was read may be from before the write
+        self.assertEqual(len(cache), 0)
+        mock_requests.get.side_effect = None
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":[{"id":"2"}]}'
+        cc.get('Contact')
+        self.assertEqual(len(cache), 1)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_result_cache_errors(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":1,"error_message":"test"}'
+        mock_requests.post.return_value.status_code = 500
+        cache = LRUCache()
+        cc = CiviCRM('example.org', 'site', 'api', result_cache=cache)
+        for _ in range(2):
+            self.assertRaises(CivicrmError, cc.getsingle, 'Contact', id=1)
+        self.assertEqual(mock_requests.get.call_count, 2)
+        # a failed write still invalidates, including chained entities
+        cache.set(('Contact', 'x'), b'{}')
+        cache.set(('Email', 'x'), b'{}')
+        cache.set(('Group', 'x'), b'{}')
+        self.assertRaises(CivicrmError, cc.create, 'Contact',
+                          **{'api.Email.create': {'email': 'a@example.org'},
+                             'api.Group.get': {}})
+        self.assertEqual(len(cache), 1)
+        cc.invalidate_results()
+        self.assertEqual(len(cache), 0)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_prepare(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":[{"id":"1"}]}'
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.content = \
+            '{"is_error":0,"values":[{"id":"2"}]}'
+        cc = CiviCRM('example.org', 'site', 'api', result_cache=LRUCache())
+        find = cc.prepare('Contact', 'get', contact_type='Individual',
+                          limit=5)
+        self.assertEqual(find(city='Portland'), [{'id': '1'}])
+        query = mock_requests.get.call_args[1]['params']
+        self.assertIn('contact_type=Individual', query)
+        self.assertIn('options%5Blimit%5D=5', query)
+        self.assertTrue(query.endswith('&city=Portland'))
+        # the same payload as get, so cached results are shared
+        cc.get('Contact', contact_type='Individual', limit=5,
+               city='Portland')
+        self.assertEqual(mock_requests.get.call_count, 1)
+        # overriding a fixed parameter builds the payload in full
+        payload = find.payload(contact_type='Organization', offset=10)
+        self.assertIsNone(getattr(payload, 'query', None))
+        self.assertEqual(payload['contact_type'], 'Organization')
+        self.assertEqual(payload['options[offset]'], 10)
+        self.assertIn('json', find.payload(id={'IN': [1, 2]}))
+        add = cc.prepare('Email', 'create', location_type_id=1)
+        self.assertEqual(add(contact_id=1, email='a@example.org'),
+                         [{'id': '2'}])
+        data = mock_requests.post.call_args[1]['data']
+        self.assertIn('email=a%40example.org', data)
+        self.assertIn('location_type_id=1', data)
+        self.assertRaises(CivicrmError, cc.prepare, 'Contact', 'get',
+                          api_key='x')
+        self.assertRaises(CivicrmError, cc.prepare, 'Contact', '')
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_resolve_options(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = """
+            {"is_error":0,"values":{"1":"Meeting","2":"Phone Call"}}"""
+        results = self.cc.resolve_options('Activity', 'activity_type_id',
+                ['Meeting', 'phone  call', 2, 'Lunch'], strict=False)
+        self.assertEquals(results, ['1', '2', 2, None])
+        self.assertEquals(
+            self.cc.is_valid_option('Activity', 'activity_type_id', 'MEETING'),
+            '1')
+        self.assertEquals(mock_requests.get.call_count, 1)
+        self.assertRaises(CivicrmError, self.cc.resolve_options,
+            'Activity', 'activity_type_id', ['Lunch'])
+
+    @mock.patch.object(RequestsTransport, "session")
     def test_doaction(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = self.contacts
         results = self.cc.doaction('get', 'Contact')
         self.assertEqual(results[0]['id'], '1')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_contact(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = self.results
@@ -304,11 +807,57 @@ class CiviCRMTests(unittest.TestCase):
                 contact_type='Individual', display_name='bar, foo')
         self.assertEquals(results['display_name'], 'bar, foo')
 
+    @mock.patch.object(RequestsTransport, "session")
+    def test_add_contact_chained(self, mock_requests):
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.content = """
+        {
+            "is_error":0,
+            "values":[{
+                "id":"2",
+                "display_name":"bar, foo",
+                "api.Email.create":[
+                    {"is_error":0,"values":[{"id":"7","email":"a@b.org"}]},
+                    {"is_error":0,"values":[{"id":"8","email":"c@d.org"}]}],
+                "api.GroupContact.create":[
+                    {"is_error":0,"added":1,"not_added":0}]
+            }]
+        }"""
+        contact = self.cc.add_contact('Individual', display_name='bar, foo',
+                emails=['a@b.org', {'email': 'c@d.org', 'is_primary': 0}],
+                groups=[5])
+        self.assertEquals([e['id'] for e in contact['emails']], ['7', '8'])
+        self.assertEquals(contact['groups'][0]['added'], 1)
+        self.assertNotIn('api.Email.create', contact)
+        data = mock_requests.post.call_args[1]['data']
+        self.assertEquals(sorted(data),
+                ['action', 'api_key', 'entity', 'json', 'key'])
+        params = json.loads(data['json'])
+        self.assertEquals(params['display_name'], 'bar, foo')
+        self.assertEquals(params['api.Email.create'][1],
+                {'email': 'c@d.org', 'is_primary': 0, 'sequential': 1})
+        self.assertEquals(params['api.GroupContact.create'][0]['group_id'], 5)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_create_chained_error(self, mock_requests):
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.content = """
+        {"is_error":0,"values":[{"id":"2","api.Phone.create":
+            {"is_error":1,"error_message":"Mandatory key(s) missing"}}]}"""
+        self.assertRaisesRegexp(CivicrmError, 'Mandatory',
+                self.cc.create, 'Contact', contact_type='Individual',
+                **{'api.Phone.create': {'phone_type_id': 1}})
+        # the contact was still created, and can be found from the error
+        with self.assertRaises(CivicrmError) as context:
+            self.cc.create('Contact', contact_type='Individual',
+                           **{'api.Phone.create': {'phone_type_id': 1}})
+        self.assertEqual(context.exception.created['id'], '2')
+
     def test_add_contact_required_field_missing(self):
         self.assertRaisesRegexp(CivicrmError, 'fields must exist',
                 self.cc.add_contact, contact_type='Individual')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_contact_wrong_type(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = """
@@ -324,7 +873,7 @@ class CiviCRMTests(unittest.TestCase):
                 self.cc.add_contact, 'not a contact type',
                 display_name='test')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_relationship_by_id(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = """
@@ -349,11 +898,11 @@ class CiviCRMTests(unittest.TestCase):
         result = self.cc.add_relationship(101, 102, 1)
         self.assertEquals(result['relationship_type_id'], '1')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_relationship_by_type(self, mock_requests):
         result1 = """{
         "is_error":0,"version":3,"count":1,"id":3,
-        "values":[{"id":"3","name_a_b":"Partnerof"}]
+        "values":[{"id":"3","name_a_b":"Partner of"}]
         }"""
         result2 = """
         {
@@ -382,9 +931,34 @@ class CiviCRMTests(unittest.TestCase):
         call = mock_requests.post.call_args[1]['data']['relationship_type_id']
         self.assertEquals(call, '3')
         self.assertEquals(result['relationship_type_id'], '3')
+        params = mock_requests.get.call_args[1]['params']
+        self.assertEquals(params['options[limit]'], 0)
+        self.cc.add_relationship(101, 102, 'Partner of')
+        self.assertEquals(mock_requests.get.call_count, 1)
 
-
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
+    def test_relationship_type_index(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = """{
+        "is_error":0,"values":[
+        {"id":"1","name_a_b":"Child of","label_a_b":"Child of",
+         "name_b_a":"Parent of","description":"Parent/child"},
+        {"id":"2","name_a_b":"Spouse of","label_a_b":"Parent of",
+         "name_b_a":"Spouse of"}]
+        }"""
+        index = self.cc.relationship_type_index()
+        params = mock_requests.get.call_args[1]['params']
+        self.assertEquals(params['return'],
+            'id,name_a_b,label_a_b,name_b_a,label_b_a,description')
+        self.assertEquals(index['Parent/child'], '1')
+        self.assertEquals(index['Spouse of'], '2')
+        # label_a_b is searched before name_b_a
+        self.assertEquals(index['Parent of'], '2')
+        self.cc.relationship_type_index(refresh=True)
+        self.assertEquals(mock_requests.get.call_count, 2)
+
+
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_relationship_type_not_found(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content =\
@@ -392,7 +966,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertRaises(CivicrmError,
                 self.cc.add_relationship, 101, 102, 'Aunt of')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_activity_type(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = """
@@ -412,7 +986,7 @@ class CiviCRMTests(unittest.TestCase):
         result = self.cc.add_activity_type('test_activity_type', is_active=1)
         self.assertEqual(result['name'], 'test_activity_type')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_activity_by_status_id(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content ="""
@@ -432,7 +1006,7 @@ class CiviCRMTests(unittest.TestCase):
                 subject = "test", status = 2,  is_test=1)
         self.assertEquals(result['activity_type_id'], '1')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     @mock.patch.object(CiviCRM, "is_valid_option")
     def test_add_activity_by_status_type(self, mock_is_valid, mock_requests):
         mock_requests.post.return_value.status_code = 200
@@ -467,7 +1041,7 @@ class CiviCRMTests(unittest.TestCase):
             self.cc.add_activity,"Not A Meeting", self.contact_id,
             "test", "0000", 2)
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_activity_invalid_status_id(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = """
@@ -505,7 +1079,7 @@ class CiviCRMTests(unittest.TestCase):
             self.cc.add_activity,"Meeting", self.contact_id,
             "test", "0000", "test")
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_contribution_by_id(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = """
@@ -531,7 +1105,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertEquals(result['total_amount'], '100')
         assert not self.cc.is_valid_option.called
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_contribution_by_type(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content ="""
@@ -570,7 +1144,7 @@ class CiviCRMTests(unittest.TestCase):
         self.cc.is_valid_option.assert_called_with(
             'Contribution', 'financial_type_id', 'Donation')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_contribution_invalid_financial_type(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content ="""
@@ -588,7 +1162,7 @@ class CiviCRMTests(unittest.TestCase):
                 self.cc.add_contribution,self.contact_id,
                 100, 'Not Valid', is_test=1)
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_email(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content ="""
@@ -611,7 +1185,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertRaises(CivicrmError, self.cc.add_email,
             self.contact_id, 'invalid.address', True)
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_note(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content ="""
@@ -632,7 +1206,7 @@ class CiviCRMTests(unittest.TestCase):
         result = self.cc.add_note(self.contact_id, 'test')
         self.assertEquals(result['note'], 'test')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_tag(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content ="""
@@ -652,7 +1226,7 @@ class CiviCRMTests(unittest.TestCase):
         result = self.cc.add_tag('test')
         self.assertEquals(result['name'], 'test')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_entity_tag(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content =\
@@ -660,7 +1234,7 @@ class CiviCRMTests(unittest.TestCase):
         result = self.cc.add_entity_tag(self.contact_id, 1)
         self.assertEquals(result['added'], 1)
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_group(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = """
@@ -679,7 +1253,7 @@ class CiviCRMTests(unittest.TestCase):
         result = self.cc.add_group(title='test')
         self.assertEquals(result['title'], 'test')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_group_contact(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content =\
@@ -687,7 +1261,7 @@ class CiviCRMTests(unittest.TestCase):
         result = self.cc.add_group_contact(self.contact_id, 5)
         self.assertEquals(result['added'], 1)
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_phone(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = """
@@ -711,7 +1285,7 @@ class CiviCRMTests(unittest.TestCase):
         result = self.cc.add_phone(self.contact_id, '111-111-1111')
         self.assertEquals(result['phone'], '111-111-1111')
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_address_by_location_type_id(self, mock_requests):
         mock_requests.post.return_value.status_code = 200
         mock_requests.post.return_value.content = """
@@ -735,7 +1309,7 @@ class CiviCRMTests(unittest.TestCase):
         self.assertEquals(result['location_type_id'], '1')
         assert not self.cc.is_valid_option.called
 
-    @mock.patch("pythoncivicrm.pythoncivicrm.requests")
+    @mock.patch.object(RequestsTransport, "session")
     def test_add_address_by_location_type(self, mock_requests):
         mock_requests.get.return_value.status_code = 200
         mock_requests.get.return_value.content = """
@@ -776,5 +1350,1088 @@ class CiviCRMTests(unittest.TestCase):
             'Address', 'location_type_id', 'Home')
 
 
+class LRUCacheTests(unittest.TestCase):
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIn('a', cache)
+        self.assertNotIn('b', cache)
+        self.assertEqual(cache.stats()['size'], 2)
+
+    @mock.patch("pythoncivicrm.cache.time")
+    def test_expiry(self, mock_time):
+        cache = LRUCache(ttl=10)
+        mock_time.time.return_value = 100
+        cache.set('a', None)
+        mock_time.time.return_value = 105
+        self.assertIsNone(cache.get('a'))
+        mock_time.time.return_value = 111
+        self.assertIs(cache.get('a'), MISSING)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        cache.set('b', 1, ttl=None)
+        mock_time.time.return_value = 1000
+        self.assertIn('b', cache)
+
+    def test_invalidate(self):
+        cache = LRUCache()
+        cache.set(('x', 1), 1)
+        cache.set(('y', 1), 2)
+        cache.invalidate(lambda key: key[0] == 'x')
+        self.assertEqual(len(cache), 1)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+    def test_invalidate_groups(self):
+        cache = LRUCache(maxsize=3)
+        for key in [('x', 1), ('x', 2), ('y', 1), ('z', 1)]:
+            cache.set(key, 1)
+        # ('x', 1) was evicted, and left its group
+        self.assertEqual(cache._groups['x'], set([('x', 2)]))
+        cache.invalidate_groups(['x', 'y', 'w'])
+        self.assertEqual(len(cache), 1)
+        self.assertIn(('z', 1), cache)
+        self.assertEqual(list(cache._groups), ['z'])
+
+
+class DiskCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache.db')
+        self.cache = DiskCache(self.path, maxsize=2, ttl=10)
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_persistence(self):
+        self.cache.set(('Contact', 'a'), b'{"values": []}')
+        self.cache.close()
+        self.cache = DiskCache(self.path)
+        self.assertEqual(self.cache.get(('Contact', 'a')), b'{"values": []}')
+        self.assertIs(self.cache.get(('Contact', 'b')), MISSING)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    @mock.patch("pythoncivicrm.cache.time")
+    def test_expiry_and_eviction(self, mock_time):
+        mock_time.time.return_value = 100
+        self.cache.set('a', 1)
+        self.cache.set('b', 2, ttl=None)
+        mock_time.time.return_value = 105
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        mock_time.time.return_value = 120
+        self.assertNotIn('a', self.cache)
+        self.assertEqual(self.cache.stats()['size'], 2)
+
+    def test_invalidate(self):
+        self.cache.set(('x', 1), 1)
+        self.cache.set(('y', 1), 2)
+        self.cache.invalidate(lambda key: key[0] == 'x')
+        self.assertEqual(len(self.cache), 1)
+        self.cache.invalidate(('y', 1))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_invalidate_groups(self):
+        self.cache.maxsize = 10
+        for key in [('x', 1), ('x', 2), ('y', 1), 'x']:
+            self.cache.set(key, 1)
+        self.cache.invalidate_groups(['x'])
+        self.assertEqual(len(self.cache), 2)
+        self.assertIn('x', self.cache)
+        self.assertIn(('y', 1), self.cache)
+        self.cache.set(('y', 1), 2)
+        self.assertEqual(self.cache._size, 2)
+
+    @mock.patch("pythoncivicrm.cache.time")
+    def test_expired_purged(self, mock_time):
+        mock_time.time.return_value = 100
+        self.cache.set('a', 1, ttl=3)
+        mock_time.time.return_value = 101
+        self.cache.set('b', 2, ttl=None)
+        mock_time.time.return_value = 102
+        self.assertEqual(self.cache.get('a'), 1)
+        mock_time.time.return_value = 105
+        self.cache.set('c', 3)
+        # a was used more recently, but has expired
+        self.assertIn('b', self.cache)
+        self.assertIn('c', self.cache)
+        self.assertEqual(len(self.cache), 2)
+
+
+class RecordTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rows = [
+            {'id': '1', 'email': 'a@example.org', 'count': '3'},
+            {'id': '2', 'city': 'Portland'},
+        ]
+
+    def test_access(self):
+        first, second = to_records('Contact', self.rows)
+        self.assertIs(type(first), type(second))
+        self.assertIsInstance(first, Record)
+        self.assertEqual(first['email'], 'a@example.org')
+        self.assertEqual(first.email, 'a@example.org')
+        self.assertEqual(first['count'], '3')
+        self.assertEqual(first.get('city', 'none'), 'none')
+        self.assertRaises(KeyError, lambda: first['city'])
+        self.assertRaises(AttributeError, getattr, second, 'email')
+        self.assertNotIn('city', first)
+        self.assertIn('city', second)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(sorted(first), ['count', 'email', 'id'])
+        self.assertEqual(dict(second), self.rows[1])
+        self.assertEqual(first, self.rows[0])
+        self.assertNotEqual(second, self.rows[0])
+        self.assertEqual(first.as_dict(), self.rows[0])
+        self.assertRaises(AttributeError, setattr, first, 'id', '3')
+        self.assertRaises(TypeError, hash, first)
+
+    def test_copy_and_pickle(self):
+        record = to_records('Contact', self.rows)[0]
+        self.assertEqual(copy.deepcopy(record), record)
+        restored = pickle.loads(pickle.dumps(record))
+        self.assertEqual(restored, self.rows[0])
+        self.assertIs(type(restored), type(record))
+
+    def test_builder(self):
+        build = RecordBuilder('Contact')
+        first = build({'id': '1'})
+        second = build({'id': '2', 'city': 'Portland'})
+        third = build({'city': 'Boston'})
+        self.assertIsNot(type(first), type(second))
+        self.assertIs(type(second), type(third))
+        self.assertEqual(third, {'city': 'Boston'})
+        self.assertEqual(build.fields, ['id', 'city'])
+
+    def test_shared_values(self):
+        build = RecordBuilder('Contact')
+        first = build({'contact_type': u''.join([u'Indiv', u'idual'])})
+        second = build({'contact_type': u''.join([u'Indiv', u'idual'])})
+        self.assertIs(first['contact_type'], second['contact_type'])
+
+    def test_convert(self):
+        rows = [{'id': str(i), 'contact_type': u''.join([u'Indiv', u'idual']),
+                 'tags': [i]} for i in range(600)]
+        rows[300]['city'] = 'Portland'
+        del rows[400]['contact_type']
+        expected = [dict(row) for row in rows]
+        records = to_records('Contact', rows)
+        self.assertEqual(records, expected)
+        self.assertEqual(len(set(type(record) for record in records)), 1)
+        self.assertIs(records[0]['contact_type'],
+                      records[599]['contact_type'])
+        self.assertNotIn('contact_type', records[400])
+
+    def test_memory(self):
+        if tracemalloc is None:
+            self.skipTest('tracemalloc is not available')
+        content = benchmarks.make_response(benchmarks.make_rows(2000))
+
+        def measure(records):
+            cc = benchmarks.client(content, records=records)
+            tracemalloc.start()
+            try:
+                rows = cc.get('Contact', limit=0)
+                retained, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            self.assertEqual(len(rows), 2000)
+            return retained, peak
+
+        dict_retained, dict_peak = measure(False)
+        retained, peak = measure(True)
+        self.assertLess(retained, dict_retained * 0.6)
+        self.assertLess(peak, dict_peak * 1.1)
+
+
+class OptionIndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.index = OptionIndex({'1': 'Yes', '0': 'No', '2': 'no ',
+                                  '3': 'Phone Call'})
+
+    def test_resolve_id(self):
+        self.assertEqual(self.index.resolve(3), 3)
+        self.assertRaises(KeyError, self.index.resolve, 4)
+
+    def test_resolve_label(self):
+        self.assertEqual(self.index.resolve('Yes'), '1')
+        self.assertEqual(self.index.resolve(' phone   CALL'), '3')
+
+    def test_ambiguous_label(self):
+        self.assertEqual(self.index.resolve('No'), '0')
+        self.assertRaises(KeyError, self.index.resolve, 'NO')
+
+    def test_not_a_string(self):
+        self.assertRaises(KeyError, self.index.resolve, None)
+
+
+class RunParallelTests(unittest.TestCase):
+
+    def test_results(self):
+        outcomes = sorted(run_parallel(lambda x: 10 // x, [1, 0, 5], 2))
+        self.assertEqual([o[2] for o in outcomes], [10, None, 2])
+        self.assertIsInstance(outcomes[1][3], ZeroDivisionError)
+
+    def test_iteration_error(self):
+        def items():
+            yield 1
+            raise ValueError('bad input')
+        self.assertRaises(ValueError, list, run_parallel(str, items()))
+
+    def test_close_stops_work(self):
+        read = []
+        called = []
+
+        def items():
+            for i in range(1000):
+                read.append(i)
+                yield i
+
+        def func(item):
+            called.append(item)
+            time.sleep(0.01)
+
+        results = run_parallel(func, items(), 2)
+        next(results)
+        results.close()
+        time.sleep(0.1)
+        count = len(called)
+        # a few started, or read ahead, before the close
+        self.assertLess(count, 20)
+        self.assertLess(len(read), 20)
+        time.sleep(0.05)
+        self.assertEqual(len(called), count)
+
+    def test_close_stops_reading(self):
+        read = []
+
+        def items():
+            # endless, so only stopping reading ends it
+            for i in itertools.count():
+                read.append(i)
+                yield i
+
+        results = run_parallel(lambda item: item, items(), 2, read_ahead=2)
+        next(results)
+        results.close()
+        time.sleep(0.1)
+        count = len(read)
+        time.sleep(0.1)
+        self.assertEqual(len(read), count)
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def run_threads(self, target, count=4):
+        threads = [threading.Thread(target=target) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_calls_shared(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        calls, results = [], []
+
+        def slow():
+            calls.append(1)
+            started.set()
+            time.sleep(0.05)
+            return ['result']
+
+        def leader():
+            results.append(flight.do('key', slow))
+
+        def follower():
+            started.wait()
+            results.append(flight.do('key', slow))
+
+        first = threading.Thread(target=leader)
+        first.start()
+        self.run_threads(follower, 3)
+        first.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(flight.shared, 3)
+        self.assertTrue(all(r is results[0] for r in results))
+        # once finished the next call runs again
+        flight.do('key', slow)
+        self.assertEqual(len(calls), 2)
+
+    def test_error_raised_for_all(self):
+        flight = SingleFlight()
+        errors = []
+
+        def fail():
+            time.sleep(0.02)
+            raise CivicrmError('test')
+
+        def call():
+            try:
+                flight.do('key', fail)
+            except CivicrmError as error:
+                errors.append(error)
+
+        self.run_threads(call)
+        self.assertEqual(len(errors), 4)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_coalesced_get(self, mock_requests):
+        cc = CiviCRM('example.org', 'site', 'api', coalesce=True)
+
+        def slow_get(*args, **kwargs):
+            time.sleep(0.05)
+            response = mock.MagicMock(status_code=200)
+            response.content = '{"is_error":0,"values":[{"id":"1"}]}'
+            return response
+
+        mock_requests.get.side_effect = slow_get
+        results = []
+        self.run_threads(lambda: results.append(
+            cc.get('Contact', contact_type='Individual')))
+        self.assertEqual(mock_requests.get.call_count, 1)
+        self.assertEqual(results, [[{'id': '1'}]] * 4)
+        # each caller has its own copy, as get changes them in place
+        self.assertEqual(len(set(id(rows) for rows in results)), 4)
+        self.assertEqual(len(set(id(rows[0]) for rows in results)), 4)
+        # different parameters are different requests
+        cc.get('Contact', contact_type='Organization')
+        self.assertEqual(mock_requests.get.call_count, 2)
+
+
+class AdaptiveLimiterTests(unittest.TestCase):
+
+    def test_increase_and_backoff(self):
+        limiter = AdaptiveLimiter(initial=2, maximum=4)
+        for _ in range(20):
+            limiter.call(lambda: None)
+        self.assertEqual(limiter.limit, 4)
+
+        def fail():
+            raise CivicrmError('Deadlock found when trying to get lock')
+
+        self.assertRaises(CivicrmError, limiter.call, fail)
+        self.assertEqual(limiter.limit, 2)
+
+    def test_row_errors_ignored(self):
+        limiter = AdaptiveLimiter(initial=4)
+
+        def invalid():
+            raise CivicrmError('Mandatory key(s) missing from params '
+                               'array: contact_id')
+
+        for _ in range(10):
+            self.assertRaises(CivicrmError, limiter.call, invalid)
+        self.assertEqual((limiter.limit, limiter.decreases), (4, 0))
+        self.assertEqual(limiter.in_flight, 0)
+        for error in [CivicrmError('request to x failed with status code '
+                                   '503'),
+                      CivicrmError('DB Error: Lock wait timeout exceeded'),
+                      requests.exceptions.ConnectTimeout('timed out'),
+                      IOError('Connection reset by peer')]:
+            self.assertTrue(is_overload(error), error)
+        self.assertFalse(is_overload(ValueError('bad value')))
+
+    def test_single_cut_per_overload(self):
+        limiter = AdaptiveLimiter(initial=8)
+        generation = limiter._acquire()
+        limiter._acquire()
+        limiter._release(generation, 0, True)
+        limiter._release(generation, 0, True)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.in_flight, 0)
+
+    @mock.patch("pythoncivicrm.parallel.time")
+    def test_slow_call_backs_off(self, mock_time):
+        limiter = AdaptiveLimiter(initial=4)
+        mock_time.time.side_effect = [0, 1, 10, 11, 20, 30]
+        limiter.call(lambda: None)
+        limiter.call(lambda: None)
+        self.assertGreater(limiter.limit, 4)
+        limiter.call(lambda: None)
+        self.assertLess(limiter.limit, 4)
+
+    def test_in_flight_bounded(self):
+        limiter = AdaptiveLimiter(initial=2, maximum=2)
+        state = {'running': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def call(_):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+
+        list(run_parallel(lambda x: limiter.call(call, x), range(12), 6))
+        self.assertEqual(state['max'], 2)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_bulk_create_adaptive(self, mock_requests):
+        responses = [500, 200, 200, 200]
+        mock_requests.post.side_effect = lambda *args, **kwargs: \
+            mock.MagicMock(status_code=responses.pop(0),
+                           content='{"is_error":0,"values":[{"id":"1"}]}')
+        cc = CiviCRM('example.org', 'site', 'api', adaptive_concurrency=True)
+        result = cc.bulk_create('Email', [{'email': 'a@example.org'}] * 4,
+                                concurrency=1)
+        self.assertEqual((result.succeeded, result.failed), (3, 1))
+        limiter = cc.concurrency_limiter('Email')
+        self.assertEqual(limiter.decreases, 1)
+        self.assertIs(cc.concurrency_limiter('Email'), limiter)
+
+    def test_limit_capped_at_concurrency(self):
+        fake = FakeCiviCRM()
+        cc = fake.civicrm(adaptive_concurrency=True)
+        limits = []
+        limiter = cc.concurrency_limiter('Email')
+        cc.create = lambda entity, **row: limits.append(limiter.limit) or []
+        result = cc.bulk_create('Email', [{'email': 'a@example.org'}] * 500,
+                                concurrency=4)
+        self.assertEqual(result.succeeded, 500)
+        self.assertEqual(max(limits), 4)
+        self.assertEqual(limiter.limit, 4)
+
+        def overloaded():
+            raise IOError('connection reset')
+        # so the first cut is felt straight away
+        self.assertRaises(IOError, limiter.call, overloaded)
+        self.assertEqual(limiter.limit, 2)
+
+
+class HedgerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.hedger = Hedger(percentile=50, min_samples=4)
+        for _ in range(4):
+            self.hedger.call(lambda: None)
+
+    def test_no_delay_until_timed(self):
+        hedger = Hedger(min_samples=2)
+        self.assertIsNone(hedger.delay())
+        hedger.call(lambda: 1)
+        self.assertIsNone(hedger.delay())
+        hedger.call(lambda: 1)
+        self.assertIsNotNone(hedger.delay())
+
+    def test_slow_call_repeated(self):
+        delays = [0.5, 0]
+
+        def slow_then_fast():
+            delay = delays.pop(0)
+            time.sleep(delay)
+            return delay
+
+        self.assertEqual(self.hedger.call(slow_then_fast), 0)
+        self.assertEqual(self.hedger.hedged, 1)
+
+    def test_threads_reused(self):
+        for _ in range(5):
+            self.hedger.call(lambda: None)
+        before = threading.active_count()
+        for _ in range(50):
+            self.hedger.call(lambda: None)
+        self.assertLessEqual(threading.active_count(), before + 1)
+
+    def test_counted_across_threads(self):
+        hedger = Hedger(min_samples=1)
+        threads = [threading.Thread(target=lambda: [
+            hedger.call(lambda: None) for _ in range(200)])
+            for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(hedger.calls, 800)
+
+    def test_fast_call_not_repeated(self):
+        self.hedger._times.extend([1] * 10)
+        calls = []
+        self.hedger.call(lambda: calls.append(1))
+        self.assertEqual((len(calls), self.hedger.hedged), (1, 0))
+
+    def test_error_waits_for_other_call(self):
+        outcomes = [(0.2, CivicrmError('slow')), (0.3, None)]
+
+        def call():
+            delay, error = outcomes.pop(0)
+            time.sleep(delay)
+            if error:
+                raise error
+            return 'ok'
+
+        self.assertEqual(self.hedger.call(call), 'ok')
+        outcomes.extend([(0.2, CivicrmError('first')),
+                         (0.2, CivicrmError('second'))])
+        self.assertRaises(CivicrmError, self.hedger.call, call)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_only_reads_hedged(self, mock_requests):
+        cc = CiviCRM('example.org', 'site', 'api', hedge_percentile=50)
+        cc.hedger = self.hedger
+        # so the attempts don't call the mock at the same moment
+        self.hedger._times.extend([0.1] * 10)
+        delays = [0.5, 0]
+
+        def slow_then_fast(*args, **kwargs):
+            time.sleep(delays.pop(0) if delays else 0.5)
+            return mock.MagicMock(status_code=200,
+                                  content='{"is_error":0,"values":[]}')
+
+        mock_requests.get.side_effect = slow_then_fast
+        mock_requests.post.side_effect = slow_then_fast
+        self.assertEqual(cc.getsingle('Contact', id=1), [])
+        self.assertEqual(mock_requests.get.call_count, 2)
+        cc.create('Contact', contact_type='Individual')
+        self.assertEqual(mock_requests.post.call_count, 1)
+        self.assertEqual(cc.hedge_stats()['hedged'], 1)
+
+
+class MetricsRegistryTests(unittest.TestCase):
+
+    def test_snapshot(self):
+        registry = MetricsRegistry(buckets=[0.1, 1])
+        registry.observe('Contact', 'get', 0.05, rows=3)
+        registry.observe('Contact', 'get', 0.5, error=True)
+        registry.observe('Contact', 'get', 5)
+        registry.transferred('Contact', 'get', 100, 2000)
+        figures = registry.snapshot()['Contact']['get']
+        self.assertEqual(
+            (figures['calls'], figures['errors'], figures['rows']), (3, 1, 3))
+        self.assertEqual(figures['buckets'], [(0.1, 1), (1, 2), (None, 3)])
+        self.assertEqual(figures['response_bytes'], 2000)
+        # a copy
+        figures['calls'] = 0
+        self.assertEqual(registry.snapshot()['Contact']['get']['calls'], 3)
+
+    def test_prometheus(self):
+        registry = MetricsRegistry(buckets=[1])
+        registry.observe('Contact', 'get', 0.5, rows=2)
+        text = registry.prometheus()
+        self.assertIn('# TYPE civicrm_requests_total counter', text)
+        self.assertIn(
+            'civicrm_rows_total{entity="Contact",action="get"} 2', text)
+        self.assertIn('civicrm_request_seconds_bucket'
+                      '{entity="Contact",action="get",le="+Inf"} 1', text)
+        self.assertIn(
+            'civicrm_request_seconds_count{entity="Contact",action="get"} 1',
+            text)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_client_metrics(self, mock_requests):
+        content = '{"is_error":0,"values":[{"id":"1"},{"id":"2"}]}'
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = content
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.content = \
+            '{"is_error":1,"error_message":"test"}'
+        cc = CiviCRM('example.org', 'site', 'api', metrics=True)
+        cc.get('Contact')
+        self.assertRaises(CivicrmError, cc.create, 'Email', email='a@b.org')
+        snapshot = cc.metrics.snapshot()
+        self.assertEqual(snapshot['Contact']['get']['rows'], 2)
+        self.assertEqual(snapshot['Contact']['get']['response_bytes'],
+                         len(content))
+        self.assertGreater(snapshot['Contact']['get']['request_bytes'], 0)
+        self.assertEqual(snapshot['Email']['create']['errors'], 1)
+
+
+class TracerTests(unittest.TestCase):
+
+    def test_nested_spans(self):
+        started, finished = [], []
+        tracer = Tracer(before=started.append, after=finished.append)
+        with tracer.span('outer') as outer:
+            with tracer.span('inner', entity='Contact') as inner:
+                self.assertIs(tracer.current(), inner)
+        self.assertIsNone(tracer.current())
+        self.assertIs(inner.parent, outer)
+        self.assertEqual(inner.trace_id, outer.trace_id)
+        self.assertEqual(started, [outer, inner])
+        self.assertEqual(finished, [inner, outer])
+
+    def test_error_recorded(self):
+        tracer = Tracer()
+        try:
+            with tracer.span('fails'):
+                raise CivicrmError('test')
+        except CivicrmError:
+            pass
+        self.assertIsInstance(tracer.spans[0].error, CivicrmError)
+        event = tracer.chrome_trace()['traceEvents'][0]
+        self.assertEqual(event['args']['error'], 'test')
+
+    def test_bind(self):
+        tracer = Tracer()
+        self.assertIs(tracer.bind(len), len)
+
+        spans = []
+
+        def work():
+            with tracer.span('work') as span:
+                spans.append(span)
+        with tracer.span('outer') as outer:
+            thread = threading.Thread(target=tracer.bind(work))
+            thread.start()
+            thread.join()
+        span = spans[0]
+        self.assertIs(span.parent, outer)
+        self.assertEqual(span.trace_id, outer.trace_id)
+        self.assertNotEqual(span.thread, outer.thread)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_bulk_create_spans(self, mock_requests):
+        mock_requests.post.return_value.status_code = 200
+        mock_requests.post.return_value.content = \
+            '{"is_error":0,"values":[{"id":"1"}]}'
+        tracer = Tracer()
+        cc = CiviCRM('example.org', 'site', 'api', tracer=tracer)
+        cc.bulk_create('Email', [{'email': 'e%s' % i} for i in range(4)],
+                       concurrency=2)
+        bulk = [span for span in tracer.spans if span.name == 'bulk_create']
+        creates = [span for span in tracer.spans if span.name == 'create']
+        self.assertEqual(len(creates), 4)
+        for span in creates:
+            self.assertIs(span.parent, bulk[0])
+            self.assertEqual(span.trace_id, bulk[0].trace_id)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_client_spans(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":{"1":"Meeting"}}'
+        tracer = Tracer()
+        cc = CiviCRM('example.org', 'site', 'api', tracer=tracer)
+        cc.resolve_options('Activity', 'activity_type_id', ['Meeting'])
+        names = [span.name for span in tracer.spans]
+        self.assertEqual(names, ['GET Activity.getoptions', 'getoptions',
+                                 'option_index', 'resolve_options'])
+        http = tracer.spans[0]
+        self.assertEqual(http.attrs['status'], 200)
+        self.assertEqual(http.parent.attrs['entity'], 'Activity')
+        self.assertIs(http.parent.parent.parent, tracer.spans[3])
+        trace = json.loads(json.dumps(tracer.chrome_trace()))
+        events = trace['traceEvents']
+        self.assertEqual(events[0]['name'], 'resolve_options')
+        self.assertEqual(events[0]['ph'], 'X')
+        self.assertEqual(events[3]['cat'], 'http')
+        self.assertEqual(events[3]['args']['parent_id'],
+                         events[2]['args']['span_id'])
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_entity_keyword(self, mock_requests):
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.content = \
+            '{"is_error":0,"values":[]}'
+        tracer = Tracer()
+        cc = CiviCRM('example.org', 'site', 'api', tracer=tracer)
+        cc.get(entity='Contact')
+        self.assertEqual(tracer.spans[-1].name, 'get')
+        self.assertEqual(tracer.spans[-1].attrs['entity'], 'Contact')
+
+
+class ValuesStreamTests(unittest.TestCase):
+
+    def setUp(self):
+        self.response = json.dumps({
+            "is_error": 0,
+            "count": 3,
+            "values": [{"id": "1", "name": "caf\u00e9"}, 22, [1, "]"]],
+            "id": 12345,
+        }).encode('utf-8')
+
+    def chunked(self, data, size):
+        return [data[i:i + size] for i in range(0, len(data), size)]
+
+    def test_any_chunk_size(self):
+        for size in range(1, len(self.response) + 1):
+            stream = ValuesStream(self.chunked(self.response, size))
+            self.assertEqual(list(stream),
+                    [{"id": "1", "name": "caf\u00e9"}, 22, [1, "]"]])
+            self.assertEqual(stream.header,
+                    {"is_error": 0, "count": 3, "id": 12345})
+
+    def test_values_object(self):
+        stream = ValuesStream([b'{"values": {"1": "Yes", "0": "No"}}'])
+        self.assertEqual(sorted(stream), ["No", "Yes"])
+
+    def test_no_values(self):
+        stream = ValuesStream([b'{"is_error":1,', b'"error_message":"x"}'])
+        self.assertEqual(list(stream), [])
+        self.assertEqual(stream.header['is_error'], 1)
+
+    def test_truncated_response(self):
+        stream = ValuesStream([b'{"values": [{"id": "1"}, {"id"'])
+        self.assertRaises(ValueError, list, stream)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_stream_get(self, mock_requests):
+        cc = CiviCRM('example.org', 'site', 'api')
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.iter_content.return_value = \
+            self.chunked(self.response, 7)
+        results = list(cc.stream_get('Contact', limit=0))
+        self.assertEqual(results[0]['id'], '1')
+        self.assertTrue(mock_requests.get.call_args[1]['stream'])
+        self.assertTrue(mock_requests.get.return_value.close.called)
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_stream_get_raises_error(self, mock_requests):
+        cc = CiviCRM('example.org', 'site', 'api')
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.iter_content.return_value = \
+            [b'{"is_error":1,"error_message":"test"}']
+        self.assertRaises(CivicrmError, list, cc.stream_get('Contact'))
+
+    @mock.patch.object(RequestsTransport, "session")
+    def test_stream_get_observed(self, mock_requests):
+        tracer = Tracer()
+        cc = CiviCRM('example.org', 'site', 'api', metrics=True,
+                     tracer=tracer)
+        mock_requests.get.return_value.status_code = 200
+        mock_requests.get.return_value.headers = {}
+        mock_requests.get.return_value.iter_content.return_value = \
+            self.chunked(self.response, 7)
+        self.assertEqual(len(list(cc.stream_get('Contact', limit=0))), 3)
+        http, streamed = tracer.spans
+        self.assertEqual(streamed.name, 'stream_get')
+        self.assertEqual(streamed.attrs['entity'], 'Contact')
+        self.assertIs(http.parent, streamed)
+        figures = cc.metrics.snapshot()['Contact']['get']
+        self.assertEqual((figures['calls'], figures['errors'],
+                          figures['rows']), (1, 0, 3))
+        # stopping early isn't an error
+        mock_requests.get.return_value.iter_content.return_value = \
+            self.chunked(self.response, 7)
+        rows = cc.stream_get('Contact', limit=0)
+        next(rows)
+        rows.close()
+        self.assertIsNone(tracer.spans[-1].error)
+        self.assertIsNone(tracer.current())
+        figures = cc.metrics.snapshot()['Contact']['get']
+        self.assertEqual((figures['calls'], figures['errors'],
+                          figures['rows']), (2, 0, 4))
+
+
+class FakeServerTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeCiviCRM(
+            {'Contact': sample_contacts(60)},
+            options={('Contact', 'contact_type'):
+                     {'Individual': 'Individual'}},
+        )
+        self.server = FakeServer(self.fake).start()
+        self.cc = self.server.civicrm()
+
+    def tearDown(self):
+        self.cc.close()
+        self.server.stop()
+
+    def test_get(self):
+        self.assertEqual(len(self.cc.get('Contact')), 25)
+        rows = self.cc.get('Contact', limit=10, offset=20,
+                           **{'return': 'display_name'})
+        self.assertEqual([row['id'] for row in rows],
+                         [str(i) for i in range(21, 31)])
+        self.assertEqual(sorted(rows[0]), ['display_name', 'id'])
+        self.assertEqual(len(self.cc.get('Contact', limit=0)), 60)
+        self.assertEqual(self.cc.get('Contact', last_name='Surname7'),
+                         [sample_contacts(7)[6]])
+
+    def test_paging_and_lookups(self):
+        ids = [row['id'] for row in self.cc.iter_get(
+            'Contact', page_size=7, keyset=True, after_id=50)]
+        self.assertEqual(ids, [str(i) for i in range(51, 61)])
+        found = self.cc.get_many('Contact', [3, 5, 99])
+        self.assertEqual(sorted(found), [3, 5])
+        self.assertEqual(self.cc.getcount('Contact', city='Portland'), 60)
+
+    def test_single_values(self):
+        self.assertEqual(self.cc.getsingle('Contact', id=4)['last_name'],
+                         'Surname4')
+        self.assertEqual(self.cc.getvalue('Contact', 'email', id=4),
+                         'contact4@example.org')
+        self.assertRaises(CivicrmError, self.cc.getsingle, 'Contact',
+                          city='Portland')
+        self.assertEqual(self.cc.getoptions('Contact', 'contact_type'),
+                         {'Individual': 'Individual'})
+        self.assertIn('email', self.cc.getfields('Contact'))
+
+    def test_writes(self):
+        created = self.cc.create('Contact', contact_type='Individual',
+                                 last_name='New')
+        self.assertEqual(created[0]['id'], '61')
+        self.cc.update('Contact', 61, last_name='Newer')
+        self.cc.setvalue('Contact', 61, 'city', 'Boston')
+        self.assertEqual(self.cc.getsingle('Contact', id=61)['city'],
+                         'Boston')
+        self.assertEqual(self.cc.delete('Contact', 61), 1)
+        self.assertEqual(self.cc.getcount('Contact'), 60)
+        self.assertEqual(self.fake.requests[('Contact', 'create')], 2)
+
+    def test_injected_errors(self):
+        self.fake.error_rate = 1
+        self.assertRaises(CivicrmError, self.cc.get, 'Contact')
+        self.fake.error_rate = 0
+        self.fake.http_error_rate = 1
+        self.assertRaises(CivicrmError, self.cc.get, 'Contact')
+        self.fake.http_error_rate = 0
+        bad = CiviCRM(self.server.url, 'site_key', 'wrong', use_ssl=False)
+        self.assertRaises(CivicrmError, bad.get, 'Contact')
+
+    def test_form_fields_parsed_as_php(self):
+        self.assertEqual(self.fake._merge([('return', 'id'),
+                                           ('return', 'email')])['return'],
+                         'email')
+        self.assertEqual(self.fake._merge([('return[]', 'id'),
+                                           ('return[]', 'email')])['return'],
+                         ['id', 'email'])
+
+    def test_add_relationship(self):
+        self.fake.tables['RelationshipType'] = [
+            {'id': '1', 'name_a_b': 'Child of', 'label_a_b': 'Child of',
+             'name_b_a': 'Parent of', 'label_b_a': 'Parent of',
+             'description': 'Parent/child relationship.', 'is_active': '1'},
+            {'id': '2', 'name_a_b': 'Employee of',
+             'label_a_b': 'Employee of', 'name_b_a': 'Employer of',
+             'label_b_a': 'Employer of', 'is_active': '1'},
+        ]
+        relationship = self.cc.add_relationship(1, 2, 'Employer of')
+        self.assertEqual(relationship['relationship_type_id'], '2')
+        relationship = self.cc.add_relationship(3, 4, 'Parent of')
+        self.assertEqual(relationship['relationship_type_id'], '1')
+        self.assertEqual(
+            self.fake.requests[('RelationshipType', 'get')], 1)
+
+    def test_urllib3_transport(self):
+        cc = self.server.civicrm(transport='urllib3')
+        self.assertIsInstance(cc.transport, Urllib3Transport)
+        rows = cc.get('Contact', limit=3, first_name='Forename')
+        self.assertEqual(len(rows), 3)
+        created = cc.create('Contact', last_name=u'caf\u00e9')
+        self.assertEqual(created[0]['last_name'], u'caf\u00e9')
+        streamed = list(cc.stream_get('Contact', chunk_size=100, limit=0))
+        self.assertEqual(len(streamed), 61)
+        cc.transport = Urllib3Transport()
+        cc.max_query_length = 10
+        self.assertEqual(cc.getsingle('Contact', id=2)['id'], '2')
+        self.fake.http_error_rate = 1
+        self.assertRaises(CivicrmError, cc.get, 'Contact')
+        cc.close()
+
+    def test_in_process_transport(self):
+        cc = self.fake.civicrm()
+        self.assertIsInstance(cc.transport, InProcessTransport)
+        self.assertEqual(len(cc.get('Contact', limit=0, id={'>': 55})), 5)
+        self.assertEqual(cc.get_many('Contact', ['1', '2'], return_fields=[
+            'email'])['2']['email'], 'contact2@example.org')
+        self.assertEqual(len(list(cc.stream_get('Contact', chunk_size=10))),
+                         25)
+        self.fake.error_rate = 1
+        self.assertRaises(CivicrmError, cc.getcount, 'Contact')
+        self.assertRaises(AttributeError, getattr, cc, 'session')
+
+    def test_prepare(self):
+        find = self.cc.prepare('Contact', 'get', **{'return': 'email'})
+        self.assertEqual(find(id=3), [{'id': '3',
+                                       'email': 'contact3@example.org'}])
+        self.assertEqual(len(find(limit=0)), 60)
+        cc = self.server.civicrm(transport='urllib3')
+        add = cc.prepare('Contact', 'create', contact_type='Individual')
+        self.assertEqual(add(last_name=u'caf\u00e9')[0]['last_name'],
+                         u'caf\u00e9')
+        self.assertEqual(cc.prepare('Contact', 'getcount')(), 61)
+        cc.close()
+
+    def test_records(self):
+        cc = self.fake.civicrm(records=True)
+        rows = cc.get('Contact', limit=5, **{'return': 'email'})
+        self.assertIsInstance(rows[0], Record)
+        self.assertEqual(rows[2].email, 'contact3@example.org')
+        streamed = list(cc.stream_get('Contact', chunk_size=100, limit=0))
+        self.assertEqual(streamed[59]['id'], '60')
+        self.assertEqual(streamed, sample_contacts(60))
+        self.assertIsInstance(next(cc.iter_get('Contact')), Record)
+        found = cc.get_many('Contact', [3, 5])
+        self.assertEqual(found[5].last_name, 'Surname5')
+        self.assertIsInstance(cc.prepare('Contact', 'get')(id=1)[0], Record)
+
+    def test_bulk_create_concurrency(self):
+        self.fake.latency = 0.05
+        cc = self.fake.civicrm()
+        rows = [{'contact_type': 'Individual', 'last_name': 'Bulk%s' % i}
+                for i in range(8)]
+        started = time.time()
+        result = cc.bulk_create('Contact', rows, concurrency=8)
+        # one row at a time per worker, not one chunk of 100
+        self.assertLess(time.time() - started, 0.2)
+        self.assertEqual(result.succeeded, 8)
+        self.assertEqual(result.results[7]['last_name'], 'Bulk7')
+
+    def test_latency_and_padding(self):
+        self.fake.latency = 0.05
+        self.fake.padding = 1000
+        started = time.time()
+        rows = self.cc.get('Contact', limit=2)
+        self.assertGreaterEqual(time.time() - started, 0.05)
+        self.assertEqual(len(rows[0]['padding']), 1000)
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_run(self):
+        results = benchmarks.run(sizes=[2], min_time=0, repeat=1)
+        names = set(result['name'] for result in results['results'])
+        self.assertTrue(set(['construct_payload', 'decode', 'get', 'create'])
+                        <= names)
+        baseline = json.loads(json.dumps(results))
+        self.assertEqual(len(benchmarks.compare(results, baseline)),
+                         len(results['results']))
+
+
+@unittest.skipIf(AsyncCiviCRM is None, "requires Python 3.5+")
+class AsyncCiviCRMTests(unittest.TestCase):
+
+    def setUp(self):
+        self.session = mock.MagicMock()
+        self.cc = CiviCRM('example.org', 'site', 'api', session=self.session)
+        # calls made by the client in worker threads
+        self.acc = AsyncCiviCRM(client=self.cc, max_concurrency=2,
+                                native=False)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.acc.close()
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_get(self):
+        self.session.get.return_value.status_code = 200
+        self.session.get.return_value.content = \
+            '{"is_error":0,"values":[{"id":"1"}]}'
+        results = self.loop.run_until_complete(self.acc.get('Contact'))
+        self.assertEqual(results[0]['id'], '1')
+        self.assertEqual(
+            self.session.get.call_args[1]['params']['entity'], 'Contact')
+
+    def test_close_leaves_supplied_client_open(self):
+        self.acc.close()
+        self.assertFalse(self.session.close.called)
+
+    def test_concurrency_is_bounded(self):
+        state = {'running': 0, 'max': 0}
+        lock = threading.Lock()
+
+        def fake_get(entity, **kwargs):
+            with lock:
+                state['running'] += 1
+                state['max'] = max(state['max'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running'] -= 1
+            return []
+
+        self.cc.get = fake_get
+        calls = [self.acc.get('Contact') for _ in range(6)]
+        self.loop.run_until_complete(asyncio.gather(*calls))
+        self.assertEqual(state['max'], 2)
+
+    def test_cancelled_call_is_not_sent(self):
+        self.cc.get = mock.MagicMock(return_value=[])
+        # take both slots so the next call has to wait
+        semaphore = asyncio.Semaphore(0)
+        self.acc._semaphore = semaphore
+        task = self.loop.create_task(self.acc.get('Contact'))
+        self.loop.call_soon(task.cancel)
+        self.assertRaises(asyncio.CancelledError,
+            self.loop.run_until_complete, task)
+        self.assertFalse(self.cc.get.called)
+
+    def test_coalesced_reads(self):
+        self.acc.coalesce = True
+
+        def fake_get(entity, **kwargs):
+            time.sleep(0.01)
+            return [{'id': '1'}]
+
+        self.cc.get = mock.MagicMock(side_effect=fake_get)
+        calls = [self.acc.get('Contact', id=1) for _ in range(4)]
+        calls.append(self.acc.get('Contact', id=2))
+        results = self.loop.run_until_complete(asyncio.gather(*calls))
+        self.assertEqual(self.cc.get.call_count, 2)
+        self.assertEqual(results[0], results[3])
+        self.assertIsNot(results[0], results[3])
+        self.assertEqual(self.acc._inflight, {})
+
+
+@unittest.skipIf(httpx is None, "requires httpx")
+class NativeAsyncCiviCRMTests(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeCiviCRM({'Contact': sample_contacts(20)})
+        self.server = FakeServer(self.fake).start()
+        self.cc = self.server.civicrm(result_cache=LRUCache(10))
+        self.acc = AsyncCiviCRM(client=self.cc, max_concurrency=4)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.acc.aclose())
+        asyncio.set_event_loop(None)
+        self.loop.close()
+        self.server.stop()
+
+    def call(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_reads(self):
+        self.assertIsNone(self.acc._executor)
+        rows = self.call(self.acc.get('Contact', limit=5, offset=2))
+        self.assertEqual([row['id'] for row in rows],
+                         [str(i) for i in range(3, 8)])
+        contact = self.call(self.acc.getsingle('Contact', id=4))
+        self.assertEqual(contact['id'], '4')
+        self.assertEqual(self.call(self.acc.getcount('Contact')), 20)
+        rows = self.call(self.acc.get('Contact', id={'IN': [2, 9]}))
+        self.assertEqual(sorted(row['id'] for row in rows), ['2', '9'])
+        # requests were sent by httpx, not the client's transport
+        self.assertIsNone(self.acc._executor)
+        self.assertIsNone(self.cc.transport._session)
+
+    def test_write_invalidates_cache(self):
+        self.assertEqual(self.call(self.acc.getcount('Contact')), 20)
+        created = self.call(self.acc.create(
+            'Contact', contact_type='Individual', last_name='Async'))
+        self.assertEqual(created[0]['last_name'], 'Async')
+        self.assertEqual(self.call(self.acc.getcount('Contact')), 21)
+        self.assertEqual(self.cc.result_cache_stats()['hits'], 0)
+
+    def test_error(self):
+        self.assertRaises(CivicrmError, self.call,
+                          self.acc.getsingle('Contact', id=999))
+
+    def test_concurrent(self):
+        self.fake.latency = 0.05
+        started = time.time()
+        calls = [self.acc.getsingle('Contact', id=i) for i in range(1, 9)]
+        results = self.call(asyncio.gather(*calls))
+        self.assertEqual([row['id'] for row in results],
+                         [str(i) for i in range(1, 9)])
+        # two rounds of four at once
+        self.assertLess(time.time() - started, 0.3)
+
+
 if __name__ == '__main__':
     pass